@@ -0,0 +1,144 @@
+import zlib
+
+import numpy as np
+
+from _util import to_bytes, from_bytes
+
+
+# buildings file versions:
+# legacy (no magic bytes): every rasterized wall, roof and ground position of every building.
+# 1: one span per building and column: the ground height, the lowest and highest position of the building and
+#    whether the highest position is part of a roof. Spans are written in independently compressed chunks.
+MAGIC = b"W2MB"
+BUILDINGS_VERSION = 1
+
+SPAN_DTYPE = np.dtype([
+    ("x", "<i4"),
+    ("y", "<i4"),
+    ("ground", "<i4"),  # NONE if there's no ground position in this column
+    ("zmin", "<i4"),  # NONE if there's no wall/roof position in this column
+    ("zmax", "<i4"),  # NONE if there's no wall/roof position in this column
+    ("roof", "u1"),  # 1 if zmax is part of a roof
+])
+NONE = np.iinfo(np.int32).min
+
+# flush spans to the file once this many have been collected
+CHUNK_SPANS = 1 << 16
+
+_ROOF_KEY = 1 << 40
+
+
+def building_spans(building):
+    """
+    Reduce a building (dict of surface type -> list of (x, y, z) positions) to one span per column.
+    If a roof position exists in a column, zmax is the highest roof position (even if a wall is higher).
+    """
+    points = []
+    types = []
+    for surface_name, surface_points in building.items():
+        p = np.array(surface_points, dtype=np.int64).reshape(-1, 3)
+        points.append(p)
+        types.append(np.full(len(p), {"ground": 0, "roof": 2}.get(surface_name, 1), dtype=np.uint8))
+    if not points:
+        return np.zeros(0, dtype=SPAN_DTYPE)
+    points = np.concatenate(points)
+    types = np.concatenate(types)
+
+    columns, column = np.unique((points[:, 0] << 32) | points[:, 1], return_inverse=True)
+    column = column.reshape(-1)
+    spans = np.zeros(len(columns), dtype=SPAN_DTYPE)
+    spans["x"] = columns >> 32
+    spans["y"] = columns & 0xFFFFFFFF
+
+    z = points[:, 2]
+    is_ground = types == 0
+    ground = np.full(len(columns), NONE, dtype=np.int64)
+    np.maximum.at(ground, column[is_ground], z[is_ground])
+    zmin = np.full(len(columns), np.iinfo(np.int64).max)
+    np.minimum.at(zmin, column[~is_ground], z[~is_ground])
+    zmax_key = np.full(len(columns), np.iinfo(np.int64).min)
+    np.maximum.at(zmax_key, column[~is_ground], z[~is_ground] + (types[~is_ground] == 2)*_ROOF_KEY)
+
+    has_building = zmin != np.iinfo(np.int64).max
+    roof = has_building & (zmax_key >= _ROOF_KEY // 2)
+    spans["ground"] = ground
+    spans["zmin"] = np.where(has_building, zmin, NONE)
+    spans["zmax"] = np.where(has_building, zmax_key - roof*_ROOF_KEY, NONE)
+    spans["roof"] = roof
+    return spans
+
+
+class SpanWriter:
+    """Write spans to a buildings file object in chunks."""
+
+    def __init__(self, f):
+        self.f = f
+        self.pending = []
+        self.pending_count = 0
+        self.count = 0
+        f.write(MAGIC)
+        f.write(to_bytes(BUILDINGS_VERSION, 1))
+
+    def write(self, spans):
+        self.pending.append(spans)
+        self.pending_count += len(spans)
+        if self.pending_count >= CHUNK_SPANS:
+            self.flush()
+
+    def flush(self):
+        if self.pending_count == 0:
+            return
+        compressed = zlib.compress(np.concatenate(self.pending).tobytes(), 9)
+        self.f.write(to_bytes(self.pending_count, 4))
+        self.f.write(to_bytes(len(compressed), 4))
+        self.f.write(compressed)
+        self.count += self.pending_count
+        self.pending = []
+        self.pending_count = 0
+
+    def close(self):
+        self.flush()
+        self.f.write(to_bytes(0, 4))
+
+
+def _read_legacy_buildings(f):
+    buildings_count = from_bytes(f.read(4))
+    assert from_bytes(f.read(1)) == 0
+    spans = []
+    for _ in range(buildings_count):
+        # every building ends with the 0 byte that starts the next one (or the end of the file)
+        building = {}
+        while (surface_name_len := from_bytes(f.read(1))) != 0:
+            surface_name = f.read(surface_name_len).decode("utf-8")
+            pos_count = from_bytes(f.read(4))
+            building[surface_name] = np.frombuffer(f.read(12*pos_count), dtype="<u4").reshape(-1, 3)
+        spans.append(building_spans(building))
+    return np.concatenate(spans) if spans else np.zeros(0, dtype=SPAN_DTYPE)
+
+
+def _in_bbox(spans, bbox):
+    if bbox is None:
+        return spans
+    min_x, min_y, max_x, max_y = bbox
+    return spans[(min_x <= spans["x"]) & (spans["x"] <= max_x) & (min_y <= spans["y"]) & (spans["y"] <= max_y)]
+
+
+def read_buildings(f, bbox=None):
+    """
+    Read all spans of a buildings file object (either version).
+    If `bbox` (min_x, min_y, max_x, max_y) is given, only the spans within it are kept (while reading, chunk by chunk).
+    """
+    magic = f.read(len(MAGIC))
+    if magic != MAGIC:
+        f.seek(-len(magic), 1)
+        return _in_bbox(_read_legacy_buildings(f), bbox)
+    version = from_bytes(f.read(1))
+    if version > BUILDINGS_VERSION:
+        raise ValueError(f"Can't read buildings file; it has newer version {version}")
+    chunks = []
+    while (count := from_bytes(f.read(4))) != 0:
+        length = from_bytes(f.read(4))
+        chunk = np.frombuffer(zlib.decompress(f.read(length)), dtype=SPAN_DTYPE)
+        assert len(chunk) == count
+        chunks.append(_in_bbox(chunk, bbox))
+    return np.concatenate(chunks) if chunks else np.zeros(0, dtype=SPAN_DTYPE)
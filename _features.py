@@ -0,0 +1,192 @@
+import hashlib
+import json
+
+import numpy as np
+
+
+class FeatureColumns:
+    """
+    Features of one kind (e.g. all areas) in columnar form.
+    The vertices of all features are concatenated in `x` and `y`; `counts` holds the vertex count of every feature.
+    `attributes` maps attribute names (e.g. "surface") to lists with one value (or None) per feature.
+    `is_point` is True for features whose coordinates were single numbers instead of lists (point decorations).
+    """
+
+    def __init__(self, x=(), y=(), counts=(), attributes=None, is_point=None):
+        self.x = np.asarray(x, dtype=np.int64)
+        self.y = np.asarray(y, dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.offsets = np.cumsum(self.counts) - self.counts
+        self.attributes = attributes or {}
+        self.is_point = np.zeros(len(self.counts), dtype=bool) if is_point is None else np.asarray(is_point, dtype=bool)
+        assert len(self.x) == len(self.y) == self.counts.sum()
+
+    @classmethod
+    def from_dicts(cls, dicts):
+        is_point = np.array([type(d["x"]) is not list for d in dicts], dtype=bool)
+        counts = np.array([1 if p else len(d["x"]) for d, p in zip(dicts, is_point)], dtype=np.int64)
+
+        def coords(key):
+            return np.fromiter((v for d, p in zip(dicts, is_point) for v in ((d[key],) if p else d[key])), dtype=np.int64, count=counts.sum())
+        names = []
+        for d in dicts:
+            for name in d:
+                if name not in ("x", "y") and name not in names:
+                    names.append(name)
+        attributes = {name: [d.get(name) for d in dicts] for name in names}
+        return cls(coords("x"), coords("y"), counts, attributes, is_point)
+
+    def to_dicts(self):
+        return list(self.iter_dicts())
+
+    def iter_dicts(self):
+        for i in range(len(self)):
+            start, end = self.offsets[i], self.offsets[i]+self.counts[i]
+            if self.is_point[i]:
+                d = {"x": int(self.x[start]), "y": int(self.y[start])}
+            else:
+                d = {"x": self.x[start:end].tolist(), "y": self.y[start:end].tolist()}
+            for name, values in self.attributes.items():
+                if values[i] is not None:
+                    d[name] = values[i]
+            yield d
+
+    @classmethod
+    def concatenate(cls, columns):
+        columns = [c for c in columns if len(c)]
+        if not columns:
+            return cls()
+        names = []
+        for c in columns:
+            for name in c.attributes:
+                if name not in names:
+                    names.append(name)
+        attributes = {name: [v for c in columns for v in c.attributes.get(name, [None]*len(c))] for name in names}
+        return cls(
+            np.concatenate([c.x for c in columns]), np.concatenate([c.y for c in columns]),
+            np.concatenate([c.counts for c in columns]), attributes, np.concatenate([c.is_point for c in columns])
+        )
+
+    def __len__(self):
+        return len(self.counts)
+
+    def subset(self, index):
+        """Return the features selected by `index` (boolean mask or integer indices)."""
+        index = np.arange(len(self))[index]
+        vertex_index = np.repeat(self.offsets[index] - (np.cumsum(self.counts[index]) - self.counts[index]), self.counts[index]) + np.arange(self.counts[index].sum())
+        attributes = {name: [values[i] for i in index] for name, values in self.attributes.items()}
+        return FeatureColumns(self.x[vertex_index], self.y[vertex_index], self.counts[index], attributes, self.is_point[index])
+
+    def attribute(self, name, default=None, dtype=None):
+        """Return an attribute as a numpy array, replacing missing values with `default`."""
+        values = self.attributes.get(name, [None]*len(self))
+        return np.array([default if v is None else v for v in values], dtype=dtype)
+
+    def hashes(self):
+        """
+        A hash of the coordinates and attributes (including the OSM "id", if present) of every feature.
+        Features that are equal in every value get the same hash.
+        """
+        return [
+            hashlib.blake2b(json.dumps(d, sort_keys=True).encode("utf-8"), digest_size=16).digest()
+            for d in self.iter_dicts()
+        ]
+
+    def vertex_feature(self):
+        """Index of the feature every vertex belongs to."""
+        return np.repeat(np.arange(len(self)), self.counts)
+
+    def bboxes(self):
+        """Bounding boxes (min_x, min_y, max_x, max_y) of all features. Features without vertices get empty boxes."""
+        has_vertices = self.counts > 0
+        bboxes = np.empty((4, len(self)), dtype=np.int64)
+        bboxes[:2] = np.iinfo(np.int64).max
+        bboxes[2:] = np.iinfo(np.int64).min
+        offsets = self.offsets[has_vertices]
+        if len(offsets):
+            bboxes[0, has_vertices] = np.minimum.reduceat(self.x, offsets)
+            bboxes[1, has_vertices] = np.minimum.reduceat(self.y, offsets)
+            bboxes[2, has_vertices] = np.maximum.reduceat(self.x, offsets)
+            bboxes[3, has_vertices] = np.maximum.reduceat(self.y, offsets)
+        return bboxes
+
+
+class Features:
+    """
+    All features of a map: areas, highways, buildings and decorations (by decoration name),
+    as stored in the features .json files created by parse_features_osm.py and parse_features_dxf.py.
+    `bounds` is (min_x, max_x, min_y, max_y), or None if unknown.
+    """
+    CATEGORIES = ("areas", "highways", "buildings")
+
+    def __init__(self, areas=None, highways=None, buildings=None, decorations=None, bounds=None):
+        self.areas = areas if areas is not None else FeatureColumns()
+        self.highways = highways if highways is not None else FeatureColumns()
+        self.buildings = buildings if buildings is not None else FeatureColumns()
+        self.decorations = decorations if decorations is not None else {}
+        self.bounds = bounds
+
+    @classmethod
+    def from_json(cls, data):
+        bounds = None
+        if data.get("min_x") is not None:
+            bounds = (data["min_x"], data["max_x"], data["min_y"], data["max_y"])
+        return cls(
+            **{key: FeatureColumns.from_dicts(data.get(key) or []) for key in cls.CATEGORIES},
+            decorations={name: FeatureColumns.from_dicts(d) for name, d in (data.get("decorations") or {}).items()},
+            bounds=bounds,
+        )
+
+    @classmethod
+    def load(cls, file):
+        return cls.from_json(json.load(file))
+
+    def to_json(self):
+        min_x, max_x, min_y, max_y = self.bounds if self.bounds is not None else (None, None, None, None)
+        return {
+            "min_x": min_x,
+            "max_x": max_x,
+            "min_y": min_y,
+            "max_y": max_y,
+            **{key: getattr(self, key).to_dicts() for key in self.CATEGORIES},
+            "decorations": {name: d.to_dicts() for name, d in self.decorations.items()},
+        }
+
+    def update(self, other):
+        """Merge `other` into these features. Features of the same type in `other` override these ones."""
+        if self.bounds is None:
+            self.bounds = other.bounds
+        for key in self.CATEGORIES:
+            if len(getattr(other, key)):
+                setattr(self, key, getattr(other, key))
+        for name, decorations in other.decorations.items():
+            if len(decorations):
+                self.decorations[name] = decorations
+
+    def items(self):
+        """(key, FeatureColumns) of every feature type, where key is a category or ("decorations", name)."""
+        for key in self.CATEGORIES:
+            yield key, getattr(self, key)
+        for name, decorations in self.decorations.items():
+            yield ("decorations", name), decorations
+
+
+def changed_features(old, new):
+    """
+    Compare two Features by the hashes of their features (see FeatureColumns.hashes()).
+    Returns a dict {key: (removed, added)} with FeatureColumns of the features of `old` that aren't in `new`
+    and vice versa, for every feature type (key as in Features.items()) that changed.
+    A feature that was modified is both removed and added.
+    """
+    old_items, new_items = dict(old.items()), dict(new.items())
+    res = {}
+    for key in list(old_items) + [key for key in new_items if key not in old_items]:
+        old_columns = old_items.get(key, FeatureColumns())
+        new_columns = new_items.get(key, FeatureColumns())
+        old_hashes, new_hashes = old_columns.hashes(), new_columns.hashes()
+        old_set, new_set = set(old_hashes), set(new_hashes)
+        removed = np.array([h not in new_set for h in old_hashes], dtype=bool)
+        added = np.array([h not in old_set for h in new_hashes], dtype=bool)
+        if removed.any() or added.any():
+            res[key] = (old_columns.subset(removed), new_columns.subset(added))
+    return res
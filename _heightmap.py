@@ -0,0 +1,147 @@
+import zlib
+
+import numpy as np
+
+from _util import to_bytes, from_bytes
+
+
+# heightmap.dat versions:
+# legacy (no magic bytes): min_x, min_y, size_x, size_y, followed by one zlib stream of all heights.
+# 1: the heights are stored in blocks of BLOCK_ROWS rows. An index in the header contains the position of every block,
+#    so a part of the heightmap can be read without decompressing everything else.
+#    Blocks are either compressed independently or stored uncompressed (the file can then be memory-mapped).
+# 2: sizes are 32-bit values, and the heights are either 8-bit or 16-bit (little-endian) values (see DTYPES).
+MAGIC = b"W2MH"
+HEIGHTMAP_VERSION = 2
+BLOCK_ROWS = 256
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+
+DTYPE_UINT8 = 0
+DTYPE_UINT16 = 1
+DTYPES = {DTYPE_UINT8: np.dtype(np.uint8), DTYPE_UINT16: np.dtype("<u2")}
+
+
+def write_heightmap(f, a, min_x, min_y, block_rows=BLOCK_ROWS, compress=True):
+    """
+    Write the (size_y, size_x) array `a` of heights (0..65535) to the heightmap.dat file object `f`.
+    The heights are stored as 8-bit values if they are all smaller than 256.
+    """
+    size_y, size_x = a.shape
+    dtype = DTYPE_UINT8 if a.max(initial=0) < 256 else DTYPE_UINT16
+    a = a.astype(DTYPES[dtype])
+    if compress:
+        blocks = [zlib.compress(a[y:y+block_rows].tobytes(), 9) for y in range(0, size_y, block_rows)]
+    else:
+        blocks = [a[y:y+block_rows].tobytes() for y in range(0, size_y, block_rows)]
+    f.write(MAGIC)
+    f.write(to_bytes(HEIGHTMAP_VERSION, 1))
+    f.write(to_bytes(min_x, 4))
+    f.write(to_bytes(min_y, 4))
+    f.write(to_bytes(size_x, 4))
+    f.write(to_bytes(size_y, 4))
+    f.write(to_bytes(block_rows, 2))
+    f.write(to_bytes(COMPRESSION_ZLIB if compress else COMPRESSION_NONE, 1))
+    f.write(to_bytes(dtype, 1))
+    # index: offset (8 bytes) and length (4 bytes) of every block
+    offset = len(MAGIC) + 21 + 12*len(blocks)
+    for block in blocks:
+        f.write(to_bytes(offset, 8))
+        f.write(to_bytes(len(block), 4))
+        offset += len(block)
+    for block in blocks:
+        f.write(block)
+
+
+def read_heightmap_header(f):
+    """Read the header of the heightmap.dat file object `f`."""
+    magic = f.read(len(MAGIC))
+    if magic != MAGIC:
+        # legacy format
+        return {
+            "version": 0,
+            "min_x": from_bytes(magic),
+            "min_y": from_bytes(f.read(4)),
+            "size_x": from_bytes(f.read(2)),
+            "size_y": from_bytes(f.read(2)),
+            "dtype": DTYPES[DTYPE_UINT8],
+        }
+    version = from_bytes(f.read(1))
+    if version > HEIGHTMAP_VERSION:
+        raise ValueError(f"Can't read heightmap.dat; it has newer version {version}")
+    size_length = 2 if version == 1 else 4
+    header = {
+        "version": version,
+        "min_x": from_bytes(f.read(4)),
+        "min_y": from_bytes(f.read(4)),
+        "size_x": from_bytes(f.read(size_length)),
+        "size_y": from_bytes(f.read(size_length)),
+        "block_rows": from_bytes(f.read(2)),
+        "compression": from_bytes(f.read(1)),
+        "dtype": DTYPES[DTYPE_UINT8 if version == 1 else from_bytes(f.read(1))],
+    }
+    block_count = -(-header["size_y"] // header["block_rows"])
+    index = np.frombuffer(f.read(12*block_count), dtype=np.dtype([("offset", "<u8"), ("length", "<u4")]))
+    header["blocks"] = index
+    return header
+
+
+def read_heightmap(f, header, min_x=None, min_y=None, max_x=None, max_y=None):
+    """
+    Read the part of the heightmap that lies within min_x..max_x, min_y..max_y (inclusive).
+    `header` is the result of read_heightmap_header(f); `f` must be seekable.
+    Returns the heights (uint16) and the coordinates of the first value.
+    """
+    # window in array coordinates
+    x1 = 0 if min_x is None else min(max(min_x-header["min_x"], 0), header["size_x"])
+    y1 = 0 if min_y is None else min(max(min_y-header["min_y"], 0), header["size_y"])
+    x2 = header["size_x"] if max_x is None else min(max(max_x-header["min_x"]+1, x1), header["size_x"])
+    y2 = header["size_y"] if max_y is None else min(max(max_y-header["min_y"]+1, y1), header["size_y"])
+    size_x = header["size_x"]
+    dtype = header["dtype"]
+
+    if header["version"] == 0:
+        f.seek(12)
+        a = np.frombuffer(zlib.decompress(f.read()), dtype=np.uint8).reshape((header["size_y"], size_x))
+        return a[y1:y2, x1:x2].astype(np.uint16), header["min_x"]+x1, header["min_y"]+y1
+
+    block_rows = header["block_rows"]
+    blocks = header["blocks"]
+    if header["compression"] == COMPRESSION_NONE:
+        # blocks are stored one after another, so all heights can be mapped at once
+        if len(blocks) == 0:
+            return np.zeros((0, 0), dtype=np.uint16), header["min_x"]+x1, header["min_y"]+y1
+        a = np.memmap(f, dtype=dtype, mode="r", offset=int(blocks[0]["offset"]), shape=(header["size_y"], size_x))
+        return a[y1:y2, x1:x2].astype(np.uint16), header["min_x"]+x1, header["min_y"]+y1
+    elif header["compression"] != COMPRESSION_ZLIB:
+        raise ValueError(f"unknown heightmap compression {header['compression']}")
+
+    a = np.empty((y2-y1, x2-x1), dtype=np.uint16)
+    for block in range(y1 // block_rows, -(-y2 // block_rows)):
+        f.seek(int(blocks[block]["offset"]))
+        rows = np.frombuffer(zlib.decompress(f.read(int(blocks[block]["length"]))), dtype=dtype).reshape((-1, size_x))
+        block_y = block*block_rows
+        r1 = max(y1-block_y, 0)
+        r2 = min(y2-block_y, rows.shape[0])
+        a[block_y+r1-y1:block_y+r2-y1] = rows[r1:r2, x1:x2]
+    return a, header["min_x"]+x1, header["min_y"]+y1
+
+
+def read_heightmap_min(f, header, min_x, min_y, max_x, max_y):
+    """
+    The smallest height within min_x..max_x, min_y..max_y (inclusive), or 0 if the heightmap doesn't cover it.
+    The heights are read one stored block of rows at a time, so the whole area doesn't have to fit into memory
+    and every block is only decompressed once.
+    """
+    # legacy files are a single zlib stream
+    block_rows = header["block_rows"] if header["version"] > 0 else max(header["size_y"], 1)
+    min_height = None
+    # only the rows the heightmap covers; steps start at the first row of a block
+    y1 = max(min_y, header["min_y"])
+    y2 = min(max_y, header["min_y"]+header["size_y"]-1)
+    for y in range(y1 - (y1-header["min_y"]) % block_rows, y2+1, block_rows):
+        heights = read_heightmap(f, header, min_x, max(y, y1), max_x, min(y+block_rows-1, y2))[0]
+        if heights.size:
+            min_height = int(heights.min()) if min_height is None else min(min_height, int(heights.min()))
+    return min_height or 0
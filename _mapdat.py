@@ -0,0 +1,219 @@
+import zlib
+
+import numpy as np
+
+from _util import to_bytes, from_bytes
+
+
+# map.dat versions:
+# 1: one zlib stream of the interleaved (y, x, layer) array.
+# 2: every layer is stored as a separate plane, cut into TILE_SIZE x TILE_SIZE tiles.
+#    Tiles with a constant value are stored as that single value.
+# 3: like 2, but with 32-bit offsets and sizes, 16-bit values and 32-bit incr block positions.
+#    Every layer is stored with 8 bits per value if its values fit (see STORAGE_*).
+#    The header contains the top height (see map_top()), so the mod knows which heights the map covers.
+MAP_VERSION = 3
+TILE_SIZE = 16
+
+# per-layer encodings (version 2 and 3)
+ENCODING_RAW = 0
+ENCODING_DELTA = 1  # every tile row stores its first value, followed by differences (mod 2**bits) to the previous value
+
+# per-layer value storage (version 3)
+STORAGE_16 = 0
+STORAGE_8 = 1  # all values are < 256
+STORAGE_8_FLAG = 2  # all values are < 128 or 0x8000 + (< 128); bit 15 is stored as bit 7
+# layers 2 and 3 of versions 1 and 2 are stored like STORAGE_8_FLAG, all others like STORAGE_8
+LEGACY_FLAG_LAYERS = (2, 3)
+
+# values of layers 2 and 3 >= BUILDING_FLAG are building positions z, stored as BUILDING_BASE + z (see generate_map.py).
+# Layer 3 stores the top of buildings without a roof as z, so building positions can't be higher than BUILDING_MAX_Z.
+BUILDING_FLAG = 0x8000
+BUILDING_BASE = BUILDING_FLAG - 1
+BUILDING_MAX_Z = BUILDING_FLAG - 1
+LAYER_MAX = 0xFFFF
+
+# zlib level of the layers. Level 9 is several times slower on map layers and only makes them a few percent smaller.
+COMPRESSION_LEVEL = 6
+
+
+def _to_tiles(layer, tile_size):
+    # split a 2D array into (tile count, tile_size*tile_size) tiles, row by row.
+    # Edge tiles are padded by repeating the last row/column.
+    size_y, size_x = layer.shape
+    tiles_y = -(-size_y // tile_size)
+    tiles_x = -(-size_x // tile_size)
+    padded = np.pad(layer, ((0, tiles_y*tile_size-size_y), (0, tiles_x*tile_size-size_x)), mode="edge")
+    tiles = padded.reshape(tiles_y, tile_size, tiles_x, tile_size).swapaxes(1, 2)
+    return tiles.reshape(tiles_y*tiles_x, tile_size*tile_size)
+
+
+def _from_tiles(tiles, tile_size, size_y, size_x):
+    tiles_y = -(-size_y // tile_size)
+    tiles_x = -(-size_x // tile_size)
+    layer = tiles.reshape(tiles_y, tiles_x, tile_size, tile_size).swapaxes(1, 2)
+    return layer.reshape(tiles_y*tile_size, tiles_x*tile_size)[:size_y, :size_x]
+
+
+def encode_layer(layer, tile_size=TILE_SIZE, encoding=ENCODING_RAW):
+    """
+    Encode a single layer (2D uint8 or uint16 array) as it is stored in map.dat version 2 and 3 (before compression):
+    tile flags (1 byte per tile, 1 if the tile is uniform), one value for every uniform tile
+    and the full data of every other tile.
+    """
+    layer = layer.astype(layer.dtype.newbyteorder("<"))
+    tiles = _to_tiles(layer, tile_size)
+    uniform = (tiles == tiles[:, :1]).all(axis=1)
+    stored = tiles[~uniform]
+    if encoding == ENCODING_DELTA:
+        rows = stored.reshape(-1, tile_size, tile_size)
+        stored = np.concatenate((rows[:, :, :1], np.diff(rows, axis=2)), axis=2).reshape(-1, tile_size*tile_size)
+    elif encoding != ENCODING_RAW:
+        raise ValueError(f"unknown layer encoding {encoding}")
+    return uniform.astype(np.uint8).tobytes() + tiles[uniform, 0].tobytes() + stored.tobytes()
+
+
+def decode_layer(data, size_y, size_x, tile_size=TILE_SIZE, encoding=ENCODING_RAW, dtype=np.uint8):
+    tile_count = (-(-size_y // tile_size)) * (-(-size_x // tile_size))
+    dtype = np.dtype(dtype).newbyteorder("<")
+    uniform = np.frombuffer(data, dtype=np.uint8, count=tile_count).astype(bool)
+    uniform_count = int(uniform.sum())
+    buf = np.frombuffer(data, dtype=dtype, offset=tile_count)
+    values = buf[:uniform_count]
+    stored = buf[uniform_count:].reshape(-1, tile_size*tile_size)
+    if encoding == ENCODING_DELTA:
+        # add up the differences one tile column at a time; faster than np.cumsum along the short tile rows
+        stored = stored.reshape(-1, tile_size, tile_size).copy()
+        for c in range(1, tile_size):
+            stored[:, :, c] += stored[:, :, c-1]
+        stored = stored.reshape(-1, tile_size*tile_size)
+    elif encoding != ENCODING_RAW:
+        raise ValueError(f"unknown layer encoding {encoding}")
+    tiles = np.empty((tile_count, tile_size*tile_size), dtype=dtype)
+    tiles[uniform] = values[:, None]
+    tiles[~uniform] = stored
+    return _from_tiles(tiles, tile_size, size_y, size_x)
+
+
+def narrow_layer(layer):
+    """Return the smallest storage (STORAGE_*) for a uint16 layer and the layer converted to it."""
+    if layer.max(initial=0) < 256:
+        return STORAGE_8, layer.astype(np.uint8)
+    if not (layer & 0x7F80).any():
+        return STORAGE_8_FLAG, ((layer >> 8) & 0x80 | layer & 0x7F).astype(np.uint8)
+    return STORAGE_16, layer
+
+
+def widen_layer(layer, storage):
+    """Convert a layer stored as `storage` (STORAGE_*) back to uint16."""
+    layer = layer.astype(np.uint16)
+    if storage == STORAGE_8_FLAG:
+        return (layer & 0x80) << 8 | layer & 0x7F
+    return layer
+
+
+def layer_top(layer, index):
+    """The largest y coordinate (relative to the floor) of layer number `index` of the map array (see map_top())."""
+    if index == 0:
+        return int(layer.max(initial=0))
+    if index == 3:
+        building_max = layer.astype(np.int64)
+        building_max[building_max >= BUILDING_FLAG] -= BUILDING_BASE
+        return int(building_max.max(initial=0))
+    return 0
+
+
+def map_top(a):
+    """The largest y coordinate (relative to the floor) of the ground and buildings of the map array `a`."""
+    return max(layer_top(a[:, :, i], i) for i in range(a.shape[2]))
+
+
+def encode_map_layer(layer, index, tile_size=TILE_SIZE):
+    """
+    Encode and compress layer number `index` (2D uint16 array) of the map array as stored in map.dat.
+    Returns the encoding, the storage and the compressed data.
+    """
+    storage, layer = narrow_layer(layer)
+    candidates = [(ENCODING_RAW, zlib.compress(encode_layer(layer, tile_size), COMPRESSION_LEVEL))]
+    if index == 0:
+        # heights mostly change smoothly, so differences usually compress better
+        candidates.append((ENCODING_DELTA, zlib.compress(encode_layer(layer, tile_size, ENCODING_DELTA), COMPRESSION_LEVEL)))
+    encoding, compressed = min(candidates, key=lambda c: len(c[1]))
+    return encoding, storage, compressed
+
+
+def write_encoded_map(f, layers, size_x, size_y, offset_x, offset_z, floor_height, top_height, changed_blocks=b"", tile_size=TILE_SIZE):
+    """
+    Write map.dat to the file object `f` from layers encoded by encode_map_layer(), so the whole map array
+    doesn't have to be in memory. floor_height is the height at the spawnpoint, top_height the result of map_top().
+    """
+    f.write(to_bytes(MAP_VERSION, 1))  # version
+    f.write(to_bytes(3, 1))  # minimum compatible version
+    f.write(to_bytes(len(layers), 1))
+    f.write(to_bytes(floor_height, 2))
+    f.write(to_bytes(min(top_height, LAYER_MAX), 2))
+    f.write(to_bytes(offset_x, 4))
+    f.write(to_bytes(offset_z, 4))
+    f.write(to_bytes(size_x, 4))
+    f.write(to_bytes(size_y, 4))
+    f.write(to_bytes(tile_size, 1))
+    for encoding, storage, compressed in layers:
+        f.write(to_bytes(encoding, 1))
+        f.write(to_bytes(storage, 1))
+        f.write(to_bytes(len(compressed), 4))
+        f.write(compressed)
+    f.write(to_bytes(len(changed_blocks), 4))
+    f.write(changed_blocks)
+
+
+def write_map(f, a, offset_x, offset_z, changed_blocks=b"", tile_size=TILE_SIZE):
+    """
+    Write the (size_y, size_x, layer count) uint16 array `a` to the map.dat file object `f`.
+    `changed_blocks` is the incr data as returned by encode_changed_blocks() (generate_map.py).
+    """
+    layers = [encode_map_layer(a[:, :, i], i, tile_size) for i in range(a.shape[2])]
+    write_encoded_map(f, layers, a.shape[1], a.shape[0], offset_x, offset_z, a[offset_z, offset_x, 0], map_top(a), changed_blocks, tile_size)
+
+
+def read_map(f):
+    """
+    Read a map.dat file (version 1, 2 or 3) from the file object `f`.
+    Returns a dict with the header values, the (size_y, size_x, layer count) uint16 array and the incr data.
+    Layers of older versions are converted to the values of version 3.
+    Like in the file, every layer of the array is stored contiguously, so decoding a layer writes a single block.
+    """
+    version = from_bytes(f.read(1))
+    min_version = from_bytes(f.read(1))
+    if min_version > MAP_VERSION:
+        raise ValueError(f"Can't read map.dat; it has newer version {version}")
+    wide = version >= 3
+    header = {
+        "version": version,
+        "layer_count": from_bytes(f.read(1)),
+        "floor_height": from_bytes(f.read(2 if wide else 1)),
+        "top_height": from_bytes(f.read(2)) if wide else 255,
+        "offset_x": from_bytes(f.read(4 if wide else 2)),
+        "offset_z": from_bytes(f.read(4 if wide else 2)),
+        "size_x": from_bytes(f.read(4 if wide else 2)),
+        "size_y": from_bytes(f.read(4 if wide else 2)),
+    }
+    size_x, size_y, layer_count = header["size_x"], header["size_y"], header["layer_count"]
+    a = np.empty((layer_count, size_y, size_x), dtype=np.uint16).transpose(1, 2, 0)
+    if version == 1:
+        length_a = from_bytes(f.read(4))
+        a[:] = np.frombuffer(zlib.decompress(f.read(length_a)), dtype=np.uint8).reshape((size_y, size_x, layer_count))
+    else:
+        tile_size = from_bytes(f.read(1))
+        for i in range(layer_count):
+            encoding = from_bytes(f.read(1))
+            storage = from_bytes(f.read(1)) if wide else STORAGE_8
+            length = from_bytes(f.read(4))
+            dtype = np.uint16 if storage == STORAGE_16 else np.uint8
+            a[:, :, i] = widen_layer(decode_layer(zlib.decompress(f.read(length)), size_y, size_x, tile_size, encoding, dtype), storage)
+    if not wide:
+        for i in LEGACY_FLAG_LAYERS:
+            if i < layer_count:
+                a[:, :, i] = widen_layer(a[:, :, i], STORAGE_8_FLAG)
+    length_incr = from_bytes(f.read(4))
+    incr = zlib.decompress(f.read(length_incr)) if length_incr else b""
+    return header, a, incr
@@ -2,7 +2,7 @@ import numpy as np
 
 
 def to_bytes(x: int, length: int) -> bytes:
-    x = [None, np.uint8, np.uint16, None, np.uint32][length](x)
+    x = [None, np.uint8, np.uint16, None, np.uint32, None, None, None, np.uint64][length](x)
     # func copied from https://github.com/Gael-de-Sailly/geo-mapgen/blob/4bacbe902e7c0283a24ee3efa35c283ad592e81c/database.py#L34
     res = x.view(x.dtype.newbyteorder("<")).tobytes()
     assert len(res) == length
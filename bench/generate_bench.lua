@@ -0,0 +1,227 @@
+-- Benchmark for init.lua's chunk generation and map.dat loading, using a stubbed Minetest API.
+-- Run from the repository root:
+--     luajit bench/generate_bench.lua [chunk count]
+-- Engine calls (voxel manipulator, schematic placement, decompression) are no-ops, so this measures the time spent
+-- in the mod itself.
+-- Schematic placements are counted like the engine handles them: a path is loaded once and then found by name,
+-- a schematic table is converted and registered as a new schematic every time.
+
+local CHUNK_SIZE = 80
+local MAP_SIZE = 400
+local TILE_SIZE = 16
+local GROUND = 10
+local LOAD_MAP_SIZE = 2000
+local chunk_count = tonumber(arg and arg[1]) or 20
+
+local unpack = unpack or table.unpack
+
+
+-- map.dat (version 3, uncompressed)
+local function int2bytes(n, len)
+    local t = {}
+    for i = 1, len do
+        t[i] = string.char(n % 256)
+        n = math.floor(n / 256)
+    end
+    return table.concat(t)
+end
+
+-- layers are {encoding, storage, data}
+local function uniform_layer(value, tile_count)
+    return {0, 1, string.rep("\1", tile_count) .. string.rep(string.char(value), tile_count)}
+end
+
+local function tree_layer(spacing, tiles_x, tiles_z)
+    local flags = string.rep("\0", tiles_x*tiles_z)
+    local tiles = {}
+    for tz = 0, tiles_z-1 do
+        for tx = 0, tiles_x-1 do
+            local bytes = {}
+            for z = 0, TILE_SIZE-1 do
+                for x = 0, TILE_SIZE-1 do
+                    local wx, wz = tx*TILE_SIZE + x, tz*TILE_SIZE + z
+                    bytes[#bytes+1] = (wx % spacing == 0 and wz % spacing == 0) and "\12" or "\0"
+                end
+            end
+            tiles[#tiles+1] = table.concat(bytes)
+        end
+    end
+    -- raw encoding, 8-bit storage
+    return {0, 1, flags .. table.concat(tiles)}
+end
+
+-- hills between GROUND and GROUND+400 (16-bit storage), every row of a tile delta coded if `delta` is set
+local function hill_layer(delta, tiles_x, tiles_z)
+    local flags = string.rep("\0", tiles_x*tiles_z)
+    local tiles = {}
+    for tz = 0, tiles_z-1 do
+        for tx = 0, tiles_x-1 do
+            local bytes = {}
+            for z = 0, TILE_SIZE-1 do
+                local previous = 0
+                for x = 0, TILE_SIZE-1 do
+                    local wx, wz = tx*TILE_SIZE + x, tz*TILE_SIZE + z
+                    local v = GROUND + math.floor(200 + 200*math.sin(wx/50)*math.cos(wz/70))
+                    local stored = delta and (v - previous) % 65536 or v
+                    previous = v
+                    bytes[#bytes+1] = string.char(stored % 256, math.floor(stored / 256))
+                end
+            end
+            tiles[#tiles+1] = table.concat(bytes)
+        end
+    end
+    return {delta and 1 or 0, 0, flags .. table.concat(tiles)}
+end
+
+local function write_map(path, size, layers)
+    local file = io.open(path, "wb")
+    file:write(int2bytes(3, 1), int2bytes(3, 1), int2bytes(#layers, 1), int2bytes(GROUND, 2), int2bytes(GROUND, 2))
+    file:write(int2bytes(0, 4), int2bytes(0, 4), int2bytes(size, 4), int2bytes(size, 4), int2bytes(TILE_SIZE, 1))
+    for _, layer in ipairs(layers) do
+        local encoding, storage, data = unpack(layer)
+        file:write(int2bytes(encoding, 1), int2bytes(storage, 1), int2bytes(#data, 4), data)
+    end
+    file:write(int2bytes(0, 4))
+    file:close()
+end
+
+-- map with a tree (decoration 12) every `spacing` nodes, or no trees if spacing is nil
+local function write_tree_map(path, spacing)
+    local tiles_x = math.ceil(MAP_SIZE/TILE_SIZE)
+    local tile_count = tiles_x*tiles_x
+    write_map(path, MAP_SIZE, {
+        uniform_layer(GROUND, tile_count),
+        uniform_layer(0, tile_count),
+        spacing and tree_layer(spacing, tiles_x, tiles_x) or uniform_layer(0, tile_count),
+        uniform_layer(0, tile_count),
+    })
+end
+
+
+-- stubbed Minetest API
+local worldpath = os.tmpname()
+os.remove(worldpath)
+os.execute("mkdir -p " .. worldpath .. "/mod_storage")
+
+local on_generated
+local stats = {}
+
+-- schematics registered in the engine's schematic manager, by file name
+local schematics = {}
+local function load_schematic(path)
+    if schematics[path] == nil then
+        stats.read_schematic = stats.read_schematic + 1
+        schematics[path] = path
+    end
+    return schematics[path]
+end
+
+VoxelArea = {}
+VoxelArea.__index = VoxelArea
+function VoxelArea:new(o)
+    o = setmetatable(o, self)
+    o.ystride = o.MaxEdge.x - o.MinEdge.x + 1
+    o.zstride = o.ystride * (o.MaxEdge.y - o.MinEdge.y + 1)
+    return o
+end
+function VoxelArea:index(x, y, z)
+    return (z - self.MinEdge.z)*self.zstride + (y - self.MinEdge.y)*self.ystride + (x - self.MinEdge.x) + 1
+end
+
+local vm = {}
+function vm:get_data(data) return data end
+function vm:set_data() end
+function vm:update_liquids() end
+function vm:calc_lighting() end
+function vm:write_to_map() end
+
+minetest = {
+    set_mapgen_setting = function() end,
+    get_content_id = function(name) return #name end,
+    get_modpath = function(name) return "/mods/" .. name end,
+    get_worldpath = function() return worldpath end,
+    decompress = function(data) return data end,
+    log = function() end,
+    pos_to_string = function(pos) return "(" .. pos.x .. "," .. pos.y .. "," .. pos.z .. ")" end,
+    register_on_generated = function(f) on_generated = f end,
+    register_chatcommand = function() end,
+    get_mapgen_object = function() return vm, stats.emin, stats.emax end,
+    register_schematic = function(path)
+        return load_schematic(path)
+    end,
+    place_schematic_on_vmanip = function(_, _, schematic)
+        stats.placed = stats.placed + 1
+        if type(schematic) == "table" then
+            stats.converted = stats.converted + 1
+        else
+            load_schematic(schematic)
+        end
+    end,
+    set_node = function() end,
+    get_meta = function() return {set_string = function() end} end,
+}
+core = minetest
+
+
+-- load map.dat; returns the time it took
+local function load_map()
+    stats.read_schematic = 0
+    stats.converted = 0
+    stats.placed = 0
+    schematics = {}
+    local start = os.clock()
+    dofile("init.lua")
+    return os.clock() - start
+end
+
+-- generate chunk_count chunks of a map of map_size x map_size nodes; returns the time it took
+local function generate_chunks(map_size)
+    local chunks_per_row = math.floor(map_size/CHUNK_SIZE)
+    local start = os.clock()
+    for i = 0, chunk_count-1 do
+        local cx = (i % chunks_per_row) * CHUNK_SIZE
+        local cz = (math.floor(i / chunks_per_row) % chunks_per_row) * CHUNK_SIZE
+        local minp = {x=cx, y=-32, z=cz}
+        local maxp = {x=cx+CHUNK_SIZE-1, y=47, z=cz+CHUNK_SIZE-1}
+        stats.emin = {x=minp.x-16, y=minp.y-16, z=minp.z-16}
+        stats.emax = {x=maxp.x+16, y=maxp.y+16, z=maxp.z+16}
+        on_generated(minp, maxp, 0)
+    end
+    return os.clock() - start
+end
+
+local function run(name, spacing)
+    write_tree_map(worldpath .. "/mod_storage/map.dat", spacing)
+    load_map()
+    local elapsed = generate_chunks(MAP_SIZE)
+    print(string.format("%-12s %8.2f ms/chunk  (%d schematics placed, %d schematic files read, %d schematic tables converted)",
+        name, elapsed*1000/chunk_count, stats.placed, stats.read_schematic, stats.converted))
+end
+
+-- time to load a LOAD_MAP_SIZE x LOAD_MAP_SIZE map with hills and to generate chunks on it.
+-- Delta coded tiles are decoded when a chunk uses them.
+local function run_load(name, delta)
+    local tiles_x = math.ceil(LOAD_MAP_SIZE/TILE_SIZE)
+    local tile_count = tiles_x*tiles_x
+    write_map(worldpath .. "/mod_storage/map.dat", LOAD_MAP_SIZE, {
+        hill_layer(delta, tiles_x, tiles_x),
+        uniform_layer(0, tile_count),
+        uniform_layer(0, tile_count),
+        uniform_layer(0, tile_count),
+    })
+    local load_time = load_map()
+    local elapsed = generate_chunks(LOAD_MAP_SIZE)
+    print(string.format("%-12s %8.2f ms/chunk  (%.2f ms to load %dx%d nodes)",
+        name, elapsed*1000/chunk_count, load_time*1000, LOAD_MAP_SIZE, LOAD_MAP_SIZE))
+end
+
+print("chunks per run: " .. chunk_count)
+run("bare", nil)
+run("trees/4", 4)
+run("trees/2", 2)
+run_load("hills/raw", false)
+run_load("hills/delta", true)
+
+os.remove(worldpath .. "/mod_storage/map.dat")
+os.remove(worldpath .. "/mod_storage")
+os.remove(worldpath)
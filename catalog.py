@@ -0,0 +1,258 @@
+import argparse
+import hashlib
+import itertools
+import json
+import math
+import os
+
+import numpy as np
+import orjson
+
+
+# catalog file: JSON object {"version": CATALOG_VERSION, "files": {path: entry}}. Every entry contains
+# "format", "size", "mtime" (ns), "sha256" and "bbox" ([min_x, min_y, max_x, max_y], inclusive).
+# Files that couldn't be read have "format" null.
+# Paths are relative to the directory of the catalog file (version 1: relative to the working directory),
+# so the catalog can be used from any directory and moved together with the input files.
+# Scanning reads every new or changed file once for its checksum. GeoTIFF files and CityJSONSeq files with
+# metadata.geographicalExtent in their header are only read up to the header for the extent; the extent of
+# .xyz, .dxf and other CityJSON files is only known after reading all their positions.
+CATALOG_VERSION = 2
+CHUNK_SIZE = 1 << 20
+XYZ_LINES = 1 << 16
+
+FORMATS = {
+    ".xyz": "xyz",
+    ".tif": "geotiff",
+    ".tiff": "geotiff",
+    ".dxf": "dxf",
+    ".jsonl": "cityjsonseq",
+    ".json": "cityjson",
+}
+
+
+def file_format(path):
+    """Format of an input file by its extension (see FORMATS), or None if it isn't supported."""
+    return FORMATS.get(os.path.splitext(path)[1].lower())
+
+
+def file_checksum(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def xyz_extent(path):
+    # the positions aren't sorted, so all lines are read, but only XYZ_LINES at a time;
+    # positions are truncated to integers like in read_xyz()
+    extents = []
+    with open(path, "r", encoding="utf-8") as f:
+        while lines := list(itertools.islice(f, XYZ_LINES)):
+            xy = np.loadtxt(lines, usecols=(0, 1), ndmin=2)
+            if len(xy):
+                extents.append((int(xy[:, 0].min()), int(xy[:, 1].min()), int(xy[:, 0].max()), int(xy[:, 1].max())))
+    return union_extent(extents)
+
+
+def geotiff_extent(path):
+    import tifffile
+    from parse_heightmap_raster import geotiff_georeference, raster_position
+
+    with tifffile.TiffFile(path) as tif:
+        page = tif.pages[0]
+        x, y, scale_x, scale_y = geotiff_georeference(page)
+        height, width = page.shape[:2]
+    # same positions as in read_rasters()
+    min_x, min_y = raster_position(x, y, height)
+    return min_x, min_y, min_x+width-1, min_y+height-1
+
+
+def dxf_extent(path):
+    import ezdxf
+    from ezdxf import bbox
+
+    extents = bbox.extents(ezdxf.readfile(path).modelspace(), fast=True)
+    if not extents.has_data:
+        return None
+    return (
+        math.floor(extents.extmin.x), math.floor(extents.extmin.y),
+        math.ceil(extents.extmax.x), math.ceil(extents.extmax.y),
+    )
+
+
+def vertices_extent(vertices, transform):
+    vertices = np.asarray(vertices, dtype=np.float64).reshape((-1, 3))
+    if not len(vertices):
+        return None
+    scale = transform["scale"]
+    translate = transform["translate"]
+    return (
+        math.floor(vertices[:, 0].min()*scale[0]+translate[0]), math.floor(vertices[:, 1].min()*scale[1]+translate[1]),
+        math.ceil(vertices[:, 0].max()*scale[0]+translate[0]), math.ceil(vertices[:, 1].max()*scale[1]+translate[1]),
+    )
+
+
+def union_extent(extents):
+    extents = [e for e in extents if e is not None]
+    if not extents:
+        return None
+    return min(e[0] for e in extents), min(e[1] for e in extents), max(e[2] for e in extents), max(e[3] for e in extents)
+
+
+def header_extent(header):
+    """The extent of metadata.geographicalExtent of a CityJSON header, or None if it has none."""
+    extent = header.get("metadata", {}).get("geographicalExtent")
+    if extent is None:
+        return None
+    return math.floor(extent[0]), math.floor(extent[1]), math.ceil(extent[3]), math.ceil(extent[4])
+
+
+def cityjson_extent(path):
+    # a CityJSON file is a single JSON object, so it has to be parsed completely (like in parse_cityjson.py)
+    with open(path, "rb") as f:
+        data = orjson.loads(f.read())
+    if data.get("type") != "CityJSON":
+        # e.g. OSM data or features files
+        raise ValueError(f"{path}: not a CityJSON file")
+    return vertices_extent(data.get("vertices", []), data.get("transform", {"scale": [1, 1, 1], "translate": [0, 0, 0]}))
+
+
+def cityjsonseq_extent(path):
+    # only the header if it records the extent, otherwise read one feature at a time, like iter_buildings_cityjsonseq()
+    with open(path, "rb") as f:
+        header = orjson.loads(f.readline())
+        if header.get("type") != "CityJSON":
+            raise ValueError(f"{path}: first line is not a CityJSON header")
+        extent = header_extent(header)
+        if extent is not None:
+            return extent
+        transform = header.get("transform", {"scale": [1, 1, 1], "translate": [0, 0, 0]})
+        return union_extent(vertices_extent(orjson.loads(line).get("vertices", []), transform) for line in f if line.strip())
+
+
+EXTENT_FUNCTIONS = {
+    "xyz": xyz_extent,
+    "geotiff": geotiff_extent,
+    "dxf": dxf_extent,
+    "cityjson": cityjson_extent,
+    "cityjsonseq": cityjsonseq_extent,
+}
+
+
+def catalog_directory(path):
+    """The directory the paths in the catalog file `path` are relative to."""
+    return os.path.dirname(os.path.abspath(path))
+
+
+def load_catalog(path):
+    """Read a catalog file. Returns an empty catalog if it doesn't exist."""
+    if not os.path.exists(path):
+        return {"version": CATALOG_VERSION, "files": {}}
+    with open(path, "rb") as f:
+        catalog = orjson.loads(f.read())
+    if catalog.get("version", 0) > CATALOG_VERSION:
+        raise ValueError(f"Can't read catalog; it has newer version {catalog['version']}")
+    if catalog.get("version", 0) < 2:
+        base = catalog_directory(path)
+        catalog = {
+            "version": CATALOG_VERSION,
+            "files": {os.path.relpath(os.path.abspath(p), base): entry for p, entry in catalog["files"].items()},
+        }
+    return catalog
+
+
+def scan(directories, catalog=None, base=None):
+    """
+    Add all supported files (see FORMATS) within `directories` to the catalog (as returned by load_catalog()).
+    Paths are stored relative to `base`, the directory of the catalog file (see catalog_directory()),
+    which defaults to the working directory.
+    Files whose size and modification time are the same as in the catalog are not read again;
+    entries of files that no longer exist are removed. Returns the new catalog.
+    """
+    base = os.path.abspath(base or ".")
+    old_files = catalog["files"] if catalog is not None else {}
+    files = {path: entry for path, entry in old_files.items() if os.path.exists(os.path.join(base, path))}
+    for directory in directories:
+        for root, _, names in os.walk(directory):
+            for name in sorted(names):
+                abs_path = os.path.abspath(os.path.join(root, name))
+                path = os.path.relpath(abs_path, base)
+                format_ = file_format(path)
+                if format_ is None:
+                    continue
+                stat = os.stat(abs_path)
+                entry = files.get(path)
+                if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+                    continue
+                try:
+                    bbox = EXTENT_FUNCTIONS[format_](abs_path)
+                except ImportError as e:
+                    print(f"Skipping {path}: {e}")
+                    files.pop(path, None)
+                    continue
+                except (ValueError, KeyError) as e:
+                    # recorded without a format, so it isn't read again until it changes
+                    print(f"Ignoring {path}: {e!r}")
+                    format_, bbox = None, None
+                print(path)
+                files[path] = {
+                    "format": format_,
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime_ns,
+                    "sha256": file_checksum(abs_path),
+                    "bbox": list(bbox) if bbox is not None else None,
+                }
+    return {"version": CATALOG_VERSION, "files": dict(sorted(files.items()))}
+
+
+def select_files(catalog, formats, min_x=None, min_y=None, max_x=None, max_y=None, base=None):
+    """
+    Paths of all files of the catalog with one of `formats` that intersect min_x..max_x, min_y..max_y.
+    The paths of the catalog are resolved against `base`, the directory of the catalog file (see scan()).
+    """
+    base = os.path.abspath(base or ".")
+    res = []
+    for path, entry in catalog["files"].items():
+        if entry["format"] not in formats or entry["bbox"] is None:
+            continue
+        bbox = entry["bbox"]
+        if min_x is not None and not (bbox[0] <= max_x and bbox[2] >= min_x and bbox[1] <= max_y and bbox[3] >= min_y):
+            continue
+        res.append(os.path.join(base, path))
+    return res
+
+
+def add_catalog_arguments(parser):
+    """Add --catalog and --bbox to the argparse parser of a parse script."""
+    parser.add_argument("--catalog", type=str, help="Catalog created by catalog.py. Its files (of the formats this script reads) are processed in addition to the given ones.", default=None)
+    parser.add_argument("--bbox", type=int, nargs=4, metavar=("min_x", "min_y", "max_x", "max_y"), help="Only process the --catalog files that intersect this bounding box", default=None)
+
+
+def catalog_files(parser, args, formats):
+    """The files selected by the --catalog and --bbox arguments of `parser` (see add_catalog_arguments())."""
+    if args.catalog is None:
+        if args.bbox is not None:
+            parser.error("--bbox requires --catalog")
+        return []
+    files = select_files(load_catalog(args.catalog), formats, *(args.bbox or (None,)*4), base=catalog_directory(args.catalog))
+    print(f"{len(files)} files from {args.catalog}")
+    return files
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Scan directories with input files and record the extent, format and checksum of every file in a catalog, so the parse scripts can select the files that intersect a bounding box (--catalog, --bbox)")
+    parser.add_argument("directories", metavar="directory", type=str, nargs="+", help="Directories to scan (recursively)")
+    parser.add_argument("--output", "-o", type=str, help="Catalog file; existing entries of unchanged files are kept. Defaults to parsed_data/catalog.json", default="./parsed_data/catalog.json")
+
+    args = parser.parse_args(argv)
+
+    catalog = scan(args.directories, load_catalog(args.output), catalog_directory(args.output))
+    with open(args.output, "w") as f:
+        json.dump(catalog, f, indent=2)
+    print(f"{len(catalog['files'])} files")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,21 @@
 import argparse
-import json
-import random
 import zlib
-import argparse
 
 import numpy as np
-import skimage.draw
-from tqdm import trange
 
-from _util import to_bytes, from_bytes, SURFACES, DECORATIONS
+from _buildings import read_buildings, NONE as BUILDING_NONE
+from _features import Features, changed_features
+from _heightmap import read_heightmap_header, read_heightmap, read_heightmap_min
+from _mapdat import read_map, write_map, BUILDING_FLAG, BUILDING_BASE, BUILDING_MAX_Z, LAYER_MAX
+from _util import SURFACES, DECORATIONS
+
 
+LAYER_COUNT = 4
+# height of the whole map without a heightmap or with --flat
+FLAT_HEIGHT = 50
+
+# areas with these surfaces get the mean height of all their positions
+FLATTENED_SURFACES = ("water", "pitch", "playground", "sports_centre", "parking")
 
 HIGHWAY_WIDTHS = {
     "footway": 3,
@@ -22,6 +28,37 @@ HIGHWAY_WIDTHS = {
     "secondary": 6,
     "rail_track": 1
 }
+# positions (x, y) around every position of a highway's line that are part of the highway, by width.
+# very naive implementation for widths, improvement needed
+HIGHWAY_SHAPES = {
+    1: ((0, 0),),
+    3: (
+                    (0, 1),
+        (-1, 0),    (0, 0),     (1, 0),
+                    (0, -1),
+    ),
+    4: (
+        (-1, 1),    (0, 1),     (1, 1),
+        (-1, 0),    (0, 0),     (1, 0),
+        (-1, -1),   (0, -1),    (1, -1),
+    ),
+    5: (
+                                (0, 2),
+                    (-1, 1),    (0, 1),     (1, 1),
+        (-2, 0),    (-1, 0),    (0, 0),     (1, 0),     (2, 0),
+                    (-1, -1),   (0, -1),    (1, -1),
+                                (0, -2),
+    ),
+    6: (
+                    (-1, 1),    (0, 2),     (1, 2),
+        (-2, 1),    (-1, 1),    (0, 1),     (1, 1),     (2, 1),
+        (-2, 0),    (-1, 0),    (0, 0),     (1, 0),     (2, 0),
+        (-2, -1),   (-1, -1),   (0, -1),    (1, -1),    (2, -1),
+                    (-1, -2),   (0, -2),    (1, 2),
+    ),
+}
+# highways are drawn up to this many positions away from their lines
+HIGHWAY_MARGIN = 2
 
 
 def fit_array(a1, a1_min_x, a1_min_y, a2_min_x, a2_min_y, a2_size_x, a2_size_y):
@@ -35,7 +72,7 @@ def fit_array(a1, a1_min_x, a1_min_y, a2_min_x, a2_min_y, a2_size_x, a2_size_y):
     offset_y = 0
     if a2_min_y < a1_min_y:
         offset_y = a1_min_y-a2_min_y
-    elif min_y > a1_min_y:
+    elif a2_min_y > a1_min_y:
         a1 = a1[(a2_min_y-a1_min_y):, :]
 
     if a1.shape[1]+offset_x > a2_size_x:
@@ -46,390 +83,734 @@ def fit_array(a1, a1_min_x, a1_min_y, a2_min_x, a2_min_y, a2_size_x, a2_size_y):
     return a1, offset_x, offset_y
 
 
-parser = argparse.ArgumentParser(description="Generate a map.dat file that can be read by world2minetest Mod")
-parser.add_argument("--heightmap", type=argparse.FileType("rb"), help="Heightmap file generated by parse_heightmap_xyz.py", default=None)
-parser.add_argument("--features", action="append", type=argparse.FileType("r"), help="features.json files generated by parse_features_osm.py or parse_features_dxf.py. Features of the same type in files specified earlier will be overridden.", default=None)
-parser.add_argument("--buildings", type=argparse.FileType("rb"), help="buildings_cityjson.dat file generated by parse_cityjson.py. If this argument is used, buildings stored in a --features file will be ignored.", default=None)
-parser.add_argument("--buildings-base-height", type=int, help="Subtracted from the height of every building. Defaults to 0.", default=0)
-parser.add_argument("--incr", action="store_true", help="Add incremental map information to map.dat. Load new map data using the '/w2mt:incr' command. Use with caution and make a backup beforehand.")
-parser.add_argument("--offsetx", type=int, help="EPSG:25832 x coordinate that will be x=0 in Minetest", default=None)
-parser.add_argument("--offsetz", type=int, help="EPSG:25832 y coordinate that will be z=0 in Minetest (y is z in Minetest)", default=None)
-parser.add_argument("--minx", type=int, help="Minimum EPSG:25832 x coordinate", default=None)
-parser.add_argument("--maxx", type=int, help="Maximum EPSG:25832 x coordinate", default=None)
-parser.add_argument("--miny", type=int, help="Minimum EPSG:25832 y coordinate (y is z in Minetest)", default=None)
-parser.add_argument("--maxy", type=int, help="Maximum EPSG:25832 y coordinate (y is z in Minetest)", default=None)
-parser.add_argument("--noheightreduction", action="store_true", help="Do not subtract the smallest height from every heightmap value")
-parser.add_argument("--flat", action="store_true", help="If a --heightmap is specified, make the world flat, but subtract the heightmap value from each building coordinate")
-parser.add_argument("--createimg", action="store_true", help="Create a .png visualization of every layer")
-parser.add_argument("--verbose", "-v", action="store_true", help="More debug info")
-parser.add_argument("--output", "-o", type=str, help="Output file. Defaults to world2minetest/map.dat", default="world2minetest/map.dat")
-
-args = parser.parse_args()
-
-min_x = args.minx
-max_x = args.maxx
-min_y = args.miny
-max_y = args.maxy
-
-if (args.heightmap is None or args.flat) and args.features is None:
-    raise argparse.ArgumentTypeError("at least one of --heightmap (without --flat) or --features is required.")
-
-if args.heightmap is not None:
-    heightmap_min_x = from_bytes(args.heightmap.read(4))
-    heightmap_min_y = from_bytes(args.heightmap.read(4))
-    heightmap_size_x = from_bytes(args.heightmap.read(2))
-    heightmap_size_y = from_bytes(args.heightmap.read(2))
-
-    min_x = min_x if min_x is not None else heightmap_min_x
-    max_x = max_x if max_x is not None else (heightmap_min_x+heightmap_size_x-1)
-    min_y = min_y if min_y is not None else heightmap_min_y
-    max_y = max_y if max_y is not None else (heightmap_min_y+heightmap_size_y-1)
-
-    heightmap = np.frombuffer(zlib.decompress(args.heightmap.read()), dtype=np.uint8).reshape((heightmap_size_y, heightmap_size_x))
-    size = (max_x-min_x+1, max_y-min_y+1)
-    heightmap, h_offset_x, h_offset_y = fit_array(heightmap, heightmap_min_x, heightmap_min_y, min_x, min_y, size[0], size[1])
-else:
-    heightmap = None
-
-
-features = {
-    "areas": [],
-    "highways": [],
-    "buildings": [],
-    "decorations": {}
-}
-
-for file in args.features or []:
-    data = json.load(file)
-    min_x = min_x if min_x is not None else data["min_x"]
-    max_x = max_x if max_x is not None else data["max_x"]
-    min_y = min_y if min_y is not None else data["min_y"]
-    max_y = max_y if max_y is not None else data["max_y"]
-    for key in features.keys():
-        if key != "decorations":
-            if key in data and data[key]:
-                features[key] = data[key]
+def draw_lines(x1, y1, x2, y2):
+    # rasterize many line segments at once.
+    # Returns the x and y coordinates of all pixels and the index of the segment each pixel belongs to.
+    x1, y1, x2, y2 = (np.asarray(c, dtype=np.int64) for c in (x1, y1, x2, y2))
+    dx = x2-x1
+    dy = y2-y1
+    n = np.maximum(np.abs(dx), np.abs(dy)) + 1
+    seg = np.repeat(np.arange(len(n)), n)
+    step = np.arange(n.sum()) - np.repeat(np.cumsum(n)-n, n)
+    steps = np.maximum(n-1, 1)[seg]
+    # round half away from the start point; this gives the same pixels as skimage.draw.line
+    xx = x1[seg] + np.sign(dx[seg]) * ((2*step*np.abs(dx[seg]) + steps) // (2*steps))
+    yy = y1[seg] + np.sign(dy[seg]) * ((2*step*np.abs(dy[seg]) + steps) // (2*steps))
+    return xx, yy, seg
+
+
+def fill_polygons(x, y, polygon_ids, shape):
+    # scanline-fill many polygons at once. x, y: integer vertex coordinates of all polygons, concatenated.
+    # polygon_ids: polygon index of every vertex; vertices of a polygon must be contiguous.
+    # Fills the same pixels as skimage.draw.polygon, which tests every pixel center like O'Rourke's InPoly
+    # ("Computational Geometry in C", 7.4): it is filled if an odd number of edges cross its column above it
+    # (counting edges with min x <= column < max x) or below it (counting edges with min x < column <= max x),
+    # or if it is a vertex. Pixels outside of `shape` are skipped, and every pixel is returned once per polygon.
+    # Returns the x and y coordinates of all pixels and the index of the polygon each pixel belongs to.
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    polygon_ids = np.asarray(polygon_ids, dtype=np.int64)
+    if len(x) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    # edges go from every vertex to the next one of the same polygon; the last vertex connects to the first one
+    nxt = np.arange(1, len(x)+1)
+    last = np.flatnonzero(np.append(polygon_ids[1:] != polygon_ids[:-1], True))
+    first = np.append(0, last[:-1]+1)
+    nxt[last] = first
+    x1, y1, x2, y2 = x, y, x[nxt], y[nxt]
+    dx, dy = x2-x1, y2-y1
+    direction = np.where(dx < 0, -1, 1)
+    # (polygon, column, first y, last y) of runs of pixels; vertices are runs of one pixel
+    inside = (0 <= x) & (x < shape[1]) & (0 <= y) & (y < shape[0])
+    runs = [(polygon_ids[inside], x[inside], y[inside], y[inside])]
+    for below in (0, 1):
+        col_lo = np.clip(np.minimum(x1, x2)+below, 0, shape[1])
+        col_hi = np.clip(np.maximum(x1, x2)+below, 0, shape[1])
+        count = col_hi - col_lo
+        edge = np.repeat(np.arange(len(x)), count)
+        col = np.arange(count.sum()) - np.repeat(np.cumsum(count)-count, count) + col_lo[edge]
+        # the edge crosses the column at y = num / den (exactly)
+        num = (y1[edge]*dx[edge] + (col-x1[edge])*dy[edge]) * direction[edge]
+        den = np.abs(dx[edge])
+        poly = polygon_ids[edge]
+        order = np.lexsort((num/den, poly*shape[1] + col))
+        # every (polygon, column) has an even number of crossings; fill between pairs of them
+        lower, upper = order[0::2], order[1::2]
+        if below:
+            # lower < y <= upper
+            start, end = num[lower]//den[lower] + 1, num[upper]//den[upper]
         else:
-            if "decorations" in data and data["decorations"]:
-                for key, value in data["decorations"].items():
-                    if value:
-                        features["decorations"][key] = value
-
-
-size = (max_x-min_x+1, max_y-min_y+1)
-
-print(f"from {min_x},{min_y} to {max_x},{max_y} (size: {size[0]},{size[1]})")
-if min_x > max_x or min_y > max_y:
-    raise ValueError("map size is invalid")
+            # lower <= y < upper
+            start, end = -(-num[lower]//den[lower]), -(-num[upper]//den[upper]) - 1
+        runs.append((poly[lower], col[lower], np.maximum(start, 0), np.minimum(end, shape[0]-1)))
+    poly, col, start, end = (np.concatenate(c) for c in zip(*runs))
+    keep = start <= end
+    poly, col, start, end = poly[keep], col[keep], start[keep], end[keep]
+    # runs of both directions mostly overlap: skip the pixels of earlier runs (by start) of the same column
+    order = np.argsort((poly*shape[1] + col)*shape[0] + start, kind="stable")
+    poly, col, start, end = poly[order], col[order], start[order], end[order]
+    new_column = np.ones(len(poly), dtype=bool)
+    new_column[1:] = (poly[1:] != poly[:-1]) | (col[1:] != col[:-1])
+    column_base = np.cumsum(new_column) * (shape[0]+1)
+    covered = np.maximum.accumulate(end + column_base) - column_base
+    start[~new_column] = np.maximum(start[~new_column], covered[:-1][~new_column[1:]] + 1)
+    length = np.maximum(end-start+1, 0)
+    run = np.repeat(np.arange(len(length)), length)
+    yy = np.arange(length.sum()) - np.repeat(np.cumsum(length)-length, length) + start[run]
+    return col[run], yy, poly[run]
+
+
+def load_features(files):
+    """
+    Read features .json files (paths or file objects) generated by parse_features_osm.py or parse_features_dxf.py.
+    Features of the same type in files specified earlier are overridden.
+    """
+    features = Features()
+    for file in files:
+        if isinstance(file, str):
+            with open(file) as f:
+                features.update(Features.load(f))
+        else:
+            features.update(Features.load(file))
+    return features
+
+
+def map_bounds(min_x=None, min_y=None, max_x=None, max_y=None, heightmap_header=None, features=None):
+    """
+    Return (min_x, min_y, max_x, max_y) of the map. Missing values are taken from the heightmap header
+    (see read_heightmap_header()), or else from the bounds of the features.
+    """
+    if heightmap_header is not None:
+        min_x = min_x if min_x is not None else heightmap_header["min_x"]
+        max_x = max_x if max_x is not None else (heightmap_header["min_x"]+heightmap_header["size_x"]-1)
+        min_y = min_y if min_y is not None else heightmap_header["min_y"]
+        max_y = max_y if max_y is not None else (heightmap_header["min_y"]+heightmap_header["size_y"]-1)
+    if features is not None and features.bounds is not None:
+        min_x = min_x if min_x is not None else features.bounds[0]
+        max_x = max_x if max_x is not None else features.bounds[1]
+        min_y = min_y if min_y is not None else features.bounds[2]
+        max_y = max_y if max_y is not None else features.bounds[3]
+    return min_x, min_y, max_x, max_y
+
+
+def coordinate_random(x, y):
+    # deterministic pseudo-random numbers in [0, 1) for world coordinates.
+    # They don't depend on which part of the map is generated, so every region gets the same values as a full run.
+    h = np.asarray(x, dtype=np.int64).astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    h ^= np.asarray(y, dtype=np.int64).astype(np.uint64) * np.uint64(0xC2B2AE3D27D4EB4F)
+    h ^= h >> np.uint64(31)
+    h *= np.uint64(0xBF58476D1CE4E5B9)
+    h ^= h >> np.uint64(29)
+    return (h >> np.uint64(11)).astype(np.float64) / 2.0**53
+
+
+def rasterize_heightmap(a, heightmap, min_x, min_y, flat=False, heightmap_sub=0):
+    """
+    Write the heights to layer 0. `heightmap` is (heights, min_x, min_y) as returned by read_heightmap(), or None.
+    Without a heightmap or if `flat` is set, the whole map gets FLAT_HEIGHT.
+    Returns the heights fitted into the map and their offset (or None).
+    """
+    fitted = None
+    if heightmap is not None:
+        heights, heightmap_min_x, heightmap_min_y = heightmap
+        fitted = fit_array(heights, heightmap_min_x, heightmap_min_y, min_x, min_y, a.shape[1], a.shape[0])
+    if fitted is not None and not flat:
+        heights, h_offset_x, h_offset_y = fitted
+        a[h_offset_y:h_offset_y+heights.shape[0]+1, h_offset_x:h_offset_x+heights.shape[1]+1, 0] = heights - heightmap_sub
+    else:
+        a[:, :, 0] = FLAT_HEIGHT  # everywhere the same height
+    return fitted
 
-if not (min_x <= args.offsetx <= max_x and min_y <= args.offsetz <= max_y):
-    raise ValueError(f"offset {(args.offsetx, args.offsetz)} is located outside of map")
 
+def rasterize_areas(a, areas, min_x, min_y, verbose=False):
+    import skimage.draw
 
-LAYER_COUNT = 4
-a = np.zeros((size[1], size[0], LAYER_COUNT), dtype=np.uint8)
-# bytes (one for every layer):
-# byte 0: y0: heightmap; floor goes up to this block.
-# byte 1: surface type (block to place at y=y0; below is always stone)
-# byte 2: y1: If y1<128, this is a decoration id (block to place at y=y0+1, and sometimes above (e.g. for trees)).
-#             Otherwise, y1-127 is the minimum y coordinate of a building. If the building is standing on the ground: y1=y0+127+1.
-# byte 3: y2: maximum y coordinate of a building. If y2>=128, the topmost block (at y=y2) is part of a roof and the maximum y coordinate is y2-127.
-
-
-# HEIGHTMAP
-if heightmap is not None and not args.flat:
-    if not args.noheightreduction:
-        heightmap_sub = heightmap.min()
-    else:
-        heightmap_sub = 0
-    a[h_offset_y:h_offset_y+heightmap.shape[0]+1, h_offset_x:h_offset_x+heightmap.shape[1]+1, 0] = heightmap - heightmap_sub
-else:
-    heightmap_sub = 0
-    FLAT_HEIGHT = 50
-    a[:, :, 0] = FLAT_HEIGHT  # everywhere the same height
-
-
-# FEATURES
-def shift_coords(x_coords, y_coords):
-    if type(x_coords) is list:
-        x_res = []
-        y_res = []
-        for x, y in zip(x_coords, y_coords):
-            if min_x <= x <= max_x and min_y <= y <= max_y:
-                x = x-min_x
-                y = y-min_y
-                x_res.append(x)
-                y_res.append(y)
-        return x_res, y_res
-    x, y = x_coords, y_coords
-    if min_x <= x <= max_x and min_y <= y <= max_y:
-        return x-min_x, y-min_y
-    return None, None
-
-for area in features["areas"]:
-    x, y = shift_coords(area["x"], area["y"])
-    if len(x) < 3:
-        if args.verbose: print("Too few coordinates, ignoring area:", x, y, area)
-        continue
-    surface = area["surface"]
-    xx, yy = skimage.draw.polygon(x, y)
-    a[yy, xx, 1] = SURFACES[surface]
-    if surface in ("water", "pitch", "playground", "sports_centre", "parking"):
-        assert 0 <= int(round(a[yy, xx, 0].mean())) <= 255
-        a[yy, xx, 0] = int(round(a[yy, xx, 0].mean()))  # flatten area
-    if surface in ("park", "village_green"):
-        # add a bit of random grass
-        random.seed(0)
-        for x, y in zip(xx, yy):
-            if random.random() < 0.025:
-                a[y, x, 2] = DECORATIONS["grass"]
-    else:
-        a[yy, xx, 2] = 0  # if areas overlap, this removes any previously generated grass
-
-
-if args.buildings:
-    print("Reading buildings file")
-    count_points_in_area = 0
-    count_points_out_of_area = 0
-    buildings_file = args.buildings
-    buildings_count = from_bytes(buildings_file.read(4))
-    assert from_bytes(buildings_file.read(1)) == 0
-    for _ in trange(buildings_count):
-        new_building = {}
-        surface_name_len_bytes = buildings_file.read(1)
-        while (surface_name_len := from_bytes(surface_name_len_bytes)) != 0:
-            surface_name = buildings_file.read(surface_name_len).decode("utf-8")
-            roof_summand = 127 if surface_name == "roof" else 0
-            is_ground = surface_name == "ground"
-            pos_count = from_bytes(buildings_file.read(4))
-            for _ in range(pos_count):
-                x = from_bytes(buildings_file.read(4))
-                y = from_bytes(buildings_file.read(4))
-                z = from_bytes(buildings_file.read(4))
-                if min_x <= x <= max_x and min_y <= y <= max_y:
-                    count_points_in_area += 1
-                    x = x-min_x
-                    y = y-min_y
-                    z -= heightmap_sub
-                    z -= args.buildings_base_height
-                    if args.flat:
-                        if h_offset_x <= x < h_offset_x+heightmap.shape[1] and h_offset_y <= y < h_offset_y+heightmap.shape[0]:
-                            z -= heightmap[y-h_offset_y, x-h_offset_x]
-                        z += FLAT_HEIGHT
-                    if is_ground:
-                        if not args.flat:
-                            assert 0 <= z <= 255
-                            a[y, x, 0] = z
-                        a[y, x, 1] = SURFACES["building_ground"]
-                    else:
-                        if z > 0:
-                            if a[y, x, 2] >= 128:
-                                a[y, x, 2] = min(a[y, x, 2], 127 + z)
-                            else:
-                                a[y, x, 2] = 127 + z
-                            a[y, x, 3] = max(a[y, x, 3], roof_summand + z)
-                else:
-                    count_points_out_of_area += 1
-            surface_name_len_bytes = buildings_file.read(1)
-    if count_points_out_of_area > 0:
-        print(f"Warning: {count_points_out_of_area}/{count_points_in_area+count_points_out_of_area} building points were outside the area and skipped")
-else:
-    for building in features["buildings"]:
-        x_coords, y_coords = shift_coords(building["x"], building["y"])
-        if len(x_coords) < 2:
-            if args.verbose: print("Too few coordinates, ignoring building:", x_coords, y_coords, building)
+    for area in areas.iter_dicts():
+        if len(area["x"]) < 3:
+            if verbose: print("Too few coordinates, ignoring area:", area)
             continue
-        elif len(x_coords) == 2:
-            xx, yy = skimage.draw.line(x_coords[0], y_coords[0], x_coords[1], y_coords[1])
+        surface = area["surface"]
+        # pixels outside of the map are clipped (not the vertices), so every region of an area is drawn the same way
+        xx, yy = skimage.draw.polygon(np.subtract(area["x"], min_x), np.subtract(area["y"], min_y), (a.shape[1], a.shape[0]))
+        a[yy, xx, 1] = SURFACES[surface]
+        if surface in FLATTENED_SURFACES and len(xx):
+            a[yy, xx, 0] = int(round(a[yy, xx, 0].mean()))  # flatten area
+        if surface in ("park", "village_green"):
+            # add a bit of random grass
+            grass = coordinate_random(xx+min_x, yy+min_y) < 0.025
+            a[yy[grass], xx[grass], 2] = DECORATIONS["grass"]
         else:
-            xx, yy = skimage.draw.polygon_perimeter(x_coords, y_coords)
-            xxx, yyy = skimage.draw.polygon(x_coords, y_coords)
-            
-        height = building.get("height")
-        if height is None:
-            height = building.get("levels")
-            if height is not None:
-                height *= 3
-            else:
-                # default to a building with 2 levels
-                height = 6
-        ground_z = int(round(a[yy, xx, 0].mean()))
-        assert 0 <= ground_z <= 255
-                
-        a[yy, xx, 0] = ground_z
-        if ground_z >= 128:
-            a[yyy, xxx, 2] = min(ground_z, ground_z + 127)
-        else:
-            a[yyy, xxx, 2] = np.minimum(255, 127 + ground_z + 1)
-        if height is not None and building.get("is_part"):
-            # only overwrite height if it is likely from the same building
-            if height >= 1:
-                a[yyy, xxx, 3] = np.minimum(255,ground_z + height + 127)
-
-        else:
-            a[yyy, xxx, 3] = np.maximum(a[yyy, xxx, 3], np.minimum(255,ground_z + (height or 1) + 127))
-
-for highway in features["highways"]:
-    x_coords, y_coords = shift_coords(highway["x"], highway["y"])
-    surface = highway["surface"]
-    surface_id = SURFACES[surface]
-    layer = highway.get("layer", 0)
-    width = HIGHWAY_WIDTHS.get(highway["type"], 3)
-    height = -layer*3 if layer < 0 else 0
-    for i in range(0, len(x_coords)-1):
-        x1, y1 = x_coords[i], y_coords[i]
-        x2, y2 = x_coords[i+1], y_coords[i+1]
-        xx, yy = skimage.draw.line(x1, y1, x2, y2)
-        if width != 1:
-            # very naive implementation for widths, improvement needed
-            positions = set()
-            if width == 3:
-                for x, y in zip(xx, yy):
-                    positions.update((
-                                    (x, y+1),
-                        (x-1, y),   (x, y  ),   (x+1, y),
-                                    (x, y-1)
-                    ))
-            elif width == 4:
-                for x, y in zip(xx, yy):
-                    positions.update((
-                        (x-1, y+1), (x  , y+1), (x+1, y+1),
-                        (x-1, y  ), (x  , y  ), (x+1, y  ),
-                        (x-1, y-1), (x  , y-1), (x+1, y-1)
-                    ))
-            elif width == 5:
-                for x, y in zip(xx, yy):
-                    positions.update((
-                                                (x  , y+2),
-                                    (x-1, y+1), (x  , y+1), (x+1, y+1),
-                        (x-2, y  ), (x-1, y  ), (x  , y  ), (x+1, y  ), (x+2, y),
-                                    (x-1, y-1), (x  , y-1), (x+1, y-1),
-                                                (x  , y-2)
-                    ))
-            elif width == 6:
-                for x, y in zip(xx, yy):
-                    positions.update((
-                                    (x-1, y+1), (x  , y+2), (x+1, y+2),
-                        (x-2, y+1), (x-1, y+1), (x  , y+1), (x+1, y+1), (x+2, y+1),
-                        (x-2, y  ), (x-1, y  ), (x  , y  ), (x+1, y  ), (x+2, y  ),
-                        (x-2, y-1), (x-1, y-1), (x  , y-1), (x+1, y-1), (x+2, y-1),
-                                    (x-1, y-2), (x  , y-2), (x+1, y+2),
-                    ))
-            xx = []
-            yy = []
-            for x, y in positions:
-                if 0 <= x < size[0] and 0 <= y < size[1]:
-                    xx.append(x)
-                    yy.append(y)
-        if height != 0:
-            if a[yy, xx, 0].mean() - height > 0 and a[yy, xx, 0].mean() - height < 255:
-                a[yy, xx, 0] = a[yy, xx, 0].mean() - height  
-            elif a[yy, xx, 0].mean() - height <= 0 and a[yy, xx, 0].mean() - height < 255:
-                a[yy, xx, 0] = 0
-            elif a[yy, xx, 0].mean() - height > 255:
-                a[yy, xx, 0] = 255
-        a[yy, xx, 1] = surface_id
-        if layer >= 0:
-            # remove anything above the surface (buildings, randomly added grass)
-            a[yy, xx, 2] = 0
-            a[yy, xx, 3] = 0
-
-for deco, decorations in features["decorations"].items():
-    id_ = DECORATIONS[deco]
-    for decoration in decorations:
-        x, y = shift_coords(decoration["x"], decoration["y"])
-        if not x: # test if x is either None or []
-            if args.verbose: print("Out of bounds, ignoring decoration:", x, y, decoration)
-            continue
-        if type(x) is list:
-            for i in range(0, len(x)-1):
-                x1, y1 = x[i], y[i]
-                x2, y2 = x[i+1], y[i+1]
-                xx, yy = skimage.draw.line(x1, y1, x2, y2)
-                a[yy, xx, 2] = id_
-        else:
-            a[y, x, 2] = id_
+            a[yy, xx, 2] = 0  # if areas overlap, this removes any previously generated grass
+
+
+def clip_building_z(z, what):
+    """Limit building positions `z` to BUILDING_MAX_Z, the highest one map.dat can store, with a warning."""
+    too_high = z > BUILDING_MAX_Z
+    if too_high.any():
+        print(f"Warning: {np.count_nonzero(too_high)} {what} reach above y={BUILDING_MAX_Z} and were cut off")
+    return np.minimum(z, BUILDING_MAX_Z)
+
+
+def reduce_at_positions(ufunc, x, y, size_x, values, initial):
+    """
+    Reduce `values` at the positions (x, y) of a map with `size_x` columns with `ufunc` (e.g. np.minimum), starting
+    at `initial`. Returns the unique positions and their results, so no array of the size of the map is needed.
+    """
+    positions, inverse = np.unique(y*size_x + x, return_inverse=True)
+    reduced = np.full(len(positions), initial, dtype=np.int64)
+    ufunc.at(reduced, inverse.reshape(-1), values)
+    return positions % size_x, positions // size_x, reduced
+
+
+def rasterize_building_spans(a, spans, min_x, min_y, heightmap_sub=0, buildings_base_height=0, flat=False, fitted_heightmap=None):
+    """
+    Write buildings given as spans (see _buildings.py) to the map.
+    If `flat` is set, the heightmap value of every column (`fitted_heightmap` as returned by rasterize_heightmap())
+    is subtracted from its building coordinates.
+    """
+    size = (a.shape[1], a.shape[0])
+    max_x, max_y = min_x+size[0]-1, min_y+size[1]-1
+    in_area = (min_x <= spans["x"]) & (spans["x"] <= max_x) & (min_y <= spans["y"]) & (spans["y"] <= max_y)
+    if not in_area.all():
+        print(f"Warning: {np.count_nonzero(~in_area)}/{len(spans)} building columns were outside the area and skipped")
+    spans = spans[in_area]
+    x = spans["x"].astype(np.int64) - min_x
+    y = spans["y"].astype(np.int64) - min_y
+    # subtracted from every z coordinate
+    z_sub = np.full(len(spans), heightmap_sub + buildings_base_height, dtype=np.int64)
+    if flat:
+        if fitted_heightmap is not None:
+            heights, h_offset_x, h_offset_y = fitted_heightmap
+            on_heightmap = (h_offset_x <= x) & (x < h_offset_x+heights.shape[1]) & (h_offset_y <= y) & (y < h_offset_y+heights.shape[0])
+            z_sub[on_heightmap] += heights[y[on_heightmap]-h_offset_y, x[on_heightmap]-h_offset_x]
+        z_sub -= FLAT_HEIGHT
+
+    has_ground = spans["ground"] != BUILDING_NONE
+    gx, gy = x[has_ground], y[has_ground]
+    if not flat:
+        ux, uy, ground_z = reduce_at_positions(np.maximum, gx, gy, size[0], spans["ground"][has_ground] - z_sub[has_ground], -1)
+        assert 0 <= ground_z.min(initial=0) and ground_z.max(initial=0) <= LAYER_MAX
+        a[uy, ux, 0] = ground_z
+    a[gy, gx, 1] = SURFACES["building_ground"]
+
+    # only building positions above z=0 are used
+    zmin = np.maximum(spans["zmin"] - z_sub, 1)
+    zmax = spans["zmax"] - z_sub
+    has_building = (spans["zmin"] != BUILDING_NONE) & (zmax > 0)
+    bx, by = x[has_building], y[has_building]
+    zmin = np.minimum(zmin[has_building], BUILDING_MAX_Z)
+    zmax = clip_building_z(zmax[has_building], "building columns")
+    # y1: lowest building position of all buildings in a column
+    ux, uy, building_min = reduce_at_positions(np.minimum, bx, by, size[0], BUILDING_BASE + zmin, LAYER_MAX)
+    layer_2 = a[uy, ux, 2]
+    a[uy, ux, 2] = np.where(layer_2 >= BUILDING_FLAG, np.minimum(layer_2, building_min), building_min)
+    # y2: highest building position; roofs win over walls
+    ux, uy, building_max = reduce_at_positions(np.maximum, bx, by, size[0], BUILDING_BASE*spans["roof"][has_building].astype(np.int64) + zmax, 0)
+    a[uy, ux, 3] = np.maximum(a[uy, ux, 3], building_max)
+
+
+def rasterize_buildings(a, buildings, min_x, min_y, verbose=False):
+    """Write buildings given as footprints (FeatureColumns with optional height, levels and is_part) to the map."""
+    size = (a.shape[1], a.shape[0])
+    too_few = buildings.counts < 2
+    if verbose:
+        for building in buildings.subset(too_few).iter_dicts():
+            print("Too few coordinates, ignoring building:", building)
+    buildings = buildings.subset(~too_few)
+
+    # rasterize all footprints at once
+    vertex_x = buildings.x - min_x
+    vertex_y = buildings.y - min_y
+    vertex_building = buildings.vertex_feature()
+    vertex_counts = buildings.counts
+    # outlines like skimage.draw.polygon_perimeter: a last vertex equal to the first one is dropped, every vertex
+    # is connected to the next one and the last one to the first one; buildings with two nodes are a single line.
+    # Segments share their end points, so these pixels count twice for the ground height, as before.
+    first = np.cumsum(vertex_counts)-vertex_counts
+    last = np.cumsum(vertex_counts)-1
+    closed = (vertex_counts > 2) & (vertex_x[first] == vertex_x[last]) & (vertex_y[first] == vertex_y[last])
+    keep = np.ones(len(vertex_x), dtype=bool)
+    keep[last[closed]] = False
+    kept = np.flatnonzero(keep)
+    kept_counts = vertex_counts - closed
+    nxt = np.arange(1, len(kept)+1)
+    nxt[np.cumsum(kept_counts)-1] = np.cumsum(kept_counts)-kept_counts
+    segment = np.ones(len(kept), dtype=bool)
+    segment[(np.cumsum(kept_counts)-1)[kept_counts == 2]] = False
+    start, end = kept[segment], kept[nxt][segment]
+    outline_x, outline_y, outline_seg = draw_lines(vertex_x[start], vertex_y[start], vertex_x[end], vertex_y[end])
+    outline_building = vertex_building[start][outline_seg]
+    inside = (0 <= outline_x) & (outline_x < size[0]) & (0 <= outline_y) & (outline_y < size[1])
+    outline_x, outline_y, outline_building = outline_x[inside], outline_y[inside], outline_building[inside]
+    fill_x, fill_y, fill_building = fill_polygons(vertex_x, vertex_y, vertex_building, (size[1], size[0]))
+    # buildings with only two nodes are drawn as a line
+    line = vertex_counts[outline_building] == 2
+    footprint_x = np.concatenate((fill_x, outline_x[line]))
+    footprint_y = np.concatenate((fill_y, outline_y[line]))
+    footprint_building = np.concatenate((fill_building, outline_building[line]))
+
+    heights = np.array([
+        height if height is not None
+        else levels*3 if levels is not None
+        else 6  # default to a building with 2 levels
+        for height, levels in zip(buildings.attributes.get("height", [None]*len(buildings)), buildings.attributes.get("levels", [None]*len(buildings)))
+    ], dtype=np.int64)
+    is_part = buildings.attribute("is_part", False, bool)
+
+    # ground height of every building: mean height below its outline
+    # (or below its footprint, if the outline is outside of the map)
+    outline_count = np.bincount(outline_building, minlength=len(buildings))
+    outline_sum = np.bincount(outline_building, weights=a[outline_y, outline_x, 0], minlength=len(buildings))
+    fill_count = np.bincount(fill_building, minlength=len(buildings))
+    fill_sum = np.bincount(fill_building, weights=a[fill_y, fill_x, 0], minlength=len(buildings))
+    ground_z = np.where(outline_count > 0, outline_sum / np.maximum(outline_count, 1), fill_sum / np.maximum(fill_count, 1))
+    ground_z = np.rint(ground_z).astype(np.int64)
+    assert ((0 <= ground_z) & (ground_z <= LAYER_MAX)).all()
+
+    # lookup tables by building index
+    lut_2 = BUILDING_BASE + np.minimum(ground_z + 1, BUILDING_MAX_Z)
+    lut_3 = BUILDING_BASE + clip_building_z(ground_z + np.where(is_part, heights, np.maximum(heights, 1)), "buildings")
+
+    def label_positions(x, y, building, rank):
+        # label every pixel with the building of highest rank covering it; pixels without a building (rank 0) are skipped.
+        # Only the covered pixels are kept, so no arrays of the size of the map are needed.
+        ux, uy, labels = reduce_at_positions(np.maximum, x, y, size[0], rank[building], 0)
+        labelled = labels > 0
+        return ux[labelled], uy[labelled], labels[labelled]
+
+    index = np.arange(1, len(buildings)+1, dtype=np.int64)
+    # the outline's ground height: later buildings win
+    ux, uy, labels = label_positions(outline_x, outline_y, outline_building, index)
+    a[uy, ux, 0] = ground_z[labels-1]
+
+    # buildings: where footprints overlap, the taller building wins
+    order = np.lexsort((index, np.where(is_part, -1, lut_3)))
+    rank = np.zeros(len(buildings), dtype=np.int64)
+    rank[order] = np.arange(1, len(buildings)+1)
+    rank[is_part] = 0
+    ux, uy, labels = label_positions(footprint_x, footprint_y, footprint_building, rank)
+    building_at = order[labels-1]
+    a[uy, ux, 2] = lut_2[building_at]
+    a[uy, ux, 3] = np.maximum(a[uy, ux, 3], lut_3[building_at])
+
+    # building parts override the building they belong to; later parts win
+    ux, uy, labels = label_positions(footprint_x, footprint_y, footprint_building, np.where(is_part, index, 0))
+    building_at = labels-1
+    a[uy, ux, 2] = lut_2[building_at]
+    # only overwrite height if it is likely from the same building
+    overwrite = heights[building_at] >= 1
+    a[uy[overwrite], ux[overwrite], 3] = lut_3[building_at[overwrite]]
+
+
+def rasterize_highways(a, highways, min_x, min_y):
+    import skimage.draw
+
+    size = (a.shape[1], a.shape[0])
+    for highway in highways.iter_dicts():
+        # lines are drawn completely and clipped to the map afterwards
+        x_coords = [x-min_x for x in highway["x"]]
+        y_coords = [y-min_y for y in highway["y"]]
+        surface = highway["surface"]
+        surface_id = SURFACES[surface]
+        layer = highway.get("layer", 0)
+        width = HIGHWAY_WIDTHS.get(highway["type"], 3)
+        height = -layer*3 if layer < 0 else 0
+        shape = np.array(HIGHWAY_SHAPES.get(width, ()), dtype=np.int64).reshape(-1, 2)
+        for i in range(0, len(x_coords)-1):
+            x1, y1 = x_coords[i], y_coords[i]
+            x2, y2 = x_coords[i+1], y_coords[i+1]
+            xx, yy = skimage.draw.line(x1, y1, x2, y2)
+            # line positions further away from the map can't reach it
+            near = (-HIGHWAY_MARGIN <= xx) & (xx < size[0]+HIGHWAY_MARGIN) & (-HIGHWAY_MARGIN <= yy) & (yy < size[1]+HIGHWAY_MARGIN)
+            xx = (xx[near, None] + shape[:, 0]).ravel()
+            yy = (yy[near, None] + shape[:, 1]).ravel()
+            inside = (0 <= xx) & (xx < size[0]) & (0 <= yy) & (yy < size[1])
+            # every position only once
+            yy, xx = np.divmod(np.unique(yy[inside]*size[0] + xx[inside]), size[0])
+            if len(xx) == 0:
+                continue
+            if height != 0:
+                if a[yy, xx, 0].mean() - height > 0 and a[yy, xx, 0].mean() - height < LAYER_MAX:
+                    a[yy, xx, 0] = a[yy, xx, 0].mean() - height
+                elif a[yy, xx, 0].mean() - height <= 0 and a[yy, xx, 0].mean() - height < LAYER_MAX:
+                    a[yy, xx, 0] = 0
+                elif a[yy, xx, 0].mean() - height > LAYER_MAX:
+                    a[yy, xx, 0] = LAYER_MAX
+            a[yy, xx, 1] = surface_id
+            if layer >= 0:
+                # remove anything above the surface (buildings, randomly added grass)
+                a[yy, xx, 2] = 0
+                a[yy, xx, 3] = 0
+
+
+def rasterize_decorations(a, decorations, min_x, min_y, verbose=False):
+    size = (a.shape[1], a.shape[0])
+    for deco, columns in decorations.items():
+        id_ = DECORATIONS[deco]
+        # point decorations (trees, benches, ...)
+        points = columns.subset(columns.is_point)
+        x = points.x - min_x
+        y = points.y - min_y
+        inside = (0 <= x) & (x < size[0]) & (0 <= y) & (y < size[1])
+        if verbose and not inside.all():
+            print(f"Out of bounds, ignoring {np.count_nonzero(~inside)} {deco} decorations")
+        x, y = x[inside], y[inside]
+        a[y, x, 2] = id_
         if deco in ("tree", "leaf_tree", "conifer", "bush"):
             # place dirt below tree
             a[y, x, 1] = SURFACES["dirt"]
 
-
-offset_x = args.offsetx-min_x if args.offsetx is not None else 0
-offset_z = args.offsetz-min_y if args.offsetz is not None else 0
-out = args.output
-
-print("offset x:", offset_x, "offset z:", offset_z)
-
-if args.incr:
-    with open(out, "rb") as f:
-        version = from_bytes(f.read(1))
-        min_version = from_bytes(f.read(1))
-        if min_version > 1:
-            raise ValueError(f"Can't add incremental map info; map.dat has newer version {version}")
-        old_layer_count = from_bytes(f.read(1))
-        old_floor_height = from_bytes(f.read(1))
-        old_offset_x = from_bytes(f.read(2))
-        old_offset_z = from_bytes(f.read(2))
-        old_size_x = from_bytes(f.read(2))
-        old_size_y = from_bytes(f.read(2))
-        length_a = from_bytes(f.read(4))
-        old_a_ = np.frombuffer(zlib.decompress(f.read(length_a)), dtype=np.uint8).reshape((old_size_y, old_size_x, old_layer_count))
-
-    if old_layer_count != LAYER_COUNT:
-        old_a_wrong_shape = old_a_
-        old_a_ = np.zeros((old_size_y, old_size_x, LAYER_COUNT), dtype=np.uint8)
-        old_a_[:,:,:old_layer_count] = old_a_wrong_shape
-
-    old_a_, old_offset_x, old_offset_z = fit_array(old_a_, -old_offset_x, -old_offset_z, -offset_x, -offset_z, a.shape[1], a.shape[0])
-    old_a = np.zeros(a.shape, dtype=np.uint8)
-    old_a[old_offset_z:old_offset_z+old_a_.shape[0], old_offset_x:old_offset_x+old_a_.shape[1]] = old_a_
-
-    diff = a != old_a
-
-    changed_blocks = []
-
-    block_x_start = -offset_x//16
-    block_x_end = (-offset_x+a.shape[1])//16
-    block_z_start = -offset_z//16
-    block_z_end = (-offset_z+a.shape[0])//16
-    print(f"checking blocks from {block_x_start},{block_z_start} to {block_x_end},{block_z_end} for changes")
-    for block_x in range(block_x_start, block_x_end+1):
-        for block_z in range(block_z_start, block_z_end+1):
-            z1 = max(block_z*16+offset_z, 0)
-            z2 = min(z1+16, diff.shape[0])
-            x1 = max(block_x*16+offset_x, 0)
-            x2 = min(x1+16, diff.shape[1])
-            if diff[z1:z2, x1:x2].any():
-                assert block_x < 2**15 and block_z < 2**15, (block_x, block_z)
-                changed_blocks.append((block_x, block_z))
+        # line decorations (fences, hedges, ...)
+        polylines = columns.subset(~columns.is_point)
+        vertex_line = polylines.vertex_feature()
+        # a segment from every vertex to the next one of the same line
+        segment = np.flatnonzero(vertex_line[1:] == vertex_line[:-1])
+        xx, yy, _ = draw_lines(polylines.x[segment]-min_x, polylines.y[segment]-min_y, polylines.x[segment+1]-min_x, polylines.y[segment+1]-min_y)
+        inside = (0 <= xx) & (xx < size[0]) & (0 <= yy) & (yy < size[1])
+        a[yy[inside], xx[inside], 2] = id_
+
+
+def generate_map(min_x, min_y, max_x, max_y, heightmap=None, features=None, building_spans=None,
+                 flat=False, noheightreduction=False, heightmap_sub=None, buildings_base_height=0, verbose=False):
+    """
+    Create the (size_y, size_x, LAYER_COUNT) uint16 map array for min_x..max_x, min_y..max_y (inclusive).
+    heightmap: (heights, min_x, min_y) as returned by read_heightmap(), or None.
+    features: Features, or None.
+    building_spans: SPAN_DTYPE array as returned by read_buildings(). If given, the buildings in `features` are ignored.
+    heightmap_sub: subtracted from every height. Defaults to the smallest height (0 with `noheightreduction` or `flat`).
+    """
+    size = (max_x-min_x+1, max_y-min_y+1)
+    if min_x > max_x or min_y > max_y:
+        raise ValueError("map size is invalid")
+    features = features if features is not None else Features()
+
+    a = np.zeros((size[1], size[0], LAYER_COUNT), dtype=np.uint16)
+    # values (one for every layer):
+    # value 0: y0: heightmap; floor goes up to this block.
+    # value 1: surface type (block to place at y=y0; below is always stone)
+    # value 2: y1: If y1<BUILDING_FLAG, this is a decoration id (block to place at y=y0+1, and sometimes above (e.g. for trees)).
+    #              Otherwise, y1-BUILDING_BASE is the minimum y coordinate of a building. If the building is standing on the ground: y1=y0+BUILDING_BASE+1.
+    # value 3: y2: maximum y coordinate of a building. If y2>=BUILDING_FLAG, the topmost block (at y=y2) is part of a roof and the maximum y coordinate is y2-BUILDING_BASE.
+    # (map.dat stores layers with 8 bits if their values fit, see _mapdat.py)
+
+    # HEIGHTMAP
+    if heightmap_sub is None:
+        heightmap_sub = heightmap_reduction(heightmap, min_x, min_y, max_x, max_y) if not (flat or noheightreduction) else 0
+    fitted_heightmap = rasterize_heightmap(a, heightmap, min_x, min_y, flat, heightmap_sub)
+
+    # FEATURES
+    rasterize_areas(a, features.areas, min_x, min_y, verbose)
+    if building_spans is not None:
+        rasterize_building_spans(a, building_spans, min_x, min_y, heightmap_sub, buildings_base_height, flat, fitted_heightmap)
+    else:
+        rasterize_buildings(a, features.buildings, min_x, min_y, verbose)
+    rasterize_highways(a, features.highways, min_x, min_y)
+    rasterize_decorations(a, features.decorations, min_x, min_y, verbose)
+    return a
+
+
+def heightmap_reduction(heightmap, min_x, min_y, max_x, max_y):
+    """The smallest height of `heightmap` within the map bounds; subtracted from every height unless --noheightreduction is used."""
+    if heightmap is None:
+        return 0
+    heights = fit_array(*heightmap, min_x, min_y, max_x-min_x+1, max_y-min_y+1)[0]
+    return int(heights.min()) if heights.size else 0
+
+
+def feature_bboxes(features):
+    """
+    Bounding boxes (min_x, min_y, max_x, max_y) of all positions every feature can change, by feature type
+    ("areas", "buildings", "highways" and ("decorations", name)).
+    """
+    bboxes = {key: getattr(features, key).bboxes() for key in Features.CATEGORIES}
+    bboxes["highways"][:2] -= HIGHWAY_MARGIN
+    bboxes["highways"][2:] += HIGHWAY_MARGIN
+    for name, decorations in features.decorations.items():
+        bboxes[("decorations", name)] = decorations.bboxes()
+    return bboxes
+
+
+def intersecting(bboxes, min_x, min_y, max_x, max_y):
+    """Which of the bounding boxes (as returned by feature_bboxes()) intersect min_x..max_x, min_y..max_y."""
+    return (bboxes[0] <= max_x) & (bboxes[2] >= min_x) & (bboxes[1] <= max_y) & (bboxes[3] >= min_y)
+
+
+def dependency_window(features, bounds, min_x, min_y, max_x, max_y, osm_buildings=True):
+    """
+    Return the smallest part of the map (within `bounds` = (min_x, min_y, max_x, max_y)) that has to be generated
+    to get the same values in min_x..max_x, min_y..max_y as a run for the whole map.
+    Most features only change the positions they cover, but some use the mean height below all their positions
+    (flattened areas, buildings from `features` if `osm_buildings` is set, highways below the ground),
+    so the window is grown until it contains all of these features that intersect it.
+    """
+    bboxes = feature_bboxes(features)
+    is_global = {
+        "areas": np.isin(np.array(features.areas.attributes.get("surface", [None]*len(features.areas)), dtype=object), FLATTENED_SURFACES),
+        "buildings": np.full(len(features.buildings), osm_buildings),
+        "highways": features.highways.attribute("layer", 0, np.int64) < 0,
+    }
+    window = (max(min_x, bounds[0]), max(min_y, bounds[1]), min(max_x, bounds[2]), min(max_y, bounds[3]))
+    while True:
+        new_window = window
+        for key, needed in is_global.items():
+            selected = needed & intersecting(bboxes[key], *window)
+            if selected.any():
+                b = bboxes[key][:, selected]
+                new_window = (
+                    min(new_window[0], int(b[0].min())), min(new_window[1], int(b[1].min())),
+                    max(new_window[2], int(b[2].max())), max(new_window[3], int(b[3].max())),
+                )
+        new_window = (max(new_window[0], bounds[0]), max(new_window[1], bounds[1]), min(new_window[2], bounds[2]), min(new_window[3], bounds[3]))
+        if new_window == window:
+            return window
+        window = new_window
+
+
+def select_features(features, min_x, min_y, max_x, max_y):
+    """Return the features that can change positions within min_x..max_x, min_y..max_y, in their original order."""
+    bboxes = feature_bboxes(features)
+    selected = Features(
+        **{key: getattr(features, key).subset(intersecting(bboxes[key], min_x, min_y, max_x, max_y)) for key in Features.CATEGORIES},
+        bounds=features.bounds,
+    )
+    for name, decorations in features.decorations.items():
+        selected.decorations[name] = decorations.subset(intersecting(bboxes[("decorations", name)], min_x, min_y, max_x, max_y))
+    return selected
+
+
+def render_region(bounds, min_x, min_y, max_x, max_y, heightmap=None, features=None, building_spans=None, heightmap_sub=0, **options):
+    """
+    Generate only min_x..max_x, min_y..max_y of the map with `bounds` (min_x, min_y, max_x, max_y).
+    The result is the same as the corresponding part of generate_map(*bounds, ...) if the same `heightmap_sub` is used.
+    Other `options` are passed to generate_map().
+    """
+    features = features if features is not None else Features()
+    window = dependency_window(features, bounds, min_x, min_y, max_x, max_y, building_spans is None)
+    if building_spans is not None:
+        building_spans = building_spans[
+            (window[0] <= building_spans["x"]) & (building_spans["x"] <= window[2]) & (window[1] <= building_spans["y"]) & (building_spans["y"] <= window[3])
+        ]
+    a = generate_map(*window, heightmap, select_features(features, *window), building_spans, heightmap_sub=heightmap_sub, **options)
+    return a[max(min_y, bounds[1])-window[1]:min(max_y, bounds[3])-window[1]+1, max(min_x, bounds[0])-window[0]:min(max_x, bounds[2])-window[0]+1]
+
+
+def merge_bboxes(bboxes):
+    """Merge intersecting bounding boxes (min_x, min_y, max_x, max_y) until none of them intersect each other."""
+    bboxes = [tuple(b) for b in bboxes]
+    while True:
+        merged = []
+        for b in bboxes:
+            for i, m in enumerate(merged):
+                if b[0] <= m[2] and b[2] >= m[0] and b[1] <= m[3] and b[3] >= m[1]:
+                    merged[i] = (min(b[0], m[0]), min(b[1], m[1]), max(b[2], m[2]), max(b[3], m[3]))
+                    break
+            else:
+                merged.append(b)
+        if len(merged) == len(bboxes):
+            return merged
+        bboxes = merged
+
+
+def changed_regions(old_features, new_features, bounds, osm_buildings=True):
+    """
+    Return the parts of the map with `bounds` (min_x, min_y, max_x, max_y) that have to be generated again
+    when `old_features` are replaced with `new_features`: the bounding boxes of all removed and added features
+    (see changed_features()), grown by dependency_window() and merged where they intersect.
+    The rest of the map stays the same. Buildings are only compared if `osm_buildings` is set.
+    """
+    bboxes = []
+    for key, columns in changed_features(old_features, new_features).items():
+        if key == "buildings" and not osm_buildings:
+            continue
+        for c in columns:
+            features = Features(decorations={key[1]: c}) if isinstance(key, tuple) else Features(**{key: c})
+            b = feature_bboxes(features)[key][:, c.counts > 0]
+            b = b[:, intersecting(b, *bounds)]
+            bboxes.extend(zip(b[0].tolist(), b[1].tolist(), b[2].tolist(), b[3].tolist()))
+    # features that use heights of the changed positions change as well
+    windows = [dependency_window(new_features, bounds, *b, osm_buildings) for b in merge_bboxes(bboxes)]
+    return merge_bboxes(windows)
+
+
+def changed_block_positions(diff, offset_x, offset_z):
+    """
+    Return the (x, z) positions of all 16x16 blocks that contain a True value of the 2D array `diff`.
+    (offset_x, offset_z) is the index of the position x=0, z=0 in `diff`.
+    """
+    # pad the array so that it starts and ends at block borders
+    pad_z = (-offset_z) % 16
+    pad_x = (-offset_x) % 16
+    size_z = -(-(diff.shape[0]+pad_z) // 16) * 16
+    size_x = -(-(diff.shape[1]+pad_x) // 16) * 16
+    padded = np.zeros((size_z, size_x), dtype=bool)
+    padded[pad_z:pad_z+diff.shape[0], pad_x:pad_x+diff.shape[1]] = diff
+    blocks = padded.reshape(size_z//16, 16, size_x//16, 16).any(axis=(1, 3))
+    block_x, block_z = np.nonzero(blocks.T)
+    block_x += (-offset_x) // 16
+    block_z += (-offset_z) // 16
+    return list(zip(block_x.tolist(), block_z.tolist()))
+
+
+def changed_positions(layer, offset_x, offset_z, old_layer, old_offset_x, old_offset_z):
+    """
+    Compare a layer of the map array with the same layer of the previous map array.
+    Returns a 2D array that is True where they differ; positions outside of the previous map were 0.
+    """
+    old_layer_, old_x, old_z = fit_array(old_layer, -old_offset_x, -old_offset_z, -offset_x, -offset_z, layer.shape[1], layer.shape[0])
+    old = np.zeros(layer.shape, dtype=np.uint16)
+    old[old_z:old_z+old_layer_.shape[0], old_x:old_x+old_layer_.shape[1]] = old_layer_
+    return layer != old
+
+
+def find_changed_blocks(a, offset_x, offset_z, old_a, old_offset_x, old_offset_z):
+    """
+    Compare the map array `a` with the previous map array `old_a` and return the (x, z) positions
+    of all 16x16 blocks that changed.
+    """
+    print(f"checking blocks from {-offset_x//16},{-offset_z//16} to {(-offset_x+a.shape[1])//16},{(-offset_z+a.shape[0])//16} for changes")
+    diff = np.zeros(a.shape[:2], dtype=bool)
+    for i in range(a.shape[2]):
+        # layers the previous map doesn't have were 0
+        old_layer = old_a[:, :, i] if i < old_a.shape[2] else np.zeros(old_a.shape[:2], dtype=np.uint16)
+        diff |= changed_positions(a[:, :, i], offset_x, offset_z, old_layer, old_offset_x, old_offset_z)
+    changed_blocks = changed_block_positions(diff, offset_x, offset_z)
     print("changed blocks:", changed_blocks[:10], "..." if len(changed_blocks) > 10 else "")
-    changed_blocks = zlib.compress(b"".join(to_bytes(x, 2) + to_bytes(z, 2) for x, z in changed_blocks), 9)
-else:
-    changed_blocks = b""
-
-
-with open(out, "wb") as f:
-    f.write(to_bytes(1, 1))  # version
-    f.write(to_bytes(1, 1))  # minimum compatible version
-    f.write(to_bytes(LAYER_COUNT, 1))
-    f.write(to_bytes(a[offset_z, offset_x, 0], 1))  # height at spawnpoint
-    f.write(to_bytes(offset_x, 2))
-    f.write(to_bytes(offset_z, 2))
-    f.write(to_bytes(a.shape[1], 2))
-    f.write(to_bytes(a.shape[0], 2))
-    a_compressed = zlib.compress(a.tobytes(), 9)
-    f.write(to_bytes(len(a_compressed), 4))
-    f.write(a_compressed)
-    f.write(to_bytes(len(changed_blocks), 4))
-    f.write(changed_blocks)
-
-if args.createimg:
-    import imageio
-
-for i in range(3):
-    layer = a[::-1,:,i]
-    name = "layer" + ["0_height", "1_surface", "2_deco"][i]
-    m = max(layer.max(), 1)
-    print(name, "max value:", m)
+    return changed_blocks
+
+
+def encode_changed_blocks(changed_blocks):
+    """Encode (x, z) block positions as stored in the incr part of map.dat (signed 32-bit values)."""
+    return zlib.compress(np.array(changed_blocks, dtype="<i4").reshape(-1, 2).tobytes(), 9)
+
+
+def update_regions(a, bounds, offset_x, offset_z, regions, features, heightmap_file=None, heightmap_header=None,
+                   building_spans=None, heightmap_sub=0, **options):
+    """
+    Generate the `regions` (list of (min_x, min_y, max_x, max_y)) of the map array `a` with `bounds` again, in place.
+    Only the part of the heightmap file object `heightmap_file` (with the header `heightmap_header`, see
+    read_heightmap_header()) that is needed for each region is read.
+    Returns the sorted (x, z) positions of all blocks that changed.
+    """
+    changed_blocks = set()
+    for region in regions:
+        heightmap = None
+        if heightmap_header is not None:
+            window = dependency_window(features, bounds, *region, building_spans is None)
+            heightmap = read_heightmap(heightmap_file, heightmap_header, *window)
+        new = render_region(bounds, *region, heightmap, features, building_spans, heightmap_sub, **options)
+        x1, y1 = max(region[0], bounds[0]) - bounds[0], max(region[1], bounds[1]) - bounds[1]
+        old = a[y1:y1+new.shape[0], x1:x1+new.shape[1]]
+        changed_blocks.update(changed_block_positions((new != old).any(axis=2), offset_x-x1, offset_z-y1))
+        old[:] = new
+    return sorted(changed_blocks)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a map.dat file that can be read by world2minetest Mod")
+    parser.add_argument("--heightmap", type=argparse.FileType("rb"), help="Heightmap file generated by parse_heightmap_xyz.py", default=None)
+    parser.add_argument("--features", action="append", type=argparse.FileType("r"), help="features.json files generated by parse_features_osm.py or parse_features_dxf.py. Features of the same type in files specified earlier will be overridden.", default=None)
+    parser.add_argument("--buildings", type=argparse.FileType("rb"), help="buildings_cityjson.dat file generated by parse_cityjson.py. If this argument is used, buildings stored in a --features file will be ignored.", default=None)
+    parser.add_argument("--buildings-base-height", type=int, help="Subtracted from the height of every building. Defaults to 0.", default=0)
+    parser.add_argument("--incr", action="store_true", help="Add incremental map information to map.dat. Load new map data using the '/w2mt:incr' command. Use with caution and make a backup beforehand.")
+    parser.add_argument("--offsetx", type=int, help="EPSG:25832 x coordinate that will be x=0 in Minetest", default=None)
+    parser.add_argument("--offsetz", type=int, help="EPSG:25832 y coordinate that will be z=0 in Minetest (y is z in Minetest)", default=None)
+    parser.add_argument("--minx", type=int, help="Minimum EPSG:25832 x coordinate", default=None)
+    parser.add_argument("--maxx", type=int, help="Maximum EPSG:25832 x coordinate", default=None)
+    parser.add_argument("--miny", type=int, help="Minimum EPSG:25832 y coordinate (y is z in Minetest)", default=None)
+    parser.add_argument("--maxy", type=int, help="Maximum EPSG:25832 y coordinate (y is z in Minetest)", default=None)
+    parser.add_argument("--noheightreduction", action="store_true", help="Do not subtract the smallest height from every heightmap value")
+    parser.add_argument("--flat", action="store_true", help="If a --heightmap is specified, make the world flat, but subtract the heightmap value from each building coordinate")
+    parser.add_argument("--previous-features", action="append", type=argparse.FileType("r"), help="features.json files the existing --output file was generated from (with the same other arguments). Only the regions where features were added, removed or modified are generated again, on top of the existing map, and the changed blocks are added like with --incr.", default=None)
+    parser.add_argument("--createimg", action="store_true", help="Create a .png visualization of every layer")
+    parser.add_argument("--verbose", "-v", action="store_true", help="More debug info")
+    parser.add_argument("--output", "-o", type=str, help="Output file. Defaults to world2minetest/map.dat", default="world2minetest/map.dat")
+
+    args = parser.parse_args(argv)
+
+    if (args.heightmap is None or args.flat) and args.features is None:
+        raise argparse.ArgumentTypeError("at least one of --heightmap (without --flat) or --features is required.")
+
+    heightmap_header = read_heightmap_header(args.heightmap) if args.heightmap is not None else None
+    features = load_features(args.features or [])
+    min_x, min_y, max_x, max_y = map_bounds(args.minx, args.miny, args.maxx, args.maxy, heightmap_header, features)
+
+    size = (max_x-min_x+1, max_y-min_y+1)
+    print(f"from {min_x},{min_y} to {max_x},{max_y} (size: {size[0]},{size[1]})")
+    if min_x > max_x or min_y > max_y:
+        raise ValueError("map size is invalid")
+
+    if args.offsetx is not None and args.offsetz is not None and not (min_x <= args.offsetx <= max_x and min_y <= args.offsetz <= max_y):
+        raise ValueError(f"offset {(args.offsetx, args.offsetz)} is located outside of map")
+
+    building_spans = None
+    if args.buildings:
+        print("Reading buildings file")
+        building_spans = read_buildings(args.buildings)
+
+    offset_x = args.offsetx-min_x if args.offsetx is not None else 0
+    offset_z = args.offsetz-min_y if args.offsetz is not None else 0
+    out = args.output
+
+    print("offset x:", offset_x, "offset z:", offset_z)
+
+    if args.previous_features is not None:
+        # generate only the regions where the features changed, on top of the previous map
+        bounds = (min_x, min_y, max_x, max_y)
+        with open(out, "rb") as f:
+            old_header, a, _ = read_map(f)
+        if a.shape != (size[1], size[0], LAYER_COUNT) or (old_header["offset_x"], old_header["offset_z"]) != (offset_x, offset_z):
+            raise ValueError(f"{out} was generated for a different map size or offset; generate it without --previous-features")
+        a = np.array(a)
+        regions = changed_regions(load_features(args.previous_features), features, bounds, building_spans is None)
+        print(f"{len(regions)} changed regions with {sum((r[2]-r[0]+1)*(r[3]-r[1]+1) for r in regions)} positions")
+        heightmap_sub = 0
+        if heightmap_header is not None and not (args.flat or args.noheightreduction):
+            # the heights must be reduced by the same value as in the previous map
+            heightmap_sub = read_heightmap_min(args.heightmap, heightmap_header, *bounds)
+        changed_blocks = update_regions(
+            a, bounds, offset_x, offset_z, regions, features, args.heightmap, heightmap_header, building_spans, heightmap_sub,
+            flat=args.flat, buildings_base_height=args.buildings_base_height, verbose=args.verbose,
+        )
+        print("changed blocks:", changed_blocks[:10], "..." if len(changed_blocks) > 10 else "")
+        changed_blocks = encode_changed_blocks(changed_blocks)
+    else:
+        heightmap = None
+        if heightmap_header is not None:
+            # only read the part of the heightmap that is needed
+            heightmap = read_heightmap(args.heightmap, heightmap_header, min_x, min_y, max_x, max_y)
+
+        a = generate_map(
+            min_x, min_y, max_x, max_y, heightmap, features, building_spans,
+            flat=args.flat, noheightreduction=args.noheightreduction,
+            buildings_base_height=args.buildings_base_height, verbose=args.verbose,
+        )
+
+        if args.incr:
+            with open(out, "rb") as f:
+                old_header, old_a, _ = read_map(f)
+            changed_blocks = find_changed_blocks(a, offset_x, offset_z, old_a, old_header["offset_x"], old_header["offset_z"])
+            changed_blocks = encode_changed_blocks(changed_blocks)
+        else:
+            changed_blocks = b""
+
+    with open(out, "wb") as f:
+        write_map(f, a, offset_x, offset_z, changed_blocks)
+
     if args.createimg:
-        imageio.imwrite(f"world2minetest/{name}.png", layer*int(255/m))
+        import imageio
+
+    for i in range(3):
+        layer = a[::-1,:,i]
+        name = "layer" + ["0_height", "1_surface", "2_deco"][i]
+        if i == 2:
+            # building positions (BUILDING_BASE + z) would make the decoration ids too dark to see
+            layer = np.where(layer >= BUILDING_FLAG, 0, layer)
+        m = max(layer.max(), 1)
+        print(name, "max value:", m)
+        if args.createimg:
+            imageio.imwrite(f"world2minetest/{name}.png", (layer.astype(np.float64)*255/m).astype(np.uint8))
+
+
+if __name__ == "__main__":
+    main()
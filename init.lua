@@ -117,16 +117,52 @@ local DECORATION_SCHEMATICS = {
     [15] = {schematic=minetest.get_modpath("default") .. "/schematics/bush.mts",       rotation="random", force_placement=false, flags="place_center_x, place_center_z", shift_y=-1}, -- bush
 }
 
+-- register every schematic file once at load time. Placements refer to it by its path, which the engine
+-- looks up in its schematic manager; a schematic table would be converted and registered again for every placement.
+do
+    local registered = {}
+    for _, info in pairs(DECORATION_SCHEMATICS) do
+        local path = info.schematic
+        if registered[path] == nil then
+            registered[path] = minetest.register_schematic(path) ~= nil
+            if not registered[path] then
+                minetest.log("[w2mt] WARNING: Failed to load schematic " .. path)
+            end
+        end
+    end
+end
+
 
 local layer_count = nil
 local floor_height = nil
+local top_height = nil  -- largest height of the ground and buildings above floor_height
 local offset_x = nil
 local offset_z = nil
 local width = nil
 local height = nil
 local map = nil
 local incr = nil
+local incr_block_size = nil  -- bytes per incr mapblock position
+local get_layers = nil
+
+-- map.dat version 2 and 3 only
+local tile_size = nil
+local tiles_x = nil
+local layer_tiles = nil  -- for every layer: list of tiles; a tile is either a number (uniform tile) or a string
+local layer_storage = nil  -- for every layer: how the values of non-uniform tiles are stored (STORAGE_*)
+local layer_delta_tiles = nil  -- for every layer: delta coded tiles that weren't used yet (see get_tile())
+
+-- values of layers 3 and 4 >= BUILDING_FLAG are building positions y, stored as BUILDING_BASE + y (see generate_map.py)
+local BUILDING_FLAG = 0x8000
+local BUILDING_BASE = BUILDING_FLAG - 1
 
+-- value storage of map.dat version 3 (see _mapdat.py)
+local STORAGE_16 = 0
+local STORAGE_8 = 1
+local STORAGE_8_FLAG = 2  -- bit 15 is stored as bit 7
+
+
+local unpack = unpack or table.unpack
 
 local function bytes2int(str, signed) -- little endian
     -- copied from https://github.com/Gael-de-Sailly/geo-mapgen/blob/4bacbe902e7c0283a24ee3efa35c283ad592e81c/init.lua#L33
@@ -143,14 +179,133 @@ local function bytes2int(str, signed) -- little endian
     return n
 end
 
-local function get_layers(x, z)
+local function widen_flag(v)
+    -- STORAGE_8_FLAG value to 16 bits
+    if v >= 128 then
+        return v + BUILDING_FLAG - 128
+    end
+    return v
+end
+
+local function get_layers_interleaved(x, z)
+    -- map.dat version 1
     x = x + offset_x
     z = z + offset_z
     if x < 0 or z < 0 or x >= width or z >= height then
-        return 0, 0, 0
+        return 0, 0, 0, 0
     end
     local i = z*width*layer_count + x*layer_count + 1
-    return bytes2int(map:sub(i, i)), bytes2int(map:sub(i+1, i+1)), bytes2int(map:sub(i+2, i+2)), bytes2int(map:sub(i+3, i+3))
+    local y0, surface, y1, y2 = map:byte(i, i+3)
+    return y0, surface, widen_flag(y1), widen_flag(y2)
+end
+
+local function tile_value(tile, i, storage)
+    if type(tile) == "number" then
+        return tile
+    end
+    if storage == STORAGE_16 then
+        local lo, hi = tile:byte(2*i-1, 2*i)
+        return lo + hi*256
+    elseif storage == STORAGE_8_FLAG then
+        return widen_flag(tile:byte(i))
+    end
+    return tile:byte(i)
+end
+
+local function decode_delta_tile(tile, storage)
+    -- add up the differences of every tile row; the whole tile is read and written with one string.byte/string.char call
+    local bytes = {tile:byte(1, -1)}
+    if storage == STORAGE_16 then
+        for r = 0, tile_size-1 do
+            local v = 0
+            for i = 2*r*tile_size+1, 2*(r+1)*tile_size, 2 do
+                v = (v + bytes[i] + bytes[i+1]*256) % 65536
+                bytes[i] = v % 256
+                bytes[i+1] = (v - v % 256) / 256
+            end
+        end
+    else
+        for r = 0, tile_size-1 do
+            local v = 0
+            for i = r*tile_size+1, (r+1)*tile_size do
+                v = (v + bytes[i]) % 256
+                bytes[i] = v
+            end
+        end
+    end
+    return string.char(unpack(bytes))
+end
+
+local function get_tile(l, t)
+    local tile = layer_tiles[l][t]
+    if tile == nil then
+        tile = decode_delta_tile(layer_delta_tiles[l][t], layer_storage[l])
+        layer_tiles[l][t] = tile
+        layer_delta_tiles[l][t] = nil
+    end
+    return tile
+end
+
+local function get_layers_planar(x, z)
+    -- map.dat version 2 and 3
+    x = x + offset_x
+    z = z + offset_z
+    if x < 0 or z < 0 or x >= width or z >= height then
+        return 0, 0, 0, 0
+    end
+    local t = math.floor(z/tile_size)*tiles_x + math.floor(x/tile_size) + 1
+    local i = (z%tile_size)*tile_size + x%tile_size + 1
+    return tile_value(get_tile(1, t), i, layer_storage[1]), tile_value(get_tile(2, t), i, layer_storage[2]),
+        tile_value(get_tile(3, t), i, layer_storage[3]), tile_value(get_tile(4, t), i, layer_storage[4])
+end
+
+local ENCODING_RAW = 0
+local ENCODING_DELTA = 1
+
+-- string.byte() returns at most this many values at once
+local BYTE_CHUNK = 4096
+
+local function decode_layer(data, tile_count, encoding, storage)
+    -- see _mapdat.py for a description of the format.
+    -- Returns the tiles and the delta coded tiles, which are only decoded when they are used (see get_tile()),
+    -- so loading a large map doesn't have to decode every tile.
+    local value_size = storage == STORAGE_16 and 2 or 1
+    local tile_len = tile_size*tile_size*value_size
+    local tiles = {}
+    local delta_tiles = {}
+    local flags = {}
+    local uniform_count = 0
+    for first = 1, tile_count, BYTE_CHUNK do
+        local chunk = {data:byte(first, math.min(first+BYTE_CHUNK-1, tile_count))}
+        for i = 1, #chunk do
+            flags[first+i-1] = chunk[i]
+            if chunk[i] ~= 0 then
+                uniform_count = uniform_count + 1
+            end
+        end
+    end
+    local value_i = tile_count + 1
+    local data_i = tile_count + uniform_count*value_size + 1
+    for t = 1, tile_count do
+        if flags[t] ~= 0 then
+            if storage == STORAGE_16 then
+                local lo, hi = data:byte(value_i, value_i+1)
+                tiles[t] = lo + hi*256
+            elseif storage == STORAGE_8_FLAG then
+                tiles[t] = widen_flag(data:byte(value_i))
+            else
+                tiles[t] = data:byte(value_i)
+            end
+            value_i = value_i + value_size
+        elseif encoding == ENCODING_DELTA then
+            delta_tiles[t] = data:sub(data_i, data_i+tile_len-1)
+            data_i = data_i + tile_len
+        else
+            tiles[t] = data:sub(data_i, data_i+tile_len-1)
+            data_i = data_i + tile_len
+        end
+    end
+    return tiles, delta_tiles
 end
 
 local function load_map_file()
@@ -158,43 +313,98 @@ local function load_map_file()
     minetest.log("[w2mt] Loading map.dat from " .. path)
     local file = io.open(path, "rb")
 
-    local CURRENT_VERSION = 1
+    local CURRENT_VERSION = 3
 
     local version = bytes2int(file:read(1))
     local min_compat_version = bytes2int(file:read(1))
     if min_compat_version > CURRENT_VERSION then
         error("world2minetest can't load map.dat (version " .. version .. ", needs version " .. min_compat_version .. " or higher (mod version: " .. CURRENT_VERSION .. ")")
     end
-    if version ~= CURRENT_VERSION then
+    if version > CURRENT_VERSION then
         minetest.log("[w2mt] WARNING: map.dat has newer version " .. version .. " (mod version: " .. CURRENT_VERSION .. ")")
     end
+    -- version 3 has wider header fields
+    local field_size = version >= 3 and 4 or 2
     layer_count = bytes2int(file:read(1))
-    floor_height = -bytes2int(file:read(1))
-    offset_x = bytes2int(file:read(2))
-    offset_z = bytes2int(file:read(2))
-    width = bytes2int(file:read(2))
-    height = bytes2int(file:read(2))
-    local map_size = bytes2int(file:read(4))
-    map = minetest.decompress(file:read(map_size))
+    floor_height = -bytes2int(file:read(field_size/2))
+    top_height = version >= 3 and bytes2int(file:read(2)) or 255
+    offset_x = bytes2int(file:read(field_size))
+    offset_z = bytes2int(file:read(field_size))
+    width = bytes2int(file:read(field_size))
+    height = bytes2int(file:read(field_size))
+    local map_info
+    if version == 1 then
+        local map_size = bytes2int(file:read(4))
+        map = minetest.decompress(file:read(map_size))
+        layer_tiles = nil
+        get_layers = get_layers_interleaved
+        map_info = " len:" .. map:len()
+    else
+        tile_size = bytes2int(file:read(1))
+        tiles_x = math.ceil(width/tile_size)
+        local tile_count = tiles_x * math.ceil(height/tile_size)
+        layer_tiles = {}
+        layer_storage = {}
+        layer_delta_tiles = {}
+        for l = 1, layer_count do
+            local encoding = bytes2int(file:read(1))
+            local storage
+            if version >= 3 then
+                storage = bytes2int(file:read(1))
+            elseif l == 3 or l == 4 then
+                storage = STORAGE_8_FLAG
+            else
+                storage = STORAGE_8
+            end
+            local layer_size = bytes2int(file:read(4))
+            layer_tiles[l], layer_delta_tiles[l] = decode_layer(minetest.decompress(file:read(layer_size)), tile_count, encoding, storage)
+            layer_storage[l] = storage
+        end
+        map = nil
+        get_layers = get_layers_planar
+        map_info = " tiles:" .. tile_count
+    end
     local incr_size = bytes2int(file:read(4))
     local incr_info
+    -- version 3: two signed 32-bit values per mapblock, before: two signed 16-bit values
+    incr_block_size = 2*field_size
     if incr_size ~= 0 then
         incr = minetest.decompress(file:read(incr_size))
-        incr_info = " incr mapblocks:" .. incr:len()/4
+        incr_info = " incr mapblocks:" .. incr:len()/incr_block_size
     else
         incr_info = " no incr data"
     end
-    minetest.log("[w2mt] map.dat loaded! offset_x:" .. offset_x .. " offset_z:" .. offset_z .. " width:" .. width .. " height:" .. height .. " len:" .. map:len() .. incr_info)
+    file:close()
+    minetest.log("[w2mt] map.dat loaded! version:" .. version .. " offset_x:" .. offset_x .. " offset_z:" .. offset_z .. " width:" .. width .. " height:" .. height .. map_info .. incr_info)
 end
 
 load_map_file()
 
 
 local vdata = {}
+
+-- schematics and signs to place after the voxel data of a chunk has been written.
+-- Entries are reused for every chunk; only the first placement_count entries are valid.
+local placements = {}
+local placement_count = 0
+
+local function add_placement(x, y, z, id)
+    placement_count = placement_count + 1
+    local p = placements[placement_count]
+    if p == nil then
+        p = {pos={}}
+        placements[placement_count] = p
+    end
+    p.pos.x = x
+    p.pos.y = y
+    p.pos.z = z
+    p.id = id
+end
+
 local function generate(vm, emin, emax, minp, maxp)
     vm:get_data(vdata)
     local va = VoxelArea:new{MinEdge = emin, MaxEdge = emax}
-    local schematics_to_place = {}
+    placement_count = 0
     local roof = get_random_roof()
     for x = minp.x, maxp.x do
         for z = minp.z, maxp.z do
@@ -221,24 +431,24 @@ local function generate(vm, emin, emax, minp, maxp)
             if x == 0 and z == 0 then
                 -- place a sign with credits
                 if minp.y <= decoration_y and decoration_y <= maxp.y then
-                    table.insert(schematics_to_place, {pos={x=0, y=decoration_y, z=0}, id="credit_sign_mod"})
+                    add_placement(0, decoration_y, 0, "credit_sign_mod")
                 end
                 -- place a sign with credits
                 if minp.y <= decoration_y and decoration_y <= maxp.y then
-                    table.insert(schematics_to_place, {pos={x=0, y=decoration_y, z=1}, id="credit_sign_data"})
+                    add_placement(0, decoration_y, 1, "credit_sign_data")
                 end
-            elseif y1_decoration_id >= 128 then
+            elseif y1_decoration_id >= BUILDING_FLAG then
                 -- there's a building here
                 local has_roof
-                if y2_max_building >= 128 then
-                    y2_max_building = y2_max_building-127-1 -- -1 block for roof
+                if y2_max_building >= BUILDING_FLAG then
+                    y2_max_building = y2_max_building-BUILDING_BASE-1 -- -1 block for roof
                     has_roof = true
                 else
                     has_roof = false
                 end
-                y1_decoration_id = floor_height+y1_decoration_id-127
+                y1_decoration_id = floor_height+y1_decoration_id-BUILDING_BASE
                 y2_max_building = floor_height+y2_max_building
-                -- building from y1_decoration_id-127 to y2_max_building(-127 if there's a roof)
+                -- building from y1_decoration_id-BUILDING_BASE to y2_max_building(-BUILDING_BASE if there's a roof)
                 local building_min = math.max(y1_decoration_id, minp.y)
                 local building_max = math.min(y2_max_building, maxp.y)
                 i = va:index(x, building_min, z)
@@ -258,7 +468,7 @@ local function generate(vm, emin, emax, minp, maxp)
                 if minp.y <= decoration_y and decoration_y <= maxp.y then
                     if 12 <= y1_decoration_id and y1_decoration_id <= 15 then
                         -- place tree, bush etc.
-                        table.insert(schematics_to_place, {pos={x=x, y=decoration_y, z=z}, id=y1_decoration_id})
+                        add_placement(x, decoration_y, z, y1_decoration_id)
                     else
                         vdata[i] = DECORATION_IDS[y1_decoration_id]
                     end
@@ -268,7 +478,8 @@ local function generate(vm, emin, emax, minp, maxp)
     end
 
     vm:set_data(vdata)
-    for _, s in pairs(schematics_to_place) do
+    for n = 1, placement_count do
+        local s = placements[n]
         if s.id == "credit_sign_mod" then
             minetest.set_node(s.pos, {name="default:sign_wall_steel", param2=1})
             local meta = minetest.get_meta(s.pos)
@@ -323,17 +534,19 @@ minetest.register_chatcommand("w2mt:incr", {
             minetest.log("[w2mt] No incremental data available")
         end
         load_map_file()
-        local len = string.len(incr)/4
+        local len = string.len(incr)/incr_block_size
+        local value_size = incr_block_size/2
         for i = 0, len-1 do
-            local start_i = i*4
-            local block_x = bytes2int(incr:sub(start_i+1, start_i+2), true)
-            local block_z = bytes2int(incr:sub(start_i+3, start_i+4), true)
+            local start_i = i*incr_block_size
+            local block_x = bytes2int(incr:sub(start_i+1, start_i+value_size), true)
+            local block_z = bytes2int(incr:sub(start_i+value_size+1, start_i+incr_block_size), true)
             local node_x_min = block_x * 16
             local node_x_max = node_x_min + 15
             local node_z_min = block_z * 16
             local node_z_max = node_z_min + 15
             minetest.log("[w2mt] Deleting mapblock " .. i+1 .. "/" .. len .. ": (" .. block_x .. "," .. block_z .. ") from (" .. node_x_min .. "," .. node_z_min .. ") to (" .. node_x_max .. "," .. node_z_max .. ")")
-            minetest.delete_area({x=node_x_min, y=floor_height, z=node_z_min}, {x=node_x_max, y=floor_height+255, z=node_z_max})
+            -- up to 32 blocks above the map for trees and roofs
+            minetest.delete_area({x=node_x_min, y=floor_height, z=node_z_min}, {x=node_x_max, y=floor_height+math.max(top_height+32, 255), z=node_z_max})
         end
     end
 })
@@ -365,7 +578,7 @@ minetest.register_chatcommand("w2mt:generateall", {
                 count = count + 1
                 if count >= start and count <= end_ then
                     local minp = {x=x, y=floor_height-10, z=z}
-                    local maxp = {x=x+79, y=minp.y+280, z=z+79}
+                    local maxp = {x=x+79, y=minp.y+math.max(top_height+42, 280), z=z+79}
                     minetest.log("[w2mt] Generating " .. count .. " " .. minetest.pos_to_string(minp) .. " to " .. minetest.pos_to_string(maxp))
                     vm = minetest.get_voxel_manip(minp, maxp)
                     local emin, emax = vm:read_from_map(minp, maxp)
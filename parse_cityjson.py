@@ -1,35 +1,131 @@
 import argparse
 import os.path
 from functools import partial
+from itertools import islice
+from multiprocessing import Pool
 
-import raster_geometry as rg
-from cjio import cityjson
+import numpy as np
+import orjson
 from tqdm import tqdm
 
-from _util import to_bytes
+from _buildings import SpanWriter, building_spans, SPAN_DTYPE
+from catalog import add_catalog_arguments, catalog_files
 
 
-parser = argparse.ArgumentParser(description="Parse CityJSON .json files and create a buildings file for generate_map.py")
-parser.add_argument("files", metavar="file", type=str, nargs="+", help=".json files to process")
-parser.add_argument("--fill", action="store_true", help="Fill the building's polygons instead of only drawing the outlines. This is much slower and doesn't work correctly for concave polygons. Roofs are always filled.")
-parser.add_argument("--output", "-o", type=argparse.FileType("wb"), help="Output file. Defaults to parsed_data/buildings_cityjson.dat", default="./parsed_data/buildings_cityjson.dat")
+BUILDING_TYPES = ["building", "buildingpart", "buildinginstallation"]
 
-args = parser.parse_args()
+SURFACE_TYPES = {
+    "WallSurface": "wall",
+    "RoofSurface": "roof",
+    "GroundSurface": "ground"
+}
 
-polygon = rg.bresenham_polygon
-lines = partial(rg.bresenham_lines, closed=True)
-get_polygon_points_normal = polygon if args.fill else lines
-get_polygon_points_roof = polygon
+# number of CityJSONSeq lines that are handed to the worker processes at once
+BATCH_SIZE = 1000
 
-buildings = []
+# set by set_fill(), so raster_geometry is only imported when needed
+get_polygon_points_normal = None
+get_polygon_points_roof = None
 
-for filepath in args.files:
-    print(os.path.basename(filepath))
+
+def set_fill(fill):
+    global get_polygon_points_normal, get_polygon_points_roof
+    import raster_geometry as rg
+    polygon = rg.bresenham_polygon
+    lines = partial(rg.bresenham_lines, closed=True)
+    get_polygon_points_normal = polygon if fill else lines
+    get_polygon_points_roof = polygon
+
+
+def get_surface_points(type_, rings):
+    # rasterize the rings (lists of (x, y, z) positions) of all surfaces of one type
+    if get_polygon_points_roof is None:
+        set_fill(False)
+    get_points = get_polygon_points_roof if type_ == "roof" else get_polygon_points_normal
+    surface_points = set()
+    for ring in rings:
+        surface_points.update(get_points([tuple(int(round(x)) for x in pos) for pos in ring]))
+    return list(surface_points)
+
+
+def get_surface_type(semantic_type):
+    type_ = SURFACE_TYPES.get(semantic_type, "other")
+    if type_ == "other":
+        print(f"unknown surface type '{semantic_type}'")
+    return type_
+
+
+def iter_semantic_surfaces(geometry):
+    # yield (semantic surface index, surface) for every surface of a CityJSON geometry
+    boundaries = geometry.get("boundaries", [])
+    values = geometry.get("semantics", {}).get("values")
+    depth = {"MultiSurface": 0, "CompositeSurface": 0, "Solid": 1, "MultiSolid": 2, "CompositeSolid": 2}.get(geometry["type"])
+    if depth is None or values is None:
+        return
+
+    def walk(b, v, d):
+        if d == 0:
+            for surface, value in zip(b, v):
+                yield value, surface
+        else:
+            for b_, v_ in zip(b, v):
+                if v_ is not None:
+                    yield from walk(b_, v_, d-1)
+    yield from walk(boundaries, values, depth)
+
+
+def parse_feature_line(line, transform):
+    # parse a single CityJSONFeature (one line of a CityJSONSeq file) and return its buildings
+    feature = orjson.loads(line)
+    if feature.get("type") != "CityJSONFeature":
+        return []
+    scale = transform["scale"]
+    translate = transform["translate"]
+    vertices = [
+        (x*scale[0]+translate[0], y*scale[1]+translate[1], z*scale[2]+translate[2])
+        for x, y, z in feature["vertices"]
+    ]
+    res_buildings = []
+    for id_, co in feature["CityObjects"].items():
+        if co["type"].lower() not in BUILDING_TYPES:
+            print("Ignoring", co["type"], id_)
+            continue
+        geometries = co.get("geometry", [])
+        if len(geometries) >= 1:
+            assert len(geometries) == 1
+            geom = geometries[0]
+            semantic_surfaces = geom.get("semantics", {}).get("surfaces", [])
+            rings_by_type = {}
+            for value, surface in iter_semantic_surfaces(geom):
+                if value is None:
+                    continue
+                type_ = get_surface_type(semantic_surfaces[value]["type"])
+                rings = rings_by_type.setdefault(type_, [])
+                for ring in surface:
+                    rings.append([vertices[i] for i in ring])
+            res_buildings.append({type_: get_surface_points(type_, rings) for type_, rings in rings_by_type.items()})
+    return res_buildings
+
+
+def init_worker(fill, transform):
+    global worker_transform
+    set_fill(fill)
+    worker_transform = transform
+
+
+def parse_feature_line_worker(line):
+    # spans are much smaller than the rasterized positions, so reduce them before sending them back
+    return [building_spans(building) for building in parse_feature_line(line, worker_transform)]
+
+
+def iter_buildings_cityjson(filepath):
+    # CityJSON file: loaded completely. Yields the spans of every building.
+    from cjio import cityjson
     cm = cityjson.load(filepath)
     for co in cm.cityobjects.values():
-        if co.type.lower() not in ["building", "buildingpart", "buildinginstallation"]:
+        if co.type.lower() not in BUILDING_TYPES:
             print("Ignoring", co.type, co)
-    t = tqdm(cm.get_cityobjects(type=["building", "buildingpart", "buildinginstallation"]).values())
+    t = tqdm(cm.get_cityobjects(type=BUILDING_TYPES).values())
     for building in t:
         t.set_description(building.id)
         if len(building.geometry) >= 1:
@@ -37,39 +133,68 @@ for filepath in args.files:
             geom = building.geometry[0]
             res_building = {}
             for surface in geom.surfaces.values():
-                type_ = {
-                    "WallSurface": "wall",
-                    "RoofSurface": "roof",
-                    "GroundSurface": "ground"
-                }.get(surface["type"], "other")
-                if type_ == "other":
-                    print(f"unknown surface type '{surface['type']}'")
-                
-                get_points = get_polygon_points_roof if type_ == "roof" else get_polygon_points_normal
-
-                boundaries = []
+                type_ = get_surface_type(surface["type"])
+                rings = []
                 for x in geom.get_surfaces(type=surface["type"]).values():
-                    boundaries.append(geom.get_surface_boundaries(x))
-                surface_points = set()
-                for composite in boundaries:
-                    for shell in composite:
-                        for boundary in shell:
-                            rg.bresenham_lines
-                            surface_points.update(get_points([tuple(int(round(x)) for x in pos) for pos in boundary]))
-                
-                res_building[type_] = list(surface_points)
-            buildings.append(res_building)
-
-
-with args.output as f:
-    f.write(to_bytes(len(buildings), 4))
-    for building in buildings:
-        f.write(to_bytes(0, 1))
-        for surface_name, points in building.items():
-            surface_name = surface_name.encode("utf-8")
-            f.write(to_bytes(len(surface_name), 1))
-            f.write(surface_name)
-            f.write(to_bytes(len(points), 4))
-            for point in points:
-                for coord in point:
-                    f.write(to_bytes(coord, 4))
+                    for shell in geom.get_surface_boundaries(x):
+                        rings.extend(shell)
+                res_building[type_] = get_surface_points(type_, rings)
+            yield building_spans(res_building)
+
+
+def iter_buildings_cityjsonseq(filepath, fill, processes=None):
+    # CityJSON Text Sequence file: the first line contains the transform, every other line is one feature.
+    # Features are read in batches and distributed to worker processes, so memory use doesn't depend on the file size.
+    # Yields the spans of every building.
+    with open(filepath, "rb") as f:
+        header = orjson.loads(f.readline())
+        if header.get("type") != "CityJSON":
+            raise ValueError(f"{filepath}: first line is not a CityJSON header")
+        transform = header.get("transform", {"scale": [1, 1, 1], "translate": [0, 0, 0]})
+        with Pool(processes, initializer=init_worker, initargs=(fill, transform)) as pool, tqdm(unit=" features") as t:
+            while batch := [line for line in islice(f, BATCH_SIZE) if line.strip()]:
+                for spans in pool.imap(parse_feature_line_worker, batch, chunksize=16):
+                    yield from spans
+                t.update(len(batch))
+
+
+def iter_building_spans(files, fill=False, processes=None):
+    """Yield the spans of every building in CityJSON .json or CityJSONSeq .jsonl files."""
+    set_fill(fill)
+    for filepath in files:
+        print(os.path.basename(filepath))
+        if filepath.endswith(".jsonl"):
+            yield from iter_buildings_cityjsonseq(filepath, fill, processes)
+        else:
+            yield from iter_buildings_cityjson(filepath)
+
+
+def read_cityjson(files, fill=False, processes=None):
+    """Return the spans (SPAN_DTYPE array) of all buildings in CityJSON .json or CityJSONSeq .jsonl files."""
+    spans = list(iter_building_spans(files, fill, processes))
+    return np.concatenate(spans) if spans else np.zeros(0, dtype=SPAN_DTYPE)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parse CityJSON .json or CityJSONSeq .jsonl files and create a buildings file for generate_map.py")
+    parser.add_argument("files", metavar="file", type=str, nargs="*", help=".json or .city.jsonl files to process")
+    parser.add_argument("--fill", action="store_true", help="Fill the building's polygons instead of only drawing the outlines. This is much slower and doesn't work correctly for concave polygons. Roofs are always filled.")
+    parser.add_argument("--processes", "-j", type=int, help="Number of worker processes for .jsonl files. Defaults to the number of CPUs.", default=None)
+    parser.add_argument("--output", "-o", type=argparse.FileType("wb"), help="Output file. Defaults to parsed_data/buildings_cityjson.dat", default="./parsed_data/buildings_cityjson.dat")
+    add_catalog_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    files = args.files + catalog_files(parser, args, ("cityjson", "cityjsonseq"))
+    if not files:
+        parser.error("no files to process")
+    with args.output as f:
+        writer = SpanWriter(f)
+        for spans in iter_building_spans(files, args.fill, args.processes):
+            writer.write(spans)
+        writer.close()
+        print(f"{writer.count} building columns")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,297 +4,313 @@ from concurrent.futures import ThreadPoolExecutor
 import threading
 from collections import defaultdict
 
-from pyproj import CRS, Transformer
-
+from _features import Features, FeatureColumns
 from _util import SURFACES, DECORATIONS
 
-parser = argparse.ArgumentParser(description="Parse OSM data")
-parser.add_argument("file", type=argparse.FileType("r", encoding="utf-8"), help="GeoJSON file with OSM data")
-parser.add_argument("--output", "-o", type=argparse.FileType("w"), help="Output file. Defaults to parsed_data/features_osm.json", default="./parsed_data/features_osm.json")
-parser.add_argument("--crs", "-c", type=int, help="Coordinates Reference system, needs to be cartesian and the same as the one coordinate given later to generate_map.py", default=25832)
-
-args = parser.parse_args()
 
-# thread locks for the different lists to enable parallelization without concurrency conflicts
-areas_lock = threading.Lock()
-buildings_lock = threading.Lock()
-decorations_lock = threading.Lock()
-highways_lock = threading.Lock()
-
-# transform EPSG:4326 to EPSG:25832
-transform_coords = Transformer.from_crs(CRS.from_epsg(4326), CRS.from_epsg(args.crs)).transform
-def get_nodepos(lat, lon):
-    x, y = transform_coords(lat, lon)
-    return int(round(x)), int(round(y))
+RAIL_TYPES = ["rail", "tram", "light_rail", "subway", "funicular"]
 
 
 def print_element(msg, e):
     print(msg, f"{e['id']} {e['type']}[{','.join(k+'='+v for k,v in e.get('tags', {}).items())}]")
 
 
-node_id_to_blockpos = {}
-
-def node_ids_to_node_positions(node_ids):
-    x_coords = []
-    y_coords = []
-    for node_id in node_ids:
-        x, y = node_id_to_blockpos[node_id]
-        x_coords.append(x)
-        y_coords.append(y)
-    return x_coords, y_coords
-
-
-data = orjson.loads(args.file.read())
+class OsmParser:
+    """Convert OSM elements (Overpass API JSON output) to features. Use a new instance for every dataset."""
+
+    def __init__(self, crs=25832):
+        from pyproj import CRS, Transformer
+
+        # transform EPSG:4326 to the target CRS
+        self.transform_coords = Transformer.from_crs(CRS.from_epsg(4326), CRS.from_epsg(crs)).transform
+        self.node_id_to_blockpos = {}
+        self.min_x = None
+        self.max_x = None
+        self.min_y = None
+        self.max_y = None
+        self.res_areas = []
+        self.res_buildings = []
+        self.res_decorations = defaultdict(list)
+        self.res_highways = []
+        # thread locks for the different lists to enable parallelization without concurrency conflicts
+        self.areas_lock = threading.Lock()
+        self.buildings_lock = threading.Lock()
+        self.decorations_lock = threading.Lock()
+        self.highways_lock = threading.Lock()
+        self.bounds_lock = threading.Lock()
+
+    def get_nodepos(self, lat, lon):
+        x, y = self.transform_coords(lat, lon)
+        return int(round(x)), int(round(y))
+
+    def node_ids_to_node_positions(self, node_ids):
+        x_coords = []
+        y_coords = []
+        for node_id in node_ids:
+            x, y = self.node_id_to_blockpos[node_id]
+            x_coords.append(x)
+            y_coords.append(y)
+        return x_coords, y_coords
+
+    def update_min_max(self, x_coords, y_coords):
+        with self.bounds_lock:
+            self.min_x = min(x_coords) if self.min_x is None else min(self.min_x, *x_coords)
+            self.max_x = max(x_coords) if self.max_x is None else max(self.max_x, *x_coords)
+            self.min_y = min(y_coords) if self.min_y is None else min(self.min_y, *y_coords)
+            self.max_y = max(y_coords) if self.max_y is None else max(self.max_y, *y_coords)
+
+    def process_barrier(self, barrier):
+        if barrier["tags"]["barrier"] in DECORATIONS:
+            deco = barrier["tags"]["barrier"]
+        else:
+            deco = "barrier"
+            print_element("Default barrier:", barrier)
+        x_coords, y_coords = self.node_ids_to_node_positions(barrier["nodes"])
+        self.update_min_max(x_coords, y_coords)
+        with self.decorations_lock:
+            self.res_decorations[deco].append({"x": x_coords, "y": y_coords, "id": barrier["id"]})
+
+    def process_building(self, building):
+        x_coords, y_coords = self.node_ids_to_node_positions(building["nodes"])
+        if len(x_coords) < 2:
+            print_element(f"Ignored, only {len(x_coords)} nodes:", building)
+
+        tags = building["tags"]
+        material = None
+
+        if "building:material" in tags:
+            if tags["building:material"] == "brick":
+                material = "brick"
+            else:
+                print_element("Unrecognized building:material", building)
+        is_building_part = "building:part" in tags
+
+        try:
+            levels = int(tags["building:levels"])
+        except (KeyError, ValueError):
+            levels = None
+
+        try:
+            height = int(float(tags["height"]))
+        except (KeyError, ValueError):
+            height = None
+
+        b = {
+            "x": x_coords, 
+            "y": y_coords, 
+            "is_part": is_building_part, 
+            "id": building["id"],
+        }
+
+        if height is not None:
+            b["height"] = height
+        if levels is not None:
+            b["levels"] = levels
+        if material is not None:
+            b["material"] = material
+
+        print('building successfully parsed')
+        with self.buildings_lock:
+            self.res_buildings.append(b)
+
+    def process_area(self, area):
+        tags = area["tags"]
+        surface = None
+        if "surface" in tags and tags["surface"] in SURFACES:
+            surface = tags["surface"]
+        elif "natural" in tags:
+            if tags["natural"] == "water":
+                surface = "water"
+            else:
+                surface = "natural"
+        elif "amenity" in tags:
+            if tags["amenity"] in SURFACES:
+                surface = tags["amenity"]
+            else:
+                surface = "amenity"
+        elif "leisure" in tags:
+            if tags["leisure"] in SURFACES:
+                surface = tags["leisure"]
+            else:
+                surface = "leisure"
+        elif "landuse" in tags:
+            if tags["landuse"] == "residential":
+                surface = "residential_landuse"  # "residential" is also a highway type
+            elif tags["landuse"] == "reservoir":
+                surface = "water"
+            elif tags["landuse"] in SURFACES:
+                surface = tags["landuse"]
+            else:
+                surface = "landuse"
+        elif "railway" in tags:
+            if tags["railway"] in RAIL_TYPES:
+                surface = "rail_track"
+            else:
+                surface = "railway_misc"
+        if surface is None:
+            print_element("Ignored, could not determine surface:", area)
+            return
+        x_coords, y_coords = self.node_ids_to_node_positions(area["nodes"])
+        self.update_min_max(x_coords, y_coords)
+
+        with self.areas_lock:
+            self.res_areas.append({"x": x_coords, "y": y_coords, "surface": surface, "id": area["id"]})
+
+    def process_highway(self, highway):
+        tags = highway["tags"]
+        if tags["highway"] in SURFACES:
+            surface = tags["highway"]
+        elif "surface" in tags and tags["surface"] in SURFACES:
+            surface = tags["surface"]
+        else:
+            surface = "highway"
+            print_element("Default highway:", highway)
+
+        layer = tags.get("layer", 0)
+        try:
+            layer = int(layer)
+        except ValueError:
+            layer = 0
+        if "tunnel" in tags and tags["tunnel"] != "building_passage":
+            return
 
 
-min_x = None
-max_x = None
-min_y = None
-max_y = None
-RAIL_TYPES = ["rail", "tram", "light_rail", "subway", "funicular"]
+        x_coords, y_coords = self.node_ids_to_node_positions(highway["nodes"])
+        self.update_min_max(x_coords, y_coords)
+        with self.highways_lock:
+            self.res_highways.append({"x": x_coords, "y": y_coords, "surface": surface, "layer": layer, "type": tags["highway"], "id": highway["id"]})
 
-def update_min_max(x_coords, y_coords):
-    global min_x, max_x, min_y, max_y
-    min_x = min(x_coords) if min_x is None else min(min_x, *x_coords)
-    max_x = max(x_coords) if max_x is None else max(max_x, *x_coords)
-    min_y = min(y_coords) if min_y is None else min(min_y, *y_coords)
-    max_y = max(y_coords) if max_y is None else max(max_y, *y_coords)
-
-def process_barrier(barrier):
-    if barrier["tags"]["barrier"] in DECORATIONS:
-        deco = barrier["tags"]["barrier"]
-    else:
-        deco = "barrier"
-        print_element("Default barrier:", barrier)
-    x_coords, y_coords = node_ids_to_node_positions(barrier["nodes"])
-    update_min_max(x_coords, y_coords)
-    with decorations_lock:
-        res_decorations[deco].append({"x": x_coords, "y": y_coords})
-
-def process_building(building):
-    x_coords, y_coords = node_ids_to_node_positions(building["nodes"])
-    if len(x_coords) < 2:
-        print_element(f"Ignored, only {len(x_coords)} nodes:", building)
-
-    tags = building["tags"]
-    material = None
-
-    if "building:material" in tags:
-        if tags["building:material"] == "brick":
-            material = "brick"
-        else:
-            print_element("Unrecognized building:material", building)
-    is_building_part = "building:part" in tags
-
-    try:
-        levels = int(tags["building:levels"])
-    except (KeyError, ValueError):
-        levels = None
-
-    try:
-        height = int(float(tags["height"]))
-    except (KeyError, ValueError):
-        height = None
-    else:
-        height = min(height, 255)
-    
-    b = {
-        "x": x_coords, 
-        "y": y_coords, 
-        "is_part": is_building_part, 
-    }
-
-    if height is not None:
-        b["height"] = height
-    if levels is not None:
-        b["levels"] = levels
-    if material is not None:
-        b["material"] = material
-    
-    print('building successfully parsed')
-    with buildings_lock:
-        res_buildings.append(b)
-
-def process_area(area):
-    tags = area["tags"]
-    surface = None
-    if "surface" in tags and tags["surface"] in SURFACES:
-        surface = tags["surface"]
-    elif "natural" in tags:
-        if tags["natural"] == "water":
-            surface = "water"
-        else:
-            surface = "natural"
-    elif "amenity" in tags:
-        if tags["amenity"] in SURFACES:
-            surface = tags["amenity"]
-        else:
-            surface = "amenity"
-    elif "leisure" in tags:
-        if tags["leisure"] in SURFACES:
-            surface = tags["leisure"]
-        else:
-            surface = "leisure"
-    elif "landuse" in tags:
-        if tags["landuse"] == "residential":
-            surface = "residential_landuse"  # "residential" is also a highway type
-        elif tags["landuse"] == "reservoir":
-            surface = "water"
-        elif tags["landuse"] in SURFACES:
-            surface = tags["landuse"]
-        else:
-            surface = "landuse"
-    elif "railway" in tags:
+    def process_railway(self, railway):
+        tags = railway["tags"]
+        layer = tags.get("layer", 0)
+        try:
+            layer = int(layer)
+        except ValueError:
+            layer = 0
         if tags["railway"] in RAIL_TYPES:
             surface = "rail_track"
+            layer += 1 #other wise they look they are below their surrounding
+        elif tags["railway"] in ["abandoned", "construction", "proposed"]: #theses shouldn't be included
+            return
         else:
             surface = "railway_misc"
-    if surface is None:
-        print_element("Ignored, could not determine surface:", area)
-        return
-    x_coords, y_coords = node_ids_to_node_positions(area["nodes"])
-    update_min_max(x_coords, y_coords)
-
-    with areas_lock:
-        res_areas.append({"x": x_coords, "y": y_coords, "surface": surface})
-
-def process_highway(highway):
-    tags = highway["tags"]
-    if tags["highway"] in SURFACES:
-        surface = tags["highway"]
-    elif "surface" in tags and tags["surface"] in SURFACES:
-        surface = tags["surface"]
-    else:
-        surface = "highway"
-        print_element("Default highway:", highway)
-
-    layer = tags.get("layer", 0)
-    try:
-        layer = int(layer)
-    except ValueError:
-        layer = 0
-    if "tunnel" in tags and tags["tunnel"] != "building_passage":
-        return
-
-
-    x_coords, y_coords = node_ids_to_node_positions(highway["nodes"])
-    update_min_max(x_coords, y_coords)
-    with highways_lock:
-        res_highways.append({"x": x_coords, "y": y_coords, "surface": surface, "layer": layer, "type": tags["highway"]})
-
-def process_railway(railway):
-    tags = railway["tags"]
-    layer = tags.get("layer", 0)
-    try:
-        layer = int(layer)
-    except ValueError:
-        layer = 0
-    if tags["railway"] in RAIL_TYPES:
-        surface = "rail_track"
-        layer += 1 #other wise they look they are below their surrounding
-    elif tags["railway"] in ["abandoned", "construction", "proposed"]: #theses shouldn't be included
-        return
-    else:
-        surface = "railway_misc"
-    if "tunnel" in tags and tags["tunnel"] != "building_passage":
-        return
-
-
-    x_coords, y_coords = node_ids_to_node_positions(railway["nodes"])
-    update_min_max(x_coords, y_coords)
-    #append to highways, because they are treated the same way when generating the map
-    with highways_lock:
-        res_highways.append({"x": x_coords, "y": y_coords, "surface": surface, "layer": layer, "type": surface})
-
-
-
-def process_node(e):
-    t = e["type"]
-    if t != 'node':
-        return
-    blockpos = get_nodepos(e["lat"], e["lon"])
-    node_id_to_blockpos[e["id"]] = blockpos
-    tags = e["tags"]
-
-    if not tags or ("natural" not in tags and "amenity" not in tags and "barrier" not in tags):
-        return
-    if "natural" in tags:
-        if tags["natural"] in DECORATIONS:
-            deco = tags["natural"]
-        else:
-            print_element("Unrecognized natural node:", e)
+        if "tunnel" in tags and tags["tunnel"] != "building_passage":
             return
-    elif "amenity" in tags and tags["amenity"] in DECORATIONS:
-        deco = tags["amenity"]
-    elif "barrier" in tags:
-        if tags["barrier"] in DECORATIONS:
-            deco = tags["barrier"]
-        else:
-            deco = "barrier"
-            print_element("Default barrier:", e)
-    else:
-        print_element("Ignored, could not determine decoration type:", e)
-        return
-    x, y = get_nodepos(e["lat"], e["lon"])
-    update_min_max([x], [y])
-    with decorations_lock:
-        res_decorations[deco].append({"x": x, "y": y})
-
-def process_element(e):
-    t = e["type"]
-    tags = e.get("tags")
-    if t == "way":
-        if not tags:
-            print_element("Ignored, missing tags:", e)
+
+
+        x_coords, y_coords = self.node_ids_to_node_positions(railway["nodes"])
+        self.update_min_max(x_coords, y_coords)
+        #append to highways, because they are treated the same way when generating the map
+        with self.highways_lock:
+            self.res_highways.append({"x": x_coords, "y": y_coords, "surface": surface, "layer": layer, "type": surface, "id": railway["id"]})
+
+
+
+    def process_node(self, e):
+        t = e["type"]
+        if t != 'node':
             return
-        if "area" in tags:
-            process_area(e)
-        elif "highway" in tags:
-            process_highway(e)
-        elif "railway" in tags:
-            process_railway(e)
-        elif "building" in tags or "building:part" in tags:
-            process_building(e)
+        blockpos = self.get_nodepos(e["lat"], e["lon"])
+        self.node_id_to_blockpos[e["id"]] = blockpos
+        tags = e["tags"]
+
+        if not tags or ("natural" not in tags and "amenity" not in tags and "barrier" not in tags):
+            return
+        if "natural" in tags:
+            if tags["natural"] in DECORATIONS:
+                deco = tags["natural"]
+            else:
+                print_element("Unrecognized natural node:", e)
+                return
+        elif "amenity" in tags and tags["amenity"] in DECORATIONS:
+            deco = tags["amenity"]
         elif "barrier" in tags:
-            process_barrier(e)
+            if tags["barrier"] in DECORATIONS:
+                deco = tags["barrier"]
+            else:
+                deco = "barrier"
+                print_element("Default barrier:", e)
         else:
-            process_area(e)
-    #     blockpos = get_nodepos(e["lat"], e["lon"])
-    #     node_id_to_blockpos[e["id"]] = blockpos
-    #     if tags and ("natural" in tags or "amenity" in tags or "barrier" in tags):
-    #         process_node(e)
-    elif t != "node":
-        print(f"Ignoring element with unknown type '{t}'")
-
-
-
-
-
-with ThreadPoolExecutor() as executor:
-    res_areas = []
-    res_buildings = []
-    res_decorations = defaultdict(list)
-    res_highways = []
-    # We need to process nodes first to know the positions of the different node blocks
-    # stored in node_id_to_blockpos
-    # possible alternative: sort data['elements'] so that all nodes appear first
-    # then process everything in one iteration through data['elements']
-    # but: is that really more efficient?
-    executor.map(process_node, data["elements"])
-    executor.map(process_element, data["elements"])
-
-print(f"\nfrom {min_x},{min_y} to {max_x},{max_y} (size: {max_x-min_x+1},{max_y-min_y+1})")
-
-output_data = orjson.dumps({
-    "min_x": min_x,
-    "max_x": max_x, 
-    "min_y": min_y,
-    "max_y": max_y,
-    "areas": res_areas,
-    "buildings": res_buildings,
-    "decorations": dict(res_decorations),
-    "highways": res_highways
-}, option=orjson.OPT_INDENT_2)  # Pretty-print with indentation
-
-# Write the serialized byte string to the output file
-args.output.write(output_data.decode("utf-8"))
+            print_element("Ignored, could not determine decoration type:", e)
+            return
+        x, y = blockpos
+        self.update_min_max([x], [y])
+        with self.decorations_lock:
+            self.res_decorations[deco].append({"x": x, "y": y, "id": e["id"]})
+
+    def process_element(self, e):
+        t = e["type"]
+        tags = e.get("tags")
+        if t == "way":
+            if not tags:
+                print_element("Ignored, missing tags:", e)
+                return
+            if "area" in tags:
+                self.process_area(e)
+            elif "highway" in tags:
+                self.process_highway(e)
+            elif "railway" in tags:
+                self.process_railway(e)
+            elif "building" in tags or "building:part" in tags:
+                self.process_building(e)
+            elif "barrier" in tags:
+                self.process_barrier(e)
+            else:
+                self.process_area(e)
+        #     blockpos = self.get_nodepos(e["lat"], e["lon"])
+        #     self.node_id_to_blockpos[e["id"]] = blockpos
+        #     if tags and ("natural" in tags or "amenity" in tags or "barrier" in tags):
+        #         process_node(e)
+        elif t != "node":
+            print(f"Ignoring element with unknown type '{t}'")
+
+    def parse(self, elements):
+        # nodes are processed first to know the positions of the nodes of all ways
+        with ThreadPoolExecutor() as executor:
+            executor.map(self.process_node, elements)
+        with ThreadPoolExecutor() as executor:
+            executor.map(self.process_element, elements)
+
+    def features(self):
+        bounds = None if self.min_x is None else (self.min_x, self.max_x, self.min_y, self.max_y)
+
+        def ordered(features):
+            # the threads append in any order; sort by element (nodes before ways), so that the same data always
+            # results in the same features and unchanged features keep their order relative to each other
+            return FeatureColumns.from_dicts(sorted(features, key=lambda d: (type(d["x"]) is list, d["id"])))
+        return Features(
+            areas=ordered(self.res_areas),
+            highways=ordered(self.res_highways),
+            buildings=ordered(self.res_buildings),
+            decorations={deco: ordered(ds) for deco, ds in sorted(self.res_decorations.items())},
+            bounds=bounds,
+        )
+
+
+def read_osm(data, crs=25832):
+    """Convert OSM data (the parsed Overpass API JSON output, a dict with "elements") to Features in the given CRS."""
+    parser = OsmParser(crs)
+    parser.parse(data["elements"])
+    return parser.features()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parse OSM data")
+    parser.add_argument("file", type=argparse.FileType("r", encoding="utf-8"), help="GeoJSON file with OSM data")
+    parser.add_argument("--output", "-o", type=argparse.FileType("w"), help="Output file. Defaults to parsed_data/features_osm.json", default="./parsed_data/features_osm.json")
+    parser.add_argument("--crs", "-c", type=int, help="Coordinates Reference system, needs to be cartesian and the same as the one coordinate given later to generate_map.py", default=25832)
+
+    args = parser.parse_args(argv)
+
+    features = read_osm(orjson.loads(args.file.read()), args.crs)
+    min_x, max_x, min_y, max_y = features.bounds
+    print(f"\nfrom {min_x},{min_y} to {max_x},{max_y} (size: {max_x-min_x+1},{max_y-min_y+1})")
+
+    output_data = orjson.dumps(features.to_json(), option=orjson.OPT_INDENT_2)  # Pretty-print with indentation
+
+    # Write the serialized byte string to the output file
+    args.output.write(output_data.decode("utf-8"))
+
+
+if __name__ == "__main__":
+    main()
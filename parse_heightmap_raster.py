@@ -0,0 +1,183 @@
+import argparse
+import math
+import os.path
+
+import numpy as np
+
+from _heightmap import write_heightmap
+from catalog import add_catalog_arguments, catalog_files
+from parse_heightmap_xyz import smooth_heightmap
+
+
+# GeoTIFF tags and keys
+MODEL_PIXEL_SCALE_TAG = 33550
+MODEL_TIEPOINT_TAG = 33922
+MODEL_TRANSFORMATION_TAG = 34264
+GEO_KEY_DIRECTORY_TAG = 34735
+GDAL_NODATA_TAG = 42113
+GT_RASTER_TYPE_GEO_KEY = 1025
+RASTER_PIXEL_IS_POINT = 2
+
+
+def geotiff_georeference(page):
+    """
+    Georeferencing of a GeoTIFF page (tifffile.TiffPage).
+    Returns the coordinates of the center of the upper left pixel and the pixel size in x and y direction.
+    """
+    tags = page.tags
+    if MODEL_TRANSFORMATION_TAG in tags:
+        m = tags[MODEL_TRANSFORMATION_TAG].value
+        if m[1] or m[4]:
+            raise ValueError("rotated rasters are not supported")
+        scale_x, scale_y = m[0], -m[5]
+        corner_x, corner_y = m[3], m[7]
+    elif MODEL_TIEPOINT_TAG in tags and MODEL_PIXEL_SCALE_TAG in tags:
+        i, j, _, x, y, _ = tags[MODEL_TIEPOINT_TAG].value[:6]
+        scale_x, scale_y = tags[MODEL_PIXEL_SCALE_TAG].value[:2]
+        corner_x, corner_y = x - i*scale_x, y + j*scale_y
+    else:
+        raise ValueError("missing GeoTIFF georeferencing tags (ModelTiepointTag and ModelPixelScaleTag, or ModelTransformationTag)")
+
+    pixel_is_point = False
+    if GEO_KEY_DIRECTORY_TAG in tags:
+        keys = tags[GEO_KEY_DIRECTORY_TAG].value
+        # header (4 values), followed by (key id, location, count, value) for every key
+        for n in range(keys[3]):
+            key_id, location, _, value = keys[4+4*n:8+4*n]
+            if key_id == GT_RASTER_TYPE_GEO_KEY and location == 0:
+                pixel_is_point = value == RASTER_PIXEL_IS_POINT
+    if not pixel_is_point:
+        # the coordinates refer to the corner of the pixel
+        corner_x, corner_y = corner_x + scale_x/2, corner_y - scale_y/2
+    return corner_x, corner_y, scale_x, scale_y
+
+
+def raster_position(x, y, height):
+    """
+    Integer position of the first value (southernmost row, westernmost column) of a raster with `height` rows,
+    given the coordinates of the center of its upper left pixel. Coordinates are truncated like in read_xyz(),
+    so a pixel covering x..x+1 gets position x; the tolerance absorbs floating point errors of the georeferencing.
+    """
+    return math.floor(x + 1e-6), math.floor(y + 1e-6)-height+1
+
+
+def read_geotiff(file):
+    """
+    Read the first image of a GeoTIFF file (path). It is memory-mapped if it is stored uncompressed and contiguously.
+    Returns the values (first row is the northernmost one), the coordinates of the center of the upper left pixel,
+    the pixel size in x and y direction and the nodata value (or None).
+    """
+    import tifffile
+
+    with tifffile.TiffFile(file) as tif:
+        page = tif.pages[0]
+        georeference = geotiff_georeference(page)
+        nodata = page.tags[GDAL_NODATA_TAG].value if GDAL_NODATA_TAG in page.tags else None
+        if page.is_memmappable:
+            values = tifffile.memmap(file, page=0, mode="r")
+        else:
+            # tiled or compressed
+            values = page.asarray()
+    if values.ndim != 2:
+        raise ValueError(f"{file}: expected a raster with one band, got shape {values.shape}")
+    return (values, *georeference, float(nodata) if nodata not in (None, "") else None)
+
+
+def read_world_file(path):
+    """
+    Read an ESRI world file (6 lines: pixel size x, rotation, rotation, -pixel size y,
+    x and y coordinate of the center of the upper left pixel).
+    """
+    with open(path) as f:
+        a, d, b, e, c, f_ = (float(line) for line in f.read().split())
+    if b or d:
+        raise ValueError("rotated rasters are not supported")
+    return c, f_, a, -e
+
+
+def read_raw_grid(file, dtype, width, nodata=None):
+    """
+    Memory-map a raw binary grid (path) of `dtype` values, `width` values per row, northernmost row first.
+    It is georeferenced by a world file next to it (same name with ".wld" appended or replacing the extension).
+    Returns the same values as read_geotiff().
+    """
+    base = os.path.splitext(file)[0]
+    world_files = [p for p in (file + ".wld", base + ".wld", base + ".tfw") if os.path.exists(p)]
+    if not world_files:
+        raise ValueError(f"{file}: missing world file ({file}.wld)")
+    values = np.memmap(file, dtype=np.dtype(dtype), mode="r")
+    if len(values) % width:
+        raise ValueError(f"{file}: size is not a multiple of the row width {width}")
+    return (values.reshape((-1, width)), *read_world_file(world_files[0]), nodata)
+
+
+def read_rasters(files, raw_dtype="<f4", raw_width=None, raw_nodata=None):
+    """
+    Read GeoTIFF (.tif/.tiff) files and raw binary grids (all other files, see read_raw_grid()) with a pixel size
+    of 1 and combine them into one heightmap. Positions not covered by any file, or only by nodata values,
+    get the smallest height.
+    Returns the heights as a (size_y, size_x) uint16 array and the coordinates of its first value, like read_xyz().
+    """
+    tiles = []
+    for file in files:
+        print(os.path.basename(file))
+        if os.path.splitext(file)[1].lower() in (".tif", ".tiff"):
+            values, x, y, scale_x, scale_y, nodata = read_geotiff(file)
+        else:
+            if raw_width is None:
+                raise ValueError(f"{file}: the row width of raw grids is required")
+            values, x, y, scale_x, scale_y, nodata = read_raw_grid(file, raw_dtype, raw_width, raw_nodata)
+        if abs(scale_x-1) > 1e-6 or abs(scale_y-1) > 1e-6:
+            raise ValueError(f"{file}: pixel size is {scale_x}x{scale_y}, but only 1x1 is supported")
+        # the heightmap's first row is the southernmost one
+        tiles.append((values, *raster_position(x, y, values.shape[0]), nodata))
+    if not tiles:
+        raise ValueError("no raster files")
+
+    min_x = min(x for _, x, _, _ in tiles)
+    min_y = min(y for _, _, y, _ in tiles)
+    max_x = max(x+values.shape[1]-1 for values, x, _, _ in tiles)
+    max_y = max(y+values.shape[0]-1 for values, _, y, _ in tiles)
+    size = (max_x-min_x+1, max_y-min_y+1)
+    heights = np.zeros((size[1], size[0]), dtype=np.uint16)
+    valid = np.zeros(heights.shape, dtype=bool)
+    for values, x, y, nodata in tiles:
+        values = np.rint(values[::-1])
+        tile_valid = np.isfinite(values) if nodata is None else (values != nodata) & np.isfinite(values)
+        if tile_valid.any() and (values[tile_valid].min() < 0 or values[tile_valid].max() > 65535):
+            raise ValueError(f"heights must be within 0..65535, got {values[tile_valid].min()}..{values[tile_valid].max()}")
+        window = heights[y-min_y:y-min_y+values.shape[0], x-min_x:x-min_x+values.shape[1]]
+        window[tile_valid] = values[tile_valid]
+        valid[y-min_y:y-min_y+values.shape[0], x-min_x:x-min_x+values.shape[1]] |= tile_valid
+    if not valid.any():
+        raise ValueError("rasters contain only nodata values")
+    heights[~valid] = heights[valid].min()
+    print("min:", (min_x, min_y), "height:", heights.min())
+    print("max:", (max_x, max_y), "height:", heights.max())
+    print("size:", size)
+    return heights, min_x, min_y
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parse GeoTIFF files or raw binary grids and generate a heightmap")
+    parser.add_argument("files", metavar="file", type=str, nargs="*", help="GeoTIFF (.tif, .tiff) files or raw binary grids with a world file (.wld) to process. The pixel size must be 1.")
+    parser.add_argument("--raw-dtype", type=str, help="numpy dtype of the values of raw binary grids. Defaults to <f4 (little-endian float32).", default="<f4")
+    parser.add_argument("--raw-width", type=int, help="Number of values per row of raw binary grids", default=None)
+    parser.add_argument("--raw-nodata", type=float, help="Value that marks missing heights in raw binary grids", default=None)
+    parser.add_argument("--output", "-o", type=argparse.FileType("wb"), help="Output file. Defaults to parsed_data/heightmap.dat", default="./parsed_data/heightmap.dat")
+    parser.add_argument("--medfiltsize", type=int, help="Odd kernel_size integer for scipy.ndimage.median_filter to smoothen the heights. 0 to disable. Defaults to 5.", default=5)
+    parser.add_argument("--uncompressed", action="store_true", help="Store the heights uncompressed. The file gets larger, but generate_map.py can memory-map it instead of decompressing it.")
+    add_catalog_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    files = args.files + catalog_files(parser, args, ("geotiff",))
+    if not files:
+        parser.error("no files to process")
+    a, min_x, min_y = read_rasters(files, args.raw_dtype, args.raw_width, args.raw_nodata)
+    a = smooth_heightmap(a, args.medfiltsize)
+    write_heightmap(args.output, a, min_x, min_y, compress=not args.uncompressed)
+
+
+if __name__ == "__main__":
+    main()
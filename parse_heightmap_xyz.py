@@ -1,57 +1,82 @@
 import argparse
 import os.path
-import zlib
 
 import numpy as np
-from scipy.ndimage import median_filter
-
-from _util import to_bytes
-
-parser = argparse.ArgumentParser(description="Parse DGM1 'XYZ ASCII' files and generate a heightmap")
-parser.add_argument("files", metavar="file", type=argparse.FileType("r", encoding="utf-8"), nargs="+", help=".xyz files to process")
-parser.add_argument("--output", "-o", type=argparse.FileType("wb"), help="Output file. Defaults to parsed_data/heightmap.dat", default="./parsed_data/heightmap.dat")
-parser.add_argument("--medfiltsize", type=int, help="Odd kernel_size integer for scipy.ndimage.median_filter to smoothen the heights. 0 to disable. Defaults to 5.", default=5)
-parser.add_argument("--createimg", action="store_true", help="Create a .png visualization of the heightmap")
-
-args = parser.parse_args()
-
-heights = []
-for file in args.files:
-    print(os.path.basename(file.name))
-    for line in file.readlines():
-        x, y, z = (float(f) for f in line.split())
-        heights.append((int(x), int(y), int(round(z))))
-    file.close()
-
-heights_xy = [(x, y) for x, y, _ in heights]
-min_pos = min(heights_xy)
-max_pos = max(heights_xy)
-z_values = [z for _, _, z in heights]
-min_height = min(z_values)
-max_height = max(z_values)
-size = (max_pos[0]-min_pos[0]+1, max_pos[1]-min_pos[1]+1)
-print("min:", min_pos, "height:", min_height)
-print("max:", max_pos, "height:", max_height)
-print("size:", size)
-
-min_x, min_y = min_pos
-a = np.empty((size[1], size[0]), dtype=np.uint8)
-for x, y, z in heights:
-    a[y-min_y, x-min_x] = z
-
-if args.medfiltsize:
+
+from _heightmap import write_heightmap
+from catalog import add_catalog_arguments, catalog_files
+
+
+def read_xyz(files):
+    """
+    Read DGM1 'XYZ ASCII' files (paths or text file objects) containing one "x y z" line per position.
+    Returns the heights as a (size_y, size_x) uint16 array and the coordinates of its first value.
+    """
+    heights = []
+    for file in files:
+        if isinstance(file, str):
+            file = open(file, "r", encoding="utf-8")
+        print(os.path.basename(file.name))
+        for line in file.readlines():
+            x, y, z = (float(f) for f in line.split())
+            heights.append((int(x), int(y), int(round(z))))
+        file.close()
+
+    heights_xy = [(x, y) for x, y, _ in heights]
+    min_pos = min(heights_xy)
+    max_pos = max(heights_xy)
+    z_values = [z for _, _, z in heights]
+    size = (max_pos[0]-min_pos[0]+1, max_pos[1]-min_pos[1]+1)
+    print("min:", min_pos, "height:", min(z_values))
+    print("max:", max_pos, "height:", max(z_values))
+    print("size:", size)
+    if min(z_values) < 0 or max(z_values) > 65535:
+        raise ValueError(f"heights must be within 0..65535, got {min(z_values)}..{max(z_values)}")
+
+    min_x, min_y = min_pos
+    a = np.empty((size[1], size[0]), dtype=np.uint16)
+    for x, y, z in heights:
+        a[y-min_y, x-min_x] = z
+    return a, min_x, min_y
+
+
+def smooth_heightmap(a, medfiltsize=5):
+    """Apply a median filter with kernel size `medfiltsize` to the heights. 0 disables the filter."""
+    if not medfiltsize:
+        return a
+    from scipy.ndimage import median_filter
     print(a.min())
-    a = median_filter(a, (args.medfiltsize, args.medfiltsize))
+    a = median_filter(a, (medfiltsize, medfiltsize))
     print(a.min())
+    return a
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parse DGM1 'XYZ ASCII' files and generate a heightmap")
+    parser.add_argument("files", metavar="file", type=argparse.FileType("r", encoding="utf-8"), nargs="*", help=".xyz files to process")
+    parser.add_argument("--output", "-o", type=argparse.FileType("wb"), help="Output file. Defaults to parsed_data/heightmap.dat", default="./parsed_data/heightmap.dat")
+    parser.add_argument("--medfiltsize", type=int, help="Odd kernel_size integer for scipy.ndimage.median_filter to smoothen the heights. 0 to disable. Defaults to 5.", default=5)
+    parser.add_argument("--uncompressed", action="store_true", help="Store the heights uncompressed. The file gets larger, but generate_map.py can memory-map it instead of decompressing it.")
+    parser.add_argument("--createimg", action="store_true", help="Create a .png visualization of the heightmap")
+    add_catalog_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    files = args.files + catalog_files(parser, args, ("xyz",))
+    if not files:
+        parser.error("no files to process")
+    a, min_x, min_y = read_xyz(files)
+    min_height, max_height = int(a.min()), int(a.max())
+    a = smooth_heightmap(a, args.medfiltsize)
+
+    out = args.output
+    write_heightmap(out, a, min_x, min_y, compress=not args.uncompressed)
+
+    if args.createimg:
+        print("Writing image...")
+        import imageio
+        imageio.imwrite(out.name + ".png", ((a[::-1]-min_height)*(255/max(max_height-min_height, 1))).astype(np.uint8))
+
 
-out = args.output
-out.write(to_bytes(min_x, 4))
-out.write(to_bytes(min_y, 4))
-out.write(to_bytes(size[0], 2))
-out.write(to_bytes(size[1], 2))
-out.write(zlib.compress(a.tobytes(), 9))
-
-if args.createimg:
-    print("Writing image...")
-    import imageio
-    imageio.imwrite(out.name + ".png", (a[::-1]-min_height)*int(255/(max_height-min_height)))
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import argparse
+
+import orjson
+
+from _features import Features
+from _mapdat import write_map
+from generate_map import generate_map
+from parse_cityjson import read_cityjson
+from parse_features_dxf import read_dxf
+from parse_features_osm import read_osm
+from parse_heightmap_raster import read_rasters
+from parse_heightmap_xyz import read_xyz, smooth_heightmap
+
+
+def run_pipeline(xyz_files=(), osm_file=None, dxf_files=(), dxf_queries=(), cityjson_files=(),
+                 min_x=None, min_y=None, max_x=None, max_y=None, crs=25832, medfiltsize=5, fill=False, processes=None,
+                 raster_files=(), raw_dtype="<f4", raw_width=None, **options):
+    """
+    Parse all input files and generate the map in one process, without writing intermediate files.
+    Features from .dxf files override features of the same type from the OSM file (like passing them to
+    generate_map.py as a later --features file). Remaining `options` are passed to generate_map().
+    The heightmap is read from `xyz_files` or else from `raster_files` (see read_rasters()).
+    Missing bounds are taken from the heightmap, or else from the features.
+    Returns the map array and the coordinates (min_x, min_y) of its first value.
+    """
+    heightmap = None
+    if xyz_files or raster_files:
+        if xyz_files:
+            heights, heightmap_min_x, heightmap_min_y = read_xyz(xyz_files)
+        else:
+            heights, heightmap_min_x, heightmap_min_y = read_rasters(raster_files, raw_dtype, raw_width)
+        heightmap = (smooth_heightmap(heights, medfiltsize), heightmap_min_x, heightmap_min_y)
+        min_x = min_x if min_x is not None else heightmap_min_x
+        max_x = max_x if max_x is not None else heightmap_min_x+heights.shape[1]-1
+        min_y = min_y if min_y is not None else heightmap_min_y
+        max_y = max_y if max_y is not None else heightmap_min_y+heights.shape[0]-1
+
+    features = Features()
+    if osm_file is not None:
+        with open(osm_file, "rb") as f:
+            features.update(read_osm(orjson.loads(f.read()), crs))
+    if dxf_files:
+        features.update(read_dxf(dxf_files, dxf_queries))
+    if features.bounds is not None:
+        min_x = min_x if min_x is not None else features.bounds[0]
+        max_x = max_x if max_x is not None else features.bounds[1]
+        min_y = min_y if min_y is not None else features.bounds[2]
+        max_y = max_y if max_y is not None else features.bounds[3]
+
+    building_spans = read_cityjson(cityjson_files, fill, processes) if cityjson_files else None
+
+    print(f"from {min_x},{min_y} to {max_x},{max_y} (size: {max_x-min_x+1},{max_y-min_y+1})")
+    a = generate_map(min_x, min_y, max_x, max_y, heightmap, features, building_spans, **options)
+    return a, min_x, min_y
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parse all input data and generate a map.dat file in one step, without writing intermediate files")
+    parser.add_argument("--xyz", action="append", help="DGM1 'XYZ ASCII' file (see parse_heightmap_xyz.py)", default=[])
+    parser.add_argument("--raster", action="append", help="GeoTIFF file or raw binary grid (see parse_heightmap_raster.py), instead of --xyz", default=[])
+    parser.add_argument("--raw-dtype", type=str, help="numpy dtype of the values of raw binary --raster files. Defaults to <f4 (little-endian float32).", default="<f4")
+    parser.add_argument("--raw-width", type=int, help="Number of values per row of raw binary --raster files", default=None)
+    parser.add_argument("--osm", type=str, help="JSON file with OSM data (see parse_features_osm.py)", default=None)
+    parser.add_argument("--dxf", action="append", help=".dxf file (see parse_features_dxf.py)", default=[])
+    parser.add_argument("--query", "-q", action="append", nargs=2, metavar=("query", "decoration-name"), help="ezdxf query for the --dxf files, followed by the decoration name id ('tree', 'bush', etc.)", default=[])
+    parser.add_argument("--cityjson", action="append", help="CityJSON .json or .city.jsonl file (see parse_cityjson.py). If used, buildings from --osm are ignored.", default=[])
+    parser.add_argument("--crs", "-c", type=int, help="Coordinates Reference system for the OSM data. Defaults to 25832.", default=25832)
+    parser.add_argument("--medfiltsize", type=int, help="Odd kernel_size integer for scipy.ndimage.median_filter to smoothen the heights. 0 to disable. Defaults to 5.", default=5)
+    parser.add_argument("--fill", action="store_true", help="Fill the CityJSON building's polygons instead of only drawing the outlines")
+    parser.add_argument("--processes", "-j", type=int, help="Number of worker processes for .jsonl files. Defaults to the number of CPUs.", default=None)
+    parser.add_argument("--buildings-base-height", type=int, help="Subtracted from the height of every building. Defaults to 0.", default=0)
+    parser.add_argument("--offsetx", type=int, help="EPSG:25832 x coordinate that will be x=0 in Minetest", default=None)
+    parser.add_argument("--offsetz", type=int, help="EPSG:25832 y coordinate that will be z=0 in Minetest (y is z in Minetest)", default=None)
+    parser.add_argument("--minx", type=int, help="Minimum EPSG:25832 x coordinate", default=None)
+    parser.add_argument("--maxx", type=int, help="Maximum EPSG:25832 x coordinate", default=None)
+    parser.add_argument("--miny", type=int, help="Minimum EPSG:25832 y coordinate (y is z in Minetest)", default=None)
+    parser.add_argument("--maxy", type=int, help="Maximum EPSG:25832 y coordinate (y is z in Minetest)", default=None)
+    parser.add_argument("--noheightreduction", action="store_true", help="Do not subtract the smallest height from every heightmap value")
+    parser.add_argument("--flat", action="store_true", help="Make the world flat, but subtract the heightmap value from each building coordinate")
+    parser.add_argument("--verbose", "-v", action="store_true", help="More debug info")
+    parser.add_argument("--output", "-o", type=str, help="Output file. Defaults to world2minetest/map.dat", default="world2minetest/map.dat")
+
+    args = parser.parse_args(argv)
+
+    if not args.xyz and not args.raster and args.osm is None and not args.dxf:
+        raise argparse.ArgumentTypeError("at least one of --xyz, --raster, --osm or --dxf is required.")
+
+    a, min_x, min_y = run_pipeline(
+        args.xyz, args.osm, args.dxf, args.query, args.cityjson,
+        args.minx, args.miny, args.maxx, args.maxy, args.crs, args.medfiltsize, args.fill, args.processes,
+        args.raster, args.raw_dtype, args.raw_width,
+        flat=args.flat, noheightreduction=args.noheightreduction,
+        buildings_base_height=args.buildings_base_height, verbose=args.verbose,
+    )
+
+    offset_x = args.offsetx-min_x if args.offsetx is not None else 0
+    offset_z = args.offsetz-min_y if args.offsetz is not None else 0
+    if not (0 <= offset_x < a.shape[1] and 0 <= offset_z < a.shape[0]):
+        raise ValueError(f"offset {(args.offsetx, args.offsetz)} is located outside of map")
+    print("offset x:", offset_x, "offset z:", offset_z)
+
+    with open(args.output, "wb") as f:
+        write_map(f, a, offset_x, offset_z)
+
+
+if __name__ == "__main__":
+    main()
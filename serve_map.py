@@ -0,0 +1,241 @@
+import argparse
+import json
+import os
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import BytesIO
+
+from _buildings import read_buildings
+from _features import Features, FeatureColumns
+from _heightmap import read_heightmap_header, read_heightmap
+from _mapdat import write_map
+from generate_map import (
+    generate_map, render_region, load_features, map_bounds, heightmap_reduction, dependency_window,
+    feature_bboxes, intersecting, changed_block_positions, encode_changed_blocks,
+)
+
+
+class MapState:
+    """
+    The inputs and the generated map array of the map service. Everything stays in memory between requests,
+    so changing a region only generates that region again.
+    `bounds` is (min_x, min_y, max_x, max_y); `offset_x` and `offset_z` are relative to min_x and min_y.
+    """
+
+    def __init__(self, bounds, offset_x, offset_z, heightmap=None, features=None, building_spans=None,
+                 flat=False, noheightreduction=False, buildings_base_height=0):
+        self.bounds = bounds
+        self.offset_x = offset_x
+        self.offset_z = offset_z
+        self.heightmap = heightmap
+        self.features = features if features is not None else Features()
+        self.building_spans = building_spans
+        self.options = {"flat": flat, "buildings_base_height": buildings_base_height}
+        # the heights must be reduced by the same value in every region
+        self.heightmap_sub = heightmap_reduction(heightmap, *bounds) if not (flat or noheightreduction) else 0
+        self.a = generate_map(*bounds, heightmap, self.features, building_spans, heightmap_sub=self.heightmap_sub, **self.options)
+        # (x, z) positions of blocks that changed since they were last exported with incr data
+        self.dirty_blocks = set()
+
+    def override_features(self, overrides, min_x, min_y, max_x, max_y):
+        """
+        Replace features within min_x..max_x, min_y..max_y. `overrides` has the structure of a features .json file;
+        for every feature type it contains (including every decoration name), all features of that type that
+        intersect the bounding box are removed and the given ones are added.
+        Returns the bounding box of all positions that may have changed, including the positions of features
+        that use heights of the changed positions (see dependency_window()).
+        """
+        bbox = (min_x, min_y, max_x, max_y)
+        region = list(bbox)
+        for key in Features.CATEGORIES:
+            if key not in overrides:
+                continue
+            old = getattr(self.features, key)
+            new = FeatureColumns.from_dicts(overrides[key])
+            old_bboxes = feature_bboxes(Features(**{key: old}))[key]
+            new_bboxes = feature_bboxes(Features(**{key: new}))[key]
+            setattr(self.features, key, self._replace(old, new, old_bboxes, new_bboxes, bbox, region))
+        for name, decorations in (overrides.get("decorations") or {}).items():
+            old = self.features.decorations.get(name, FeatureColumns())
+            new = FeatureColumns.from_dicts(decorations)
+            self.features.decorations[name] = self._replace(old, new, old.bboxes(), new.bboxes(), bbox, region)
+        return dependency_window(self.features, self.bounds, *region, osm_buildings=self.building_spans is None)
+
+    @staticmethod
+    def _replace(old, new, old_bboxes, new_bboxes, bbox, region):
+        # replace the features of `old` that intersect `bbox` with `new` and grow `region` to all changed positions
+        removed = intersecting(old_bboxes, *bbox)
+        changed = [old_bboxes[:, removed], new_bboxes[:, new.counts > 0]]
+        for bboxes in changed:
+            if bboxes.shape[1]:
+                region[0] = min(region[0], int(bboxes[0].min()))
+                region[1] = min(region[1], int(bboxes[1].min()))
+                region[2] = max(region[2], int(bboxes[2].max()))
+                region[3] = max(region[3], int(bboxes[3].max()))
+        return FeatureColumns.concatenate([old.subset(~removed), new])
+
+    def render(self, min_x, min_y, max_x, max_y):
+        """Generate min_x..max_x, min_y..max_y again. Returns the positions of the blocks that changed."""
+        x1, y1 = max(min_x, self.bounds[0]) - self.bounds[0], max(min_y, self.bounds[1]) - self.bounds[1]
+        x2, y2 = min(max_x, self.bounds[2]) - self.bounds[0], min(max_y, self.bounds[3]) - self.bounds[1]
+        if x1 > x2 or y1 > y2:
+            return []
+        new = render_region(
+            self.bounds, min_x, min_y, max_x, max_y, self.heightmap, self.features, self.building_spans,
+            heightmap_sub=self.heightmap_sub, **self.options
+        )
+        old = self.a[y1:y2+1, x1:x2+1]
+        changed_blocks = changed_block_positions((new != old).any(axis=2), self.offset_x-x1, self.offset_z-y1)
+        old[:] = new
+        self.dirty_blocks.update(changed_blocks)
+        return changed_blocks
+
+    def export(self, f, incr=False, bbox=None):
+        """
+        Write map.dat to the file object `f`. If `incr` is set, the blocks that changed since the last
+        incremental export (only those within `bbox` = (min_x, min_y, max_x, max_y), if given) are added as incr data.
+        Returns the exported block positions; they stay in `dirty_blocks` until they are passed to exported().
+        """
+        blocks = []
+        if incr:
+            blocks = sorted(self.dirty_blocks)
+            if bbox is not None:
+                # block positions are relative to the offset
+                bx1, bz1 = (bbox[0]-self.bounds[0]-self.offset_x)//16, (bbox[1]-self.bounds[1]-self.offset_z)//16
+                bx2, bz2 = (bbox[2]-self.bounds[0]-self.offset_x)//16, (bbox[3]-self.bounds[1]-self.offset_z)//16
+                blocks = [(x, z) for x, z in blocks if bx1 <= x <= bx2 and bz1 <= z <= bz2]
+        write_map(f, self.a, self.offset_x, self.offset_z, encode_changed_blocks(blocks) if incr else b"")
+        return blocks
+
+    def exported(self, blocks):
+        """Remove the block positions returned by export() from `dirty_blocks` once the file was written successfully."""
+        self.dirty_blocks.difference_update(blocks)
+
+
+class MapRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /status: size and bounds of the map, number of changed blocks that weren't exported yet.
+    GET /map.dat: the current map.dat (without incr data).
+    POST /render {"bbox": [min_x, min_y, max_x, max_y], "features": {...}}: replace the features within bbox
+        (see MapState.override_features(); "features" is optional) and generate the affected region again.
+    POST /export {"incr": true, "bbox": [min_x, min_y, max_x, max_y]}: write map.dat to --output
+        (all arguments optional). With "incr", the changed blocks are added as incr data,
+        so they can be loaded using the '/w2mt:incr' command.
+    POST requests must have the Content-Type application/json, so web pages can't send them without asking.
+    """
+    state = None
+    output = None
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        state = self.state
+        if self.path == "/status":
+            self.send_json({
+                "bounds": state.bounds,
+                "offset": [state.offset_x, state.offset_z],
+                "size": [state.a.shape[1], state.a.shape[0]],
+                "changed_blocks": len(state.dirty_blocks),
+            })
+        elif self.path == "/map.dat":
+            f = BytesIO()
+            state.export(f)
+            body = f.getvalue()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_json({"error": f"unknown path {self.path}"}, 404)
+
+    def do_POST(self):
+        if self.headers.get_content_type() != "application/json":
+            self.send_json({"error": "Content-Type must be application/json"}, 415)
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError as e:
+            self.send_json({"error": f"invalid JSON: {e}"}, 400)
+            return
+        start = time.time()
+        try:
+            if self.path == "/render":
+                region = tuple(request["bbox"])
+                if "features" in request:
+                    region = self.state.override_features(request["features"], *region)
+                changed_blocks = self.state.render(*region)
+                self.send_json({"bbox": region, "changed_blocks": len(changed_blocks), "seconds": time.time()-start})
+            elif self.path == "/export":
+                if "output" in request:
+                    # clients must not choose which file is overwritten
+                    raise ValueError("the output file can only be set with --output")
+                output = self.output
+                # replace the file at once, so the Mod never reads a partially written file
+                with open(output + ".tmp", "wb") as f:
+                    blocks = self.state.export(f, request.get("incr", False), request.get("bbox"))
+                os.replace(output + ".tmp", output)
+                self.state.exported(blocks)
+                self.send_json({"output": output, "changed_blocks": len(blocks), "seconds": time.time()-start})
+            else:
+                self.send_json({"error": f"unknown path {self.path}"}, 404)
+        except (KeyError, TypeError, ValueError) as e:
+            self.send_json({"error": f"invalid request: {e!r}"}, 400)
+        except OSError as e:
+            self.send_json({"error": f"can't write {self.output}: {e}"}, 500)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Keep a map in memory and generate changed regions again on request")
+    parser.add_argument("--heightmap", type=argparse.FileType("rb"), help="Heightmap file generated by parse_heightmap_xyz.py", default=None)
+    parser.add_argument("--features", action="append", type=argparse.FileType("r"), help="features.json files generated by parse_features_osm.py or parse_features_dxf.py. Features of the same type in files specified earlier will be overridden.", default=None)
+    parser.add_argument("--buildings", type=argparse.FileType("rb"), help="buildings_cityjson.dat file generated by parse_cityjson.py. If this argument is used, buildings stored in a --features file will be ignored.", default=None)
+    parser.add_argument("--buildings-base-height", type=int, help="Subtracted from the height of every building. Defaults to 0.", default=0)
+    parser.add_argument("--offsetx", type=int, help="EPSG:25832 x coordinate that will be x=0 in Minetest", default=None)
+    parser.add_argument("--offsetz", type=int, help="EPSG:25832 y coordinate that will be z=0 in Minetest (y is z in Minetest)", default=None)
+    parser.add_argument("--minx", type=int, help="Minimum EPSG:25832 x coordinate", default=None)
+    parser.add_argument("--maxx", type=int, help="Maximum EPSG:25832 x coordinate", default=None)
+    parser.add_argument("--miny", type=int, help="Minimum EPSG:25832 y coordinate (y is z in Minetest)", default=None)
+    parser.add_argument("--maxy", type=int, help="Maximum EPSG:25832 y coordinate (y is z in Minetest)", default=None)
+    parser.add_argument("--noheightreduction", action="store_true", help="Do not subtract the smallest height from every heightmap value")
+    parser.add_argument("--flat", action="store_true", help="If a --heightmap is specified, make the world flat, but subtract the heightmap value from each building coordinate")
+    parser.add_argument("--output", "-o", type=str, help="Output file of /export requests. Defaults to world2minetest/map.dat", default="world2minetest/map.dat")
+    parser.add_argument("--host", type=str, help="Address to listen on. Defaults to 127.0.0.1", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="Port to listen on. Defaults to 8765", default=8765)
+
+    args = parser.parse_args(argv)
+
+    if (args.heightmap is None or args.flat) and args.features is None:
+        raise argparse.ArgumentTypeError("at least one of --heightmap (without --flat) or --features is required.")
+
+    heightmap_header = read_heightmap_header(args.heightmap) if args.heightmap is not None else None
+    features = load_features(args.features or [])
+    bounds = map_bounds(args.minx, args.miny, args.maxx, args.maxy, heightmap_header, features)
+    heightmap = read_heightmap(args.heightmap, heightmap_header, *bounds) if heightmap_header is not None else None
+    building_spans = read_buildings(args.buildings) if args.buildings is not None else None
+    offset_x = args.offsetx-bounds[0] if args.offsetx is not None else 0
+    offset_z = args.offsetz-bounds[1] if args.offsetz is not None else 0
+
+    print(f"from {bounds[0]},{bounds[1]} to {bounds[2]},{bounds[3]}; generating the whole map")
+    MapRequestHandler.state = MapState(
+        bounds, offset_x, offset_z, heightmap, features, building_spans,
+        flat=args.flat, noheightreduction=args.noheightreduction, buildings_base_height=args.buildings_base_height,
+    )
+    MapRequestHandler.output = args.output
+
+    server = HTTPServer((args.host, args.port), MapRequestHandler)
+    print(f"listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
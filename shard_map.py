@@ -0,0 +1,291 @@
+import argparse
+import json
+import zlib
+
+import numpy as np
+
+from _buildings import read_buildings
+from _heightmap import read_heightmap_header, read_heightmap, read_heightmap_min
+from _mapdat import (
+    read_map, write_encoded_map, encode_map_layer, layer_top, encode_layer, decode_layer, narrow_layer, widen_layer,
+    TILE_SIZE, ENCODING_RAW, STORAGE_16, COMPRESSION_LEVEL,
+)
+from _util import to_bytes, from_bytes
+from generate_map import (
+    LAYER_COUNT, load_features, map_bounds, dependency_window, render_region,
+    changed_positions, changed_block_positions, encode_changed_blocks,
+)
+
+
+# shard files: the part of the map array generated by one shard.
+# magic, version, x and y index of the first value in the map array, size x, size y, layer count, tile size,
+# followed by every layer as in map.dat version 3 (encoding, storage, length, zlib-compressed tiles).
+SHARD_MAGIC = b"W2MS"
+SHARD_VERSION = 2
+PLAN_VERSION = 1
+
+
+def plan_shards(bounds, offset_x, offset_z, shard_blocks):
+    """
+    Split the map into rectangles of shard_blocks x shard_blocks mapblocks (16x16 positions, aligned to the offset).
+    Returns the bounding boxes (min_x, min_y, max_x, max_y) of all shards; the shards at the edges are smaller.
+    """
+    size_x, size_z = bounds[2]-bounds[0]+1, bounds[3]-bounds[1]+1
+
+    def ranges(size, offset):
+        # index ranges of the shards along one axis
+        step = 16*shard_blocks
+        start = offset + (-offset)//16*16
+        res = []
+        while start < size:
+            res.append((max(start, 0), min(start+step, size)-1))
+            start += step
+        return res
+    return [
+        (bounds[0]+x1, bounds[1]+z1, bounds[0]+x2, bounds[1]+z2)
+        for z1, z2 in ranges(size_z, offset_z) for x1, x2 in ranges(size_x, offset_x)
+    ]
+
+
+def generate_shard(plan, shard):
+    """Generate shard number `shard` of `plan`. Returns the shard's part of the map array."""
+    bounds = tuple(plan["bounds"])
+    bbox = tuple(plan["shards"][shard])
+    features = load_features(plan["features"])
+    # only read the inputs that can change the shard
+    window = dependency_window(features, bounds, *bbox, osm_buildings=plan["buildings"] is None)
+    heightmap = None
+    if plan["heightmap"] is not None:
+        with open(plan["heightmap"], "rb") as f:
+            heightmap = read_heightmap(f, read_heightmap_header(f), *window)
+    building_spans = None
+    if plan["buildings"] is not None:
+        with open(plan["buildings"], "rb") as f:
+            building_spans = read_buildings(f, window)
+    return render_region(
+        bounds, *bbox, heightmap, features, building_spans, heightmap_sub=plan["heightmap_sub"],
+        flat=plan["flat"], buildings_base_height=plan["buildings_base_height"],
+    )
+
+
+def write_shard(f, a, x, y):
+    f.write(SHARD_MAGIC)
+    f.write(to_bytes(SHARD_VERSION, 1))
+    f.write(to_bytes(x, 4))
+    f.write(to_bytes(y, 4))
+    f.write(to_bytes(a.shape[1], 4))
+    f.write(to_bytes(a.shape[0], 4))
+    f.write(to_bytes(a.shape[2], 1))
+    f.write(to_bytes(TILE_SIZE, 1))
+    for i in range(a.shape[2]):
+        storage, layer = narrow_layer(a[:, :, i])
+        compressed = zlib.compress(encode_layer(layer, TILE_SIZE), COMPRESSION_LEVEL)
+        f.write(to_bytes(ENCODING_RAW, 1))
+        f.write(to_bytes(storage, 1))
+        f.write(to_bytes(len(compressed), 4))
+        f.write(compressed)
+
+
+def read_shard_header(f):
+    """Read the header of a shard file object. Returns a dict with the x and y index of its first value in the map array and its size."""
+    if f.read(len(SHARD_MAGIC)) != SHARD_MAGIC:
+        raise ValueError("not a shard file")
+    version = from_bytes(f.read(1))
+    if version != SHARD_VERSION:
+        # shards are only kept until they are merged, so older versions aren't supported
+        raise ValueError(f"Can't read shard; it has version {version} instead of {SHARD_VERSION}")
+    x, y, size_x, size_y = (from_bytes(f.read(4)) for _ in range(4))
+    return {
+        "x": x,
+        "y": y,
+        "size_x": size_x,
+        "size_y": size_y,
+        "layer_count": from_bytes(f.read(1)),
+        "tile_size": from_bytes(f.read(1)),
+    }
+
+
+def read_shard_layer(f, header, index):
+    """Read layer number `index` of a shard file object whose header was read by read_shard_header()."""
+    for _ in range(index):
+        f.seek(2, 1)
+        f.seek(from_bytes(f.read(4)), 1)
+    encoding = from_bytes(f.read(1))
+    storage = from_bytes(f.read(1))
+    length = from_bytes(f.read(4))
+    dtype = np.uint16 if storage == STORAGE_16 else np.uint8
+    layer = decode_layer(zlib.decompress(f.read(length)), header["size_y"], header["size_x"], header["tile_size"], encoding, dtype)
+    return widen_layer(layer, storage)
+
+
+def read_shard(f):
+    """Read a shard file object. Returns the array and the x and y index of its first value in the map array."""
+    header = read_shard_header(f)
+    start = f.tell()
+    a = np.empty((header["size_y"], header["size_x"], header["layer_count"]), dtype=np.uint16)
+    for i in range(header["layer_count"]):
+        f.seek(start)
+        a[:, :, i] = read_shard_layer(f, header, i)
+    return a, header["x"], header["y"]
+
+
+def check_shards(plan, shard_files):
+    """Read the headers of the shard files (paths) of `plan` and check that they cover every position exactly once."""
+    bounds = plan["bounds"]
+    size_x, size_y = bounds[2]-bounds[0]+1, bounds[3]-bounds[1]+1
+    headers = []
+    for path in shard_files:
+        with open(path, "rb") as f:
+            header = read_shard_header(f)
+        if header["layer_count"] != LAYER_COUNT:
+            raise ValueError(f"{path} has {header['layer_count']} layers instead of {LAYER_COUNT}")
+        if header["x"]+header["size_x"] > size_x or header["y"]+header["size_y"] > size_y:
+            raise ValueError(f"{path} is located outside of the map")
+        for other_path, other in zip(shard_files, headers):
+            if (header["x"] < other["x"]+other["size_x"] and other["x"] < header["x"]+header["size_x"]
+                    and header["y"] < other["y"]+other["size_y"] and other["y"] < header["y"]+header["size_y"]):
+                raise ValueError(f"{path} overlaps {other_path}")
+        headers.append(header)
+    # the shards don't overlap, so they cover the map if their sizes add up
+    uncovered = size_x*size_y - sum(h["size_x"]*h["size_y"] for h in headers)
+    if uncovered:
+        raise ValueError(f"{uncovered} positions aren't covered by any shard")
+
+
+def merge_shard_layer(plan, shard_files, index):
+    """Stitch layer number `index` of the shard files (paths) of `plan`, which were checked by check_shards()."""
+    bounds = plan["bounds"]
+    layer = np.empty((bounds[3]-bounds[1]+1, bounds[2]-bounds[0]+1), dtype=np.uint16)
+    for path in shard_files:
+        with open(path, "rb") as f:
+            header = read_shard_header(f)
+            layer[header["y"]:header["y"]+header["size_y"], header["x"]:header["x"]+header["size_x"]] = read_shard_layer(f, header, index)
+    return layer
+
+
+def merge_shards(plan, shard_files, f, old_map=None):
+    """
+    Stitch the shard files (paths) of `plan` into map.dat and write it to the file object `f`. Every position must be
+    covered exactly once. Only one layer of the map is in memory at a time.
+    If `old_map` (the result of read_map()) is given, the blocks that changed are added as incr data.
+    Returns the positions of these blocks.
+    """
+    check_shards(plan, shard_files)
+    bounds = plan["bounds"]
+    offset_x, offset_z = plan["offset"]
+    layers = []
+    floor_height, top_height = 0, 0
+    diff = None
+    if old_map is not None:
+        old_header, old_a, _ = old_map
+        diff = np.zeros((bounds[3]-bounds[1]+1, bounds[2]-bounds[0]+1), dtype=bool)
+    for i in range(LAYER_COUNT):
+        layer = merge_shard_layer(plan, shard_files, i)
+        if i == 0:
+            floor_height = layer[offset_z, offset_x]
+        top_height = max(top_height, layer_top(layer, i))
+        if diff is not None:
+            # layers the previous map doesn't have were 0
+            old_layer = old_a[:, :, i] if i < old_a.shape[2] else np.zeros(old_a.shape[:2], dtype=np.uint16)
+            diff |= changed_positions(layer, offset_x, offset_z, old_layer, old_header["offset_x"], old_header["offset_z"])
+        layers.append(encode_map_layer(layer, i))
+        del layer
+    changed_blocks = []
+    if diff is not None:
+        changed_blocks = changed_block_positions(diff, offset_x, offset_z)
+        print("changed blocks:", changed_blocks[:10], "..." if len(changed_blocks) > 10 else "")
+    write_encoded_map(
+        f, layers, bounds[2]-bounds[0]+1, bounds[3]-bounds[1]+1, offset_x, offset_z, floor_height, top_height,
+        encode_changed_blocks(changed_blocks) if old_map is not None else b"",
+    )
+    return changed_blocks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate map.dat in shards that can run on separate machines from shared inputs. The result is the same as with generate_map.py.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    plan_parser = subparsers.add_parser("plan", help="Split the map into shards and write the plan used by the other commands")
+    plan_parser.add_argument("--heightmap", type=str, help="Heightmap file generated by parse_heightmap_xyz.py", default=None)
+    plan_parser.add_argument("--features", action="append", type=str, help="features.json files generated by parse_features_osm.py or parse_features_dxf.py. Features of the same type in files specified earlier will be overridden.", default=None)
+    plan_parser.add_argument("--buildings", type=str, help="buildings_cityjson.dat file generated by parse_cityjson.py. If this argument is used, buildings stored in a --features file will be ignored.", default=None)
+    plan_parser.add_argument("--buildings-base-height", type=int, help="Subtracted from the height of every building. Defaults to 0.", default=0)
+    plan_parser.add_argument("--offsetx", type=int, help="EPSG:25832 x coordinate that will be x=0 in Minetest", default=None)
+    plan_parser.add_argument("--offsetz", type=int, help="EPSG:25832 y coordinate that will be z=0 in Minetest (y is z in Minetest)", default=None)
+    plan_parser.add_argument("--minx", type=int, help="Minimum EPSG:25832 x coordinate", default=None)
+    plan_parser.add_argument("--maxx", type=int, help="Maximum EPSG:25832 x coordinate", default=None)
+    plan_parser.add_argument("--miny", type=int, help="Minimum EPSG:25832 y coordinate (y is z in Minetest)", default=None)
+    plan_parser.add_argument("--maxy", type=int, help="Maximum EPSG:25832 y coordinate (y is z in Minetest)", default=None)
+    plan_parser.add_argument("--noheightreduction", action="store_true", help="Do not subtract the smallest height from every heightmap value")
+    plan_parser.add_argument("--flat", action="store_true", help="If a --heightmap is specified, make the world flat, but subtract the heightmap value from each building coordinate")
+    plan_parser.add_argument("--shard-blocks", type=int, help="Width and height of a shard in mapblocks (16 positions). Defaults to 64.", default=64)
+    plan_parser.add_argument("--output", "-o", type=argparse.FileType("w"), help="Output file. Defaults to parsed_data/shards.json", default="./parsed_data/shards.json")
+
+    generate_parser = subparsers.add_parser("generate", help="Generate one shard")
+    generate_parser.add_argument("plan", type=argparse.FileType("r"), help="Plan created by the plan command")
+    generate_parser.add_argument("--shard", type=int, required=True, help="Number of the shard to generate")
+    generate_parser.add_argument("--output", "-o", type=argparse.FileType("wb"), required=True, help="Output file")
+
+    merge_parser = subparsers.add_parser("merge", help="Merge the generated shards into map.dat")
+    merge_parser.add_argument("plan", type=argparse.FileType("r"), help="Plan created by the plan command")
+    merge_parser.add_argument("shards", metavar="shard", type=str, nargs="+", help="Files created by the generate command")
+    merge_parser.add_argument("--incr", action="store_true", help="Add incremental map information to map.dat (see generate_map.py --incr)")
+    merge_parser.add_argument("--output", "-o", type=str, help="Output file. Defaults to world2minetest/map.dat", default="world2minetest/map.dat")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "plan":
+        if (args.heightmap is None or args.flat) and args.features is None:
+            raise argparse.ArgumentTypeError("at least one of --heightmap (without --flat) or --features is required.")
+        heightmap_header = None
+        if args.heightmap is not None:
+            with open(args.heightmap, "rb") as f:
+                heightmap_header = read_heightmap_header(f)
+        features = load_features(args.features or [])
+        bounds = map_bounds(args.minx, args.miny, args.maxx, args.maxy, heightmap_header, features)
+        if bounds[0] > bounds[2] or bounds[1] > bounds[3]:
+            raise ValueError("map size is invalid")
+        heightmap_sub = 0
+        if args.heightmap is not None and not (args.flat or args.noheightreduction):
+            # the heights must be reduced by the same value in every shard
+            with open(args.heightmap, "rb") as f:
+                heightmap_sub = read_heightmap_min(f, read_heightmap_header(f), *bounds)
+        if args.offsetx is not None and args.offsetz is not None and not (bounds[0] <= args.offsetx <= bounds[2] and bounds[1] <= args.offsetz <= bounds[3]):
+            raise ValueError(f"offset {(args.offsetx, args.offsetz)} is located outside of map")
+        offset_x = args.offsetx-bounds[0] if args.offsetx is not None else 0
+        offset_z = args.offsetz-bounds[1] if args.offsetz is not None else 0
+        shards = plan_shards(bounds, offset_x, offset_z, args.shard_blocks)
+        json.dump({
+            "version": PLAN_VERSION,
+            "bounds": bounds,
+            "offset": [offset_x, offset_z],
+            "heightmap": args.heightmap,
+            "features": args.features or [],
+            "buildings": args.buildings,
+            "buildings_base_height": args.buildings_base_height,
+            "flat": args.flat,
+            "heightmap_sub": heightmap_sub,
+            "shards": shards,
+        }, args.output, indent=2)
+        print(f"{len(shards)} shards")
+
+    elif args.command == "generate":
+        plan = json.load(args.plan)
+        a = generate_shard(plan, args.shard)
+        bbox = plan["shards"][args.shard]
+        with args.output as f:
+            write_shard(f, a, bbox[0]-plan["bounds"][0], bbox[1]-plan["bounds"][1])
+
+    elif args.command == "merge":
+        plan = json.load(args.plan)
+        old_map = None
+        if args.incr:
+            # the previous map is compared layer by layer, but has to be read completely
+            with open(args.output, "rb") as f:
+                old_map = read_map(f)
+        with open(args.output, "wb") as f:
+            merge_shards(plan, args.shards, f, old_map)
+
+
+if __name__ == "__main__":
+    main()
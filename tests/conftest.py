@@ -0,0 +1,82 @@
+import json
+import os
+import random
+import sys
+
+import numpy as np
+import pytest
+
+# the scripts are imported as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def map_inputs(tmp_path):
+    """
+    Small random heightmap.dat, features.json (all feature types) and buildings file around 500000, 5800000.
+    Returns a dict of their paths.
+    """
+    from _buildings import SpanWriter, building_spans
+    from _heightmap import write_heightmap
+
+    rnd = random.Random(1)
+    min_x, min_y, size_x, size_y = 500000, 5800000, 200, 160
+    yy, xx = np.mgrid[0:size_y, 0:size_x]
+    heights = (60 + 20*np.sin(xx/30) + 10*np.cos(yy/20)).astype(np.uint16)
+    paths = {name: str(tmp_path / name) for name in ("heightmap.dat", "features.json", "buildings.dat")}
+    with open(paths["heightmap.dat"], "wb") as f:
+        write_heightmap(f, heights, min_x, min_y, block_rows=32)
+
+    def random_x(margin=20):
+        return min_x + rnd.randint(-margin, size_x+margin)
+
+    def random_y(margin=20):
+        return min_y + rnd.randint(-margin, size_y+margin)
+
+    areas = []
+    for _ in range(20):
+        cx, cy, r = random_x(), random_y(), rnd.randint(5, 40)
+        angles = sorted(rnd.random()*2*np.pi for _ in range(6))
+        areas.append({
+            "x": [int(cx + r*np.cos(a)) for a in angles], "y": [int(cy + r*np.sin(a)) for a in angles],
+            "surface": rnd.choice(["water", "park", "parking", "grass", "pitch"]),
+        })
+    buildings = []
+    for _ in range(150):
+        x, y, w, d = random_x(10), random_y(10), rnd.randint(4, 20), rnd.randint(4, 20)
+        building = {"x": [x, x+w, x+w, x, x], "y": [y, y, y+d, y+d, y], "is_part": rnd.random() < 0.2}
+        if rnd.random() < 0.5:
+            building["height"] = rnd.randint(0, 40)
+        buildings.append(building)
+    highways = []
+    for _ in range(40):
+        n = rnd.randint(2, 5)
+        highways.append({
+            "x": [random_x(30) for _ in range(n)], "y": [random_y(30) for _ in range(n)],
+            "surface": rnd.choice(["footway", "highway", "service"]), "layer": rnd.choice([0, 0, -1, 1]),
+            "type": rnd.choice(["footway", "service", "primary", "path"]),
+        })
+    decorations = {"tree": [], "bush": [], "fence": [], "hedge": []}
+    for _ in range(600):
+        decorations[rnd.choice(["tree", "bush"])].append({"x": random_x(10), "y": random_y(10)})
+    for _ in range(30):
+        n = rnd.randint(2, 4)
+        decorations[rnd.choice(["fence", "hedge"])].append({"x": [random_x(10) for _ in range(n)], "y": [random_y(10) for _ in range(n)]})
+    with open(paths["features.json"], "w") as f:
+        json.dump({
+            "min_x": min_x, "max_x": min_x+size_x-1, "min_y": min_y, "max_y": min_y+size_y-1,
+            "areas": areas, "buildings": buildings, "highways": highways, "decorations": decorations,
+        }, f)
+
+    with open(paths["buildings.dat"], "wb") as f:
+        writer = SpanWriter(f)
+        for _ in range(40):
+            x, y = rnd.randint(0, size_x-10), rnd.randint(0, size_y-10)
+            z = int(heights[y, x])
+            writer.write(building_spans({
+                "ground": [(min_x+x+i, min_y+y+j, z) for i in range(8) for j in range(8)],
+                "wall": [(min_x+x+i, min_y+y, z+k) for i in range(8) for k in range(10)],
+                "roof": [(min_x+x+i, min_y+y+j, z+10+i//3) for i in range(8) for j in range(8)],
+            }))
+        writer.close()
+    return paths
@@ -0,0 +1,74 @@
+import json
+import os
+
+import pytest
+
+import catalog
+import parse_heightmap_xyz
+from catalog import load_catalog, scan, select_files, CATALOG_VERSION
+
+
+def write_xyz(path, positions):
+    with open(path, "w", encoding="utf-8") as f:
+        for x, y in positions:
+            f.write(f"{x} {y} 100.5\n")
+
+
+def test_scan_and_select(tmp_path, monkeypatch):
+    data = tmp_path / "data"
+    data.mkdir()
+    write_xyz(data / "a.xyz", [(1000.0, 2000.0), (1009.5, 2005.0)])
+    write_xyz(data / "b.xyz", [(2000.0, 3000.0), (2009.0, 3009.0)])
+    (data / "notes.txt").write_text("not an input file")
+    # more lines than are parsed at a time
+    monkeypatch.setattr(catalog, "XYZ_LINES", 1)
+
+    base = tmp_path / "parsed_data"
+    base.mkdir()
+    c = scan([str(data)], base=str(base))
+    assert list(c["files"]) == [os.path.join("..", "data", "a.xyz"), os.path.join("..", "data", "b.xyz")]
+    assert c["files"][os.path.join("..", "data", "a.xyz")]["bbox"] == [1000, 2000, 1009, 2005]
+
+    def select(*args):
+        return [os.path.normpath(p) for p in select_files(c, *args, base=str(base))]
+
+    assert select(("xyz",)) == [str(data / "a.xyz"), str(data / "b.xyz")]
+    assert select(("xyz",), 1009, 2005, 1500, 2500) == [str(data / "a.xyz")]
+    assert select(("xyz",), 1010, 2006, 1999, 2999) == []
+    assert select(("geotiff",)) == []
+
+
+def test_cityjsonseq_header_extent(tmp_path):
+    path = tmp_path / "a.city.jsonl"
+    header = {"type": "CityJSON", "transform": {"scale": [1, 1, 1], "translate": [0, 0, 0]},
+              "metadata": {"geographicalExtent": [10.5, 20.5, 0, 30.5, 40.5, 50]}}
+    # the features aren't read if the header has the extent
+    path.write_text(json.dumps(header) + "\nnot json\n")
+    assert catalog.cityjsonseq_extent(str(path)) == (10, 20, 31, 41)
+
+    del header["metadata"]
+    feature = {"type": "CityJSONFeature", "vertices": [[1, 2, 3], [5, 6, 7]]}
+    path.write_text(json.dumps(header) + "\n" + json.dumps(feature) + "\n")
+    assert catalog.cityjsonseq_extent(str(path)) == (1, 2, 5, 6)
+
+
+def test_load_catalog_version_1(tmp_path, monkeypatch):
+    (tmp_path / "parsed_data").mkdir()
+    path = tmp_path / "parsed_data" / "catalog.json"
+    entry = {"format": "xyz", "size": 1, "mtime": 1, "sha256": "", "bbox": [0, 0, 1, 1]}
+    # version 1: paths relative to the working directory
+    path.write_text(json.dumps({"version": 1, "files": {os.path.join("data", "a.xyz"): entry}}))
+    monkeypatch.chdir(tmp_path)
+    c = load_catalog(str(path))
+    assert c == {"version": CATALOG_VERSION, "files": {os.path.join("..", "data", "a.xyz"): entry}}
+
+    path.write_text(json.dumps({"version": CATALOG_VERSION + 1, "files": {}}))
+    with pytest.raises(ValueError):
+        load_catalog(str(path))
+
+
+def test_bbox_requires_catalog(tmp_path, capsys):
+    with pytest.raises(SystemExit) as e:
+        parse_heightmap_xyz.main(["--bbox", "0", "0", "1", "1", "-o", str(tmp_path / "heightmap.dat")])
+    assert e.value.code == 2
+    assert "--bbox requires --catalog" in capsys.readouterr().err
@@ -0,0 +1,72 @@
+import json
+import shutil
+
+import pytest
+
+import generate_map
+from _mapdat import read_map
+
+
+def change_features(features):
+    # move, remove, add and modify features of every kind
+    features["areas"][0]["x"] = [x + 7 for x in features["areas"][0]["x"]]
+    del features["areas"][3]
+    features["buildings"][1]["height"] = 25
+    del features["buildings"][5:8]
+    features["buildings"].append({"x": [500050, 500060, 500060, 500050], "y": [5800050, 5800050, 5800058, 5800058], "is_part": False})
+    features["highways"][2]["layer"] = -1
+    features["highways"][4]["y"] = [y - 12 for y in features["highways"][4]["y"]]
+    features["decorations"]["tree"].append({"x": 500120, "y": 5800090})
+    del features["decorations"]["bush"][:5]
+    del features["decorations"]["fence"][0]
+
+
+def add_area_below_building(features):
+    # a new area below a part of a building: its region needs the heights below the whole building
+    features["areas"].append({"x": [500130, 500150, 500150, 500130], "y": [5800095, 5800095, 5800120, 5800120], "surface": "water"})
+
+
+def assert_previous_features_match_full_run(tmp_path, args, features, change):
+    old_features = str(tmp_path / "old_features.json")
+    new_features = str(tmp_path / "new_features.json")
+    with open(old_features, "w") as f:
+        json.dump(features, f)
+    change(features)
+    with open(new_features, "w") as f:
+        json.dump(features, f)
+
+    full = str(tmp_path / "full.dat")
+    generate_map.main([*args, "--features", old_features, "-o", full])
+    updated = str(tmp_path / "updated.dat")
+    shutil.copy(full, updated)
+    generate_map.main([*args, "--features", new_features, "--incr", "-o", full])
+    generate_map.main([*args, "--features", new_features, "--previous-features", old_features, "-o", updated])
+
+    with open(full, "rb") as f1, open(updated, "rb") as f2:
+        header_full, a_full, incr_full = read_map(f1)
+        header_updated, a_updated, incr_updated = read_map(f2)
+    assert header_full == header_updated
+    assert (a_full == a_updated).all()
+    assert incr_full != b""
+    assert incr_full == incr_updated
+
+
+@pytest.mark.parametrize("options", [
+    ["--offsetx", "500100", "--offsetz", "5800107"],
+    ["--buildings", "buildings.dat"],
+    ["--flat"],
+])
+def test_previous_features_match_full_run(tmp_path, map_inputs, options):
+    args = ["--heightmap", map_inputs["heightmap.dat"]] + [map_inputs.get(o, o) for o in options]
+    with open(map_inputs["features.json"]) as f:
+        features = json.load(f)
+    assert_previous_features_match_full_run(tmp_path, args, features, change_features)
+
+
+def test_previous_features_use_heights_of_whole_buildings(tmp_path, map_inputs):
+    features = {
+        "min_x": 500000, "max_x": 500199, "min_y": 5800000, "max_y": 5800159,
+        "areas": [],
+        "buildings": [{"x": [500140, 500160, 500160, 500140], "y": [5800100, 5800100, 5800115, 5800115], "is_part": False}],
+    }
+    assert_previous_features_match_full_run(tmp_path, ["--heightmap", map_inputs["heightmap.dat"]], features, add_area_below_building)
@@ -0,0 +1,97 @@
+import numpy as np
+import skimage.draw
+
+from _buildings import SPAN_DTYPE, NONE
+from _features import FeatureColumns
+from _mapdat import BUILDING_BASE, BUILDING_FLAG
+from _util import SURFACES
+from generate_map import rasterize_building_spans, rasterize_buildings, fill_polygons, draw_lines
+
+
+def random_spans(rng, count, size_x, size_y):
+    spans = np.zeros(count, dtype=SPAN_DTYPE)
+    # few positions, so many spans share one
+    spans["x"] = 100 + rng.integers(0, size_x, count)
+    spans["y"] = 200 + rng.integers(0, size_y, count)
+    spans["ground"] = np.where(rng.random(count) < 0.2, NONE, rng.integers(20, 40, count))
+    spans["zmin"] = rng.integers(30, 60, count)
+    spans["zmax"] = spans["zmin"] + rng.integers(0, 30, count)
+    spans["zmin"][rng.random(count) < 0.2] = NONE
+    spans["roof"] = rng.integers(0, 2, count)
+    return spans
+
+
+def test_building_spans_are_reduced_per_column():
+    rng = np.random.default_rng(0)
+    size_x, size_y = 20, 10
+    spans = random_spans(rng, 500, size_x, size_y)
+    a = np.zeros((size_y, size_x, 4), dtype=np.uint16)
+    a[:, :, 2] = rng.integers(0, 3, (size_y, size_x))
+    expected = a.copy()
+    rasterize_building_spans(a, spans, 100, 200, heightmap_sub=5)
+
+    for y in range(size_y):
+        for x in range(size_x):
+            column = spans[(spans["x"] == 100+x) & (spans["y"] == 200+y)]
+            ground = column[column["ground"] != NONE]
+            if len(ground):
+                expected[y, x, 0] = ground["ground"].max() - 5
+                expected[y, x, 1] = SURFACES["building_ground"]
+            building = column[column["zmin"] != NONE]
+            if len(building):
+                expected[y, x, 2] = BUILDING_BASE + max(building["zmin"].min() - 5, 1)
+                expected[y, x, 3] = max(BUILDING_BASE*int(s["roof"]) + s["zmax"] - 5 for s in building)
+    assert (a[:, :, 2] >= BUILDING_FLAG).any()
+    assert (a == expected).all()
+
+
+def random_polygons(rng, count, size):
+    polygons = []
+    for _ in range(count):
+        n = rng.integers(3, 9)
+        polygons.append((rng.integers(-5, size+5, n).tolist(), rng.integers(-5, size+5, n).tolist()))
+    # collinear edges that overlap
+    polygons.append(([20, 30, 31, 45], [30, 38, 52, 50]))
+    return polygons
+
+
+def test_fill_polygons_like_skimage():
+    rng = np.random.default_rng(1)
+    shape = (50, 60)
+    polygons = random_polygons(rng, 1000, 55)
+    x = np.concatenate([p[0] for p in polygons])
+    y = np.concatenate([p[1] for p in polygons])
+    ids = np.repeat(np.arange(len(polygons)), [len(p[0]) for p in polygons])
+    xx, yy, poly = fill_polygons(x, y, ids, shape)
+    for i, (px, py) in enumerate(polygons):
+        expected_x, expected_y = skimage.draw.polygon(px, py, (shape[1], shape[0]))
+        assert sorted(zip(xx[poly == i].tolist(), yy[poly == i].tolist())) == sorted(zip(expected_x.tolist(), expected_y.tolist()))
+
+
+def test_building_ground_is_mean_below_perimeter():
+    rng = np.random.default_rng(2)
+    for px, py in random_polygons(rng, 200, 30):
+        px, py = np.add(px, 10).tolist(), np.add(py, 10).tolist()
+        a = np.zeros((70, 70, 4), dtype=np.uint16)
+        a[:, :, 0] = rng.integers(0, 100, (70, 70))
+        heights = a[:, :, 0].copy()
+        rasterize_buildings(a, FeatureColumns.from_dicts([{"x": px, "y": py}]), 0, 0)
+        # polygon_perimeter counts the pixels shared by two segments twice
+        outline_x, outline_y = skimage.draw.polygon_perimeter(px, py)
+        ground = int(np.rint(heights[outline_y, outline_x].mean()))
+        fill_x, fill_y = skimage.draw.polygon(px, py)
+        assert (a[fill_y, fill_x, 2] == BUILDING_BASE + ground + 1).all()
+        assert (a[outline_y, outline_x, 0] == ground).all()
+
+
+def test_draw_lines_like_skimage():
+    rng = np.random.default_rng(3)
+    x1, y1, x2, y2 = rng.integers(-20, 20, (4, 2000))
+    # points and axis-parallel lines
+    x2[:10], y2[:10] = x1[:10], y1[:10]
+    y2[10:20] = y1[10:20]
+    xx, yy, seg = draw_lines(x1, y1, x2, y2)
+    for i in range(len(x1)):
+        expected_y, expected_x = skimage.draw.line(y1[i], x1[i], y2[i], x2[i])
+        assert xx[seg == i].tolist() == expected_x.tolist()
+        assert yy[seg == i].tolist() == expected_y.tolist()
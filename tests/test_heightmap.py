@@ -0,0 +1,76 @@
+import io
+import zlib
+
+import numpy as np
+
+import _heightmap
+from _heightmap import write_heightmap, read_heightmap, read_heightmap_header, read_heightmap_min
+from _util import to_bytes
+
+
+def heightmap_file(a, min_x, min_y, **kwargs):
+    f = io.BytesIO()
+    write_heightmap(f, a, min_x, min_y, **kwargs)
+    f.seek(0)
+    return f, read_heightmap_header(f)
+
+
+def test_min_decompresses_every_block_once(monkeypatch):
+    rng = np.random.default_rng(0)
+    a = rng.integers(100, 1000, (700, 30)).astype(np.uint16)
+    f, header = heightmap_file(a, 1000, 2000)
+    calls = []
+    decompress = zlib.decompress
+    monkeypatch.setattr(_heightmap.zlib, "decompress", lambda data: calls.append(1) or decompress(data))
+    # rows 100..650 of the heightmap: not aligned with the blocks of BLOCK_ROWS rows
+    assert read_heightmap_min(f, header, 1005, 2100, 1020, 2650) == a[100:651, 5:21].min()
+    assert len(calls) == 3
+    # areas reaching beyond the heightmap
+    assert read_heightmap_min(f, header, 900, 1900, 1100, 2100) == a.min()
+    assert read_heightmap_min(f, header, 900, 1900, 950, 1950) == 0
+
+
+def legacy_heightmap_file(a, min_x, min_y):
+    f = io.BytesIO()
+    f.write(to_bytes(min_x, 4) + to_bytes(min_y, 4) + to_bytes(a.shape[1], 2) + to_bytes(a.shape[0], 2))
+    f.write(zlib.compress(a.astype(np.uint8).tobytes()))
+    f.seek(0)
+    return f, read_heightmap_header(f)
+
+
+def test_window_reads(tmp_path):
+    rng = np.random.default_rng(0)
+    a = rng.integers(0, 256, (70, 30)).astype(np.uint16)
+    files = [
+        heightmap_file(a, 1000, 2000, block_rows=16),
+        legacy_heightmap_file(a, 1000, 2000),
+    ]
+    # uncompressed heightmaps are memory-mapped, which needs a real file
+    path = tmp_path / "heightmap.dat"
+    path.write_bytes(heightmap_file(a, 1000, 2000, block_rows=16, compress=False)[0].getvalue())
+    f = open(path, "rb")
+    files.append((f, read_heightmap_header(f)))
+    windows = [
+        # whole heightmap, within one block, across blocks, beyond the edges, outside
+        ((None, None, None, None), a, 1000, 2000),
+        ((1003, 2001, 1010, 2010), a[1:11, 3:11], 1003, 2001),
+        ((1000, 2010, 1029, 2050), a[10:51], 1000, 2010),
+        ((990, 2060, 1040, 2100), a[60:, :], 1000, 2060),
+        ((1100, 2000, 1200, 2010), a[:11, 30:], 1030, 2000),
+    ]
+    for f, header in files:
+        for window, expected, x, y in windows:
+            b, min_x, min_y = read_heightmap(f, header, *window)
+            assert b.dtype == np.uint16
+            assert b.shape == expected.shape
+            assert (b == expected).all()
+            assert (min_x, min_y) == (x, y)
+    f.close()
+
+
+def test_16_bit_heights():
+    a = np.array([[0, 255], [256, 65535]], dtype=np.uint16)
+    f, header = heightmap_file(a, 5, 6)
+    assert header["dtype"] == np.dtype("<u2")
+    b, _, _ = read_heightmap(f, header)
+    assert (b == a).all()
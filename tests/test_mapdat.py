@@ -0,0 +1,114 @@
+import io
+import zlib
+
+import numpy as np
+
+from _mapdat import (
+    ENCODING_DELTA, ENCODING_RAW, MAP_VERSION, STORAGE_16, STORAGE_8, STORAGE_8_FLAG, TILE_SIZE, BUILDING_BASE, BUILDING_FLAG,
+    decode_layer, encode_layer, encode_map_layer, narrow_layer, read_map, write_map,
+)
+from _util import to_bytes
+
+
+def random_map(rng, size_y, size_x):
+    a = np.zeros((size_y, size_x, 4), dtype=np.uint16)
+    # smooth ground, so layer 0 is stored with delta tiles
+    a[:, :, 0] = 100 + np.add.outer(np.arange(size_y) // 3, np.arange(size_x) // 5)
+    a[:, :, 1] = rng.integers(0, 3, (size_y, size_x))
+    # uniform tiles in the first rows
+    a[:TILE_SIZE, :, 1] = 7
+    a[:, :, 2] = np.where(rng.random((size_y, size_x)) < 0.1, BUILDING_FLAG + rng.integers(0, 100, (size_y, size_x)), 0)
+    return a
+
+
+def test_layer_round_trip():
+    rng = np.random.default_rng(0)
+    # edge tiles are only partly covered
+    layer = rng.integers(0, 256, (40, 37)).astype(np.uint8)
+    layer[:16, :16] = 5
+    for dtype in (np.uint8, np.uint16):
+        for encoding in (ENCODING_RAW, ENCODING_DELTA):
+            data = encode_layer(layer.astype(dtype), encoding=encoding)
+            # tile flags, 1 value of the uniform tile and the data of the 8 others
+            assert len(data) == 9 + np.dtype(dtype).itemsize * (1 + 8*TILE_SIZE*TILE_SIZE)
+            decoded = decode_layer(data, 40, 37, encoding=encoding, dtype=dtype)
+            assert decoded.dtype == dtype
+            assert (decoded == layer).all()
+
+
+def test_ground_uses_delta_tiles():
+    a = random_map(np.random.default_rng(0), 50, 70)
+    assert encode_map_layer(a[:, :, 0], 0)[0] == ENCODING_DELTA
+    assert encode_map_layer(a[:, :, 1], 1)[0] == ENCODING_RAW
+
+    f = io.BytesIO()
+    write_map(f, a, 3, 4, zlib.compress(b"incr"))
+    f.seek(0)
+    header, b, incr = read_map(f)
+    assert (header["offset_x"], header["offset_z"], header["size_x"], header["size_y"]) == (3, 4, 70, 50)
+    assert header["floor_height"] == a[4, 3, 0]
+    assert (b == a).all()
+    assert incr == b"incr"
+
+
+def legacy_map(a, version):
+    # header and layers of map.dat version 1 and 2; layers 2 and 3 store bit 15 as bit 7
+    b = a.copy()
+    b[:, :, 2:] = (b[:, :, 2:] >> 8) & 0x80 | b[:, :, 2:] & 0x7F
+    b = b.astype(np.uint8)
+    f = io.BytesIO()
+    f.write(to_bytes(version, 1))
+    f.write(to_bytes(1, 1))
+    f.write(to_bytes(a.shape[2], 1))
+    f.write(to_bytes(int(a[0, 0, 0]), 1))
+    for value in (0, 0, a.shape[1], a.shape[0]):
+        f.write(to_bytes(value, 2))
+    if version == 1:
+        data = zlib.compress(b.tobytes())
+        f.write(to_bytes(len(data), 4))
+        f.write(data)
+    else:
+        f.write(to_bytes(TILE_SIZE, 1))
+        for i in range(a.shape[2]):
+            data = zlib.compress(encode_layer(b[:, :, i], encoding=ENCODING_DELTA))
+            f.write(to_bytes(ENCODING_DELTA, 1))
+            f.write(to_bytes(len(data), 4))
+            f.write(data)
+    f.write(to_bytes(0, 4))
+    f.seek(0)
+    return f
+
+
+def test_read_legacy_versions():
+    a = random_map(np.random.default_rng(0), 30, 20)
+    for version in (1, 2):
+        header, b, incr = read_map(legacy_map(a, version))
+        assert header["version"] == version
+        assert (header["size_x"], header["size_y"], header["layer_count"]) == (20, 30, 4)
+        assert (b == a).all()
+        assert incr == b""
+
+
+def test_layer_storage():
+    a = np.zeros((20, 30, 4), dtype=np.uint16)
+    a[:, :, 0] = 1000 + np.arange(30)  # heights above 255
+    a[:, :, 1] = 200
+    a[5, 5:10, 2] = BUILDING_FLAG + 100
+    a[5, 5:10, 3] = BUILDING_BASE + 2000  # roof at z=2000
+    a[6, 6, 3] = 40
+    storages = [encode_map_layer(a[:, :, i], i)[1] for i in range(4)]
+    assert storages == [STORAGE_16, STORAGE_8, STORAGE_8_FLAG, STORAGE_16]
+    # values >= 128 next to building positions need 16 bits
+    assert narrow_layer(np.array([BUILDING_FLAG + 5, 128], dtype=np.uint16))[0] == STORAGE_16
+
+    # offsets and sizes don't fit into the 16-bit fields of version 2
+    wide = np.zeros((3, 70000, 4), dtype=np.uint16)
+    wide[:, :, 0] = 65535
+    for m, offset_x, top in ((a, 12, 2000), (wide, 66000, 65535)):
+        f = io.BytesIO()
+        write_map(f, m, offset_x, 1)
+        f.seek(0)
+        header, b, _ = read_map(f)
+        assert header["version"] == MAP_VERSION
+        assert (header["offset_x"], header["floor_height"], header["top_height"]) == (offset_x, m[1, offset_x, 0], top)
+        assert (b == m).all()
@@ -0,0 +1,69 @@
+import json
+
+import numpy as np
+
+import parse_cityjson
+from parse_cityjson import read_cityjson
+
+
+TRANSFORM = {"scale": [0.5, 0.5, 0.5], "translate": [100, 200, 10]}
+
+
+def box_building(x1, y1, x2, y2, z):
+    # vertices (with TRANSFORM applied when read) and a Solid with ground, roof and 4 walls
+    vertices = [[x1, y1, 0], [x2, y1, 0], [x2, y2, 0], [x1, y2, 0], [x1, y1, z], [x2, y1, z], [x2, y2, z], [x1, y2, z]]
+    boundaries = [[
+        [[0, 3, 2, 1]], [[4, 5, 6, 7]],
+        [[0, 1, 5, 4]], [[1, 2, 6, 5]], [[2, 3, 7, 6]], [[3, 0, 4, 7]],
+    ]]
+    geometry = {
+        "type": "Solid",
+        "lod": "2",
+        "boundaries": boundaries,
+        "semantics": {
+            "surfaces": [{"type": "GroundSurface"}, {"type": "RoofSurface"}, {"type": "WallSurface"}],
+            "values": [[0, 1, 2, 2, 2, 2]],
+        },
+    }
+    return {"type": "Building", "geometry": [geometry]}, vertices
+
+
+def fake_set_fill(fill):
+    # raster_geometry isn't needed to compare the readers: only the corners are "rasterized"
+    parse_cityjson.get_polygon_points_normal = list
+    parse_cityjson.get_polygon_points_roof = list
+
+
+def test_cityjsonseq_matches_cityjson(tmp_path, monkeypatch):
+    monkeypatch.setattr(parse_cityjson, "set_fill", fake_set_fill)
+    buildings = {"a": box_building(0, 0, 10, 6, 12), "b": box_building(20, 4, 30, 16, 30)}
+
+    vertices = []
+    city_objects = {}
+    for id_, (co, co_vertices) in buildings.items():
+        co = json.loads(json.dumps(co))
+        co["geometry"][0]["boundaries"] = [[[[i + len(vertices) for i in ring] for ring in surface] for surface in shell]
+                                           for shell in co["geometry"][0]["boundaries"]]
+        city_objects[id_] = co
+        vertices.extend(co_vertices)
+    path_json = tmp_path / "city.city.json"
+    path_json.write_text(json.dumps({
+        "type": "CityJSON", "version": "1.1", "transform": TRANSFORM, "CityObjects": city_objects, "vertices": vertices,
+    }))
+
+    lines = [{"type": "CityJSON", "version": "2.0", "transform": TRANSFORM, "CityObjects": {}, "vertices": []}]
+    for id_, (co, co_vertices) in buildings.items():
+        lines.append({"type": "CityJSONFeature", "id": id_, "CityObjects": {id_: co}, "vertices": co_vertices})
+    path_jsonl = tmp_path / "city.city.jsonl"
+    path_jsonl.write_text("".join(json.dumps(line) + "\n" for line in lines))
+
+    spans_json = read_cityjson([str(path_json)])
+    spans_jsonl = read_cityjson([str(path_jsonl)], processes=1)
+    assert len(spans_json) == 8
+    order_json = np.lexsort((spans_json["y"], spans_json["x"]))
+    order_jsonl = np.lexsort((spans_jsonl["y"], spans_jsonl["x"]))
+    assert (spans_json[order_json] == spans_jsonl[order_jsonl]).all()
+
+    # corner (0, 0, 0)..(0, 0, 12) of building a
+    corner = spans_jsonl[(spans_jsonl["x"] == 100) & (spans_jsonl["y"] == 200)][0]
+    assert (corner["ground"], corner["zmin"], corner["zmax"], corner["roof"]) == (10, 10, 16, 1)
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from catalog import geotiff_extent
+from parse_heightmap_raster import read_rasters
+from parse_heightmap_xyz import read_xyz
+
+tifffile = pytest.importorskip("tifffile")
+
+
+def write_geotiff(path, values, corner_x, corner_y):
+    # pixel size 1, georeferenced by the upper left corner of the upper left pixel (PixelIsArea)
+    tags = [
+        (33550, 12, 3, (1.0, 1.0, 0.0)),
+        (33922, 12, 6, (0.0, 0.0, 0.0, float(corner_x), float(corner_y), 0.0)),
+    ]
+    tifffile.imwrite(path, values, extratags=tags)
+
+
+def test_geotiff_matches_xyz(tmp_path):
+    rng = np.random.default_rng(0)
+    # first row is the northernmost one; the raster covers x 1000..1200, y 2000..2250
+    north = rng.integers(0, 200, size=(250, 200)).astype(np.float32)
+    # tiles with corners at odd and even coordinates
+    write_geotiff(tmp_path / "west.tif", north[:, :101], 1000, 2250)
+    write_geotiff(tmp_path / "east.tif", north[:, 101:], 1101, 2250)
+    # the same heights as XYZ, at the center of every pixel
+    with open(tmp_path / "heights.xyz", "w") as f:
+        for row, y in enumerate(range(2249, 1999, -1)):
+            for col in range(200):
+                f.write(f"{1000+col+0.5} {y+0.5} {north[row, col]}\n")
+
+    raster, raster_x, raster_y = read_rasters([str(tmp_path / "west.tif"), str(tmp_path / "east.tif")])
+    xyz, xyz_x, xyz_y = read_xyz([str(tmp_path / "heights.xyz")])
+    assert (raster_x, raster_y) == (xyz_x, xyz_y) == (1000, 2000)
+    assert raster.shape == xyz.shape
+    assert (raster == xyz).all()
+
+    assert geotiff_extent(str(tmp_path / "west.tif")) == (1000, 2000, 1100, 2249)
+    assert geotiff_extent(str(tmp_path / "east.tif")) == (1101, 2000, 1199, 2249)
@@ -0,0 +1,88 @@
+import http.client
+import json
+import threading
+from http.server import HTTPServer
+
+import numpy as np
+import pytest
+
+from _features import Features, FeatureColumns
+from generate_map import generate_map
+from serve_map import MapState, MapRequestHandler
+
+
+def rectangle(x1, y1, x2, y2, **attributes):
+    return {"x": [x1, x2, x2, x1], "y": [y1, y1, y2, y2], **attributes}
+
+
+def test_render_includes_dependent_features():
+    bounds = (1000, 2000, 1199, 2099)
+    heights = (10 + np.arange(200)[None, :] // 4 + np.zeros((100, 1), dtype=np.int64)).astype(np.uint16)
+    heightmap = (heights, 1000, 2000)
+    water = rectangle(1040, 2020, 1090, 2060, surface="water")
+    # the building's ground height depends on the flattened water area, but it reaches beyond the area's bbox
+    building = rectangle(1080, 2030, 1120, 2050, is_part=False)
+    features = Features(areas=FeatureColumns.from_dicts([water]), buildings=FeatureColumns.from_dicts([building]))
+    state = MapState(bounds, 0, 0, heightmap, features)
+    before = state.a.copy()
+
+    moved = rectangle(1040, 2070, 1070, 2095, surface="water")
+    region = state.override_features({"areas": [moved]}, 1040, 2020, 1090, 2060)
+    assert region[2] >= 1120
+    state.render(*region)
+
+    expected = generate_map(*bounds, heightmap, state.features, heightmap_sub=state.heightmap_sub)
+    assert (state.a == expected).all()
+    # every changed block is exported as incr data
+    changed_x, changed_z = np.nonzero((before != expected).any(axis=2).T)
+    assert set(zip((changed_x // 16).tolist(), (changed_z // 16).tolist())) <= state.dirty_blocks
+
+
+def request(server, path, body, content_type="application/json"):
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request("POST", path, json.dumps(body), {"Content-Type": content_type})
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+
+@pytest.fixture
+def server(tmp_path):
+    bounds = (0, 0, 63, 63)
+    heightmap = (np.full((64, 64), 10, dtype=np.uint16), 0, 0)
+    handler = type("Handler", (MapRequestHandler,), {
+        "state": MapState(bounds, 0, 0, heightmap),
+        "output": str(tmp_path / "map.dat"),
+        "log_message": lambda self, *args: None,
+    })
+    server = HTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_export_rejects_cross_origin_requests(server, tmp_path):
+    # a web page can send text/plain without a preflight request
+    status, _ = request(server, "/export", {}, "text/plain")
+    assert status == 415
+    status, _ = request(server, "/export", {"output": str(tmp_path / "other.dat")})
+    assert status == 400
+    assert not (tmp_path / "other.dat").exists()
+    assert not (tmp_path / "map.dat").exists()
+    status, response = request(server, "/export", {})
+    assert status == 200 and response["output"] == str(tmp_path / "map.dat")
+    assert (tmp_path / "map.dat").exists()
+
+
+def test_failed_export_keeps_changed_blocks(server, tmp_path):
+    state = server.RequestHandlerClass.state
+    state.dirty_blocks.update({(0, 0), (1, 2)})
+    server.RequestHandlerClass.output = str(tmp_path / "missing" / "map.dat")
+    status, _ = request(server, "/export", {"incr": True})
+    assert status == 500
+    assert state.dirty_blocks == {(0, 0), (1, 2)}
+    server.RequestHandlerClass.output = str(tmp_path / "map.dat")
+    status, response = request(server, "/export", {"incr": True})
+    assert status == 200 and response["changed_blocks"] == 2
+    assert not state.dirty_blocks
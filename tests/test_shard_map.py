@@ -0,0 +1,55 @@
+import json
+import shutil
+
+import pytest
+
+import generate_map
+import shard_map
+from _mapdat import read_map
+
+
+def run_shards(tmp_path, name, args, merge_args):
+    # plan, generate every shard and merge them; returns the path of the merged map
+    plan = str(tmp_path / f"{name}.plan.json")
+    shard_map.main(["plan", *args, "--shard-blocks", "3", "-o", plan])
+    with open(plan) as f:
+        shard_count = len(json.load(f)["shards"])
+    assert shard_count > 1
+    shards = [str(tmp_path / f"{name}.{i}.shard") for i in range(shard_count)]
+    for i, shard in enumerate(shards):
+        shard_map.main(["generate", plan, "--shard", str(i), "-o", shard])
+    output = str(tmp_path / f"{name}.merged.dat")
+    if "--incr" in merge_args:
+        shutil.copy(str(tmp_path / f"{name}.single.dat"), output)
+    # any order of the shard files gives the same map
+    shard_map.main(["merge", plan, *reversed(shards), *merge_args, "-o", output])
+    return output
+
+
+@pytest.mark.parametrize("options", [
+    ["--offsetx", "500100", "--offsetz", "5800107"],
+    ["--buildings", "buildings.dat", "--offsetx", "500003", "--offsetz", "5800100"],
+    ["--buildings", "buildings.dat", "--flat", "--minx", "499990", "--maxx", "500150"],
+])
+def test_merged_shards_match_single_run(tmp_path, map_inputs, options):
+    args = ["--heightmap", map_inputs["heightmap.dat"], "--features", map_inputs["features.json"]]
+    args += [map_inputs.get(o, o) for o in options]
+    single = str(tmp_path / "map.single.dat")
+    generate_map.main([*args, "-o", single])
+    merged = run_shards(tmp_path, "map", args, [])
+    with open(single, "rb") as f1, open(merged, "rb") as f2:
+        assert f1.read() == f2.read()
+
+
+def test_merged_shards_match_single_run_incr(tmp_path, map_inputs):
+    args = ["--heightmap", map_inputs["heightmap.dat"], "--offsetx", "500000", "--offsetz", "5800000"]
+    single = str(tmp_path / "map.single.dat")
+    generate_map.main([*args, "-o", single])
+    # the features only change part of the map
+    args += ["--features", map_inputs["features.json"], "--minx", "500000", "--maxx", "500150"]
+    merged = run_shards(tmp_path, "map", args, ["--incr"])
+    generate_map.main([*args, "--incr", "-o", single])
+    with open(single, "rb") as f1, open(merged, "rb") as f2:
+        assert f1.read() == f2.read()
+        f1.seek(0)
+        assert read_map(f1)[2] != b""